@@ -0,0 +1,104 @@
+"""
+This script benchmarks the dense and the sparse (edge list) implementation of
+the FusionBlock's graph attention on random entity graphs of growing size.
+For each graph size, it reports the time for a forward and backward pass, the
+peak GPU memory (if run on a GPU) and the maximum difference between the two
+implementations' outputs.
+
+Example:
+python3 benchmarks/graph_attention_scaling.py --nodes 40 100 500 1000 2000 5000 --degree 10
+"""
+
+import os, sys, inspect
+import argparse
+import statistics
+from time import time
+import torch
+
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+
+from modules.FusionBlock import FusionBlock
+
+
+def random_graph(n_nodes, degree, device):
+    """
+    Make a random graph with symmetric links (like an EntityGraph).
+    :param n_nodes: number of nodes
+    :param degree: average number of links per node
+    :param device: torch device object
+    :return: Tensor of shape (2, E) -- source and target nodes of the links
+    """
+    n_links = n_nodes * degree // 2
+    source = torch.randint(n_nodes, (n_links,))
+    target = torch.randint(n_nodes, (n_links,))
+    keep = source != target
+    pairs = torch.stack((source[keep], target[keep]))
+    pairs = torch.cat((pairs, pairs.flip(0)), dim=1) # both directions
+    pairs = torch.unique(pairs, dim=1) # no duplicate links
+    return pairs.to(device)
+
+def time_pass(function, inputs, repeats, device):
+    """
+    Time forward and backward passes of a function.
+    :return: median time in seconds, peak GPU memory in MB (or None on CPU)
+    """
+    times = []
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    for _ in range(repeats):
+        start = time()
+        output = function(*inputs)
+        output.sum().backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time() - start)
+    peak = torch.cuda.max_memory_allocated() / 2**20 if device.type == 'cuda' else None
+    return statistics.median(times), peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, nargs='+', default=[40, 100, 250, 500, 1000, 2000, 5000],
+                        help='graph sizes (number of nodes)')
+    parser.add_argument('--degree', type=int, default=10, help='average number of links per node')
+    parser.add_argument('--emb_size', type=int, default=300, help='d2 in the paper')
+    parser.add_argument('--query_length', type=int, default=30)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--max_dense_nodes', type=int, default=5000,
+                        help='skip the dense implementation for larger graphs')
+    parser.add_argument('--gpu', action='store_true')
+    args = parser.parse_args()
+
+    device = torch.device('cuda') if args.gpu and torch.cuda.is_available() else torch.device('cpu')
+    torch.manual_seed(42)
+
+    fb = FusionBlock(args.emb_size, device=device).to(device)
+    for parameter in [fb.V, fb.U, fb.b, fb.W]:
+        torch.nn.init.normal_(parameter, std=0.02)
+
+    print(f"device: {device}, degree: {args.degree}, repeats: {args.repeats}\n")
+    print("nodes\tedges\tdense_sec\tsparse_sec\tdense_MB\tsparse_MB\tmax_diff")
+    for n_nodes in args.nodes:
+        edges = random_graph(n_nodes, args.degree, device)
+        entity_embs = torch.randn(n_nodes, 2 * args.emb_size, device=device, requires_grad=True)
+        query_emb = torch.randn(args.query_length, args.emb_size, device=device)
+
+        sparse_time, sparse_peak = time_pass(fb.graph_attention_sparse, (entity_embs, query_emb, edges),
+                                             args.repeats, device)
+        if n_nodes <= args.max_dense_nodes:
+            adjacency = torch.zeros(n_nodes, n_nodes, device=device)
+            adjacency[edges[0], edges[1]] = 1
+            dense_time, dense_peak = time_pass(fb.graph_attention, (entity_embs, query_emb, adjacency),
+                                               args.repeats, device)
+            with torch.no_grad():
+                diff = (fb.graph_attention(entity_embs, query_emb, adjacency) -
+                        fb.graph_attention_sparse(entity_embs, query_emb, edges)).abs().max().item()
+        else:
+            dense_time, dense_peak, diff = None, None, None
+
+        print("\t".join([str(n_nodes), str(edges.shape[1])] +
+                        [f"{v:.5f}" if v is not None else "-" for v in [dense_time, sparse_time]] +
+                        [f"{v:.1f}" if v is not None else "-" for v in [dense_peak, sparse_peak]] +
+                        [f"{diff:.2e}" if diff is not None else "-"]))
@@ -0,0 +1,411 @@
+"""
+This script measures throughput and latency of the full pipeline (paragraph
+selection -> entity graph -> DFGN -> decoding) under load. Questions from a
+HotPotQA file are replayed against the pipeline either
+- at a fixed arrival rate (load_mode 'open'; uniform or Poisson arrivals), or
+- by a number of clients that each send their next question as soon as the
+  previous one is answered (load_mode 'closed').
+Server threads take the waiting questions in batches of up to batch_size.
+
+For every combination of the sweep parameters in the config (text_length,
+fb_passes, ps_threshold, batch_size and the arrival rates or concurrency levels),
+one run is made. Each run adds a row to <model>.load.csv with throughput,
+end-to-end latency, queueing time and per-stage latency percentiles and memory
+high-water marks; every question adds a row to <model>.load_questions.csv.
+playground/plot_load_harness.py plots the first one.
+
+Example:
+python3 benchmarks/load_harness.py config/load_harness.cfg my_DFGN_model
+"""
+
+import os, sys, inspect
+import argparse
+import csv
+import itertools
+import queue
+import random
+import resource
+import threading
+from time import time, sleep
+import torch
+
+import flair # for NER in the EntityGraph
+from transformers import BertTokenizer
+
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+
+import utils
+from utils import Profiler
+from utils import HotPotDataHandler
+from utils import ConfigReader
+from modules import ParagraphSelector, EntityGraph
+from train_dfgn import predict_batch, DFGN # DFGN is needed for unpickling the model
+
+# stages as they are named by the profiler spans (per question: selection to alignment; per batch: the others)
+STAGES = ["selection", "ner", "graph", "alignment", "tokenization", "encode", "fusion", "predict", "decode"]
+SWEEP_PARAMETERS = ["text_length", "fb_passes", "ps_threshold", "batch_size"]
+
+
+class Pipeline():
+    """
+    The models of the full network, and a function that answers a batch of questions.
+    """
+
+    def __init__(self, dfgn, para_selector, ner_tagger, tokenizer, device, max_nodes=40, sparse_graphs=False):
+        self.dfgn = dfgn
+        self.para_selector = para_selector
+        self.ner_tagger = ner_tagger
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_nodes = max_nodes
+        self.sparse_graphs = sparse_graphs
+
+    def answer(self, points, settings, profiler):
+        """
+        Answer questions like eval_dfgn.py does.
+        :param points: list of raw points (see HotPotDataHandler.data_for_paragraph_selector())
+        :param settings: dict with text_length, fb_passes and ps_threshold
+        :param profiler: a utils.Profiler that records the stages
+        :return: list[str] -- one answer per point ('noanswer' if the graph has no entities)
+        """
+        usable = [] # (position in points, query, context, graph, sentence lengths)
+        for i, point in enumerate(points):
+            with profiler.span("selection"):
+                context = self.para_selector.make_context(point,
+                                                          threshold=settings["ps_threshold"],
+                                                          context_length=settings["text_length"],
+                                                          device=self.device)
+            graph = EntityGraph.EntityGraph(context,
+                                            context_length=settings["text_length"],
+                                            tagger=self.ner_tagger,
+                                            max_nodes=self.max_nodes,
+                                            sparse=self.sparse_graphs,
+                                            profiler=profiler)
+            if graph.graph:
+                usable.append((i, point[2], context, graph, utils.sentence_lengths(context, self.tokenizer)))
+
+        answers = ["noanswer"] * len(points)
+        if not usable:
+            return answers
+        positions, queries, contexts, graphs, sent_lengths = [list(x) for x in zip(*usable)]
+
+        with profiler.span("tokenization"):
+            qc_ids = [self.dfgn.encoder.token_ids(q, c) for q, c in zip(queries, contexts)]
+            q_ids = [torch.tensor(q, device=self.device) for q, _ in qc_ids]
+            c_ids = [torch.tensor(c, device=self.device) for _, c in qc_ids]
+            graphs = [g.to(self.device) for g in graphs]
+
+        predictions = predict_batch(self.dfgn, q_ids, c_ids, graphs, self.tokenizer, sent_lengths,
+                                    fb_passes=settings["fb_passes"], profiler=profiler) # encode, fusion, predict, decode
+        for position, (answer, _, _) in zip(positions, predictions):
+            answers[position] = answer
+        return answers
+
+
+class Request():
+    """ one question with its timestamps (time.time()) """
+
+    def __init__(self, point):
+        self.point = point
+        self.arrival = None
+        self.start = None
+        self.end = None
+        self.batch_size = 0
+        self.answer = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MemoryMonitor(threading.Thread):
+    """
+    Sample the resident memory of the process in the background and keep the
+    maximum (the high-water mark of one run; getrusage() only has that of the
+    whole process). On GPUs, the peak of allocated memory is taken from torch.
+    """
+
+    def __init__(self, device, interval=0.01):
+        super(MemoryMonitor, self).__init__(daemon=True)
+        self.device = device
+        self.interval = interval
+        self.peak_rss = 0
+        self.stopped = threading.Event()
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+
+    @staticmethod
+    def rss():
+        """ :return: resident memory in bytes (Linux), or the process's maximum (elsewhere) """
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * resource.getpagesize()
+        except (OSError, IndexError, ValueError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # KB on Linux
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak_rss = max(self.peak_rss, self.rss())
+            sleep(self.interval)
+
+    def stop(self):
+        """ :return: peak resident memory and peak GPU memory (0 on CPUs) in MB """
+        self.stopped.set()
+        self.join()
+        self.peak_rss = max(self.peak_rss, self.rss())
+        peak_gpu = torch.cuda.max_memory_allocated() if self.device.type == 'cuda' else 0
+        return self.peak_rss / 2**20, peak_gpu / 2**20
+
+
+def serve(pipeline, requests, settings, batch_size, max_batch_wait, profiler):
+    """
+    Server thread: take waiting requests in batches and answer them until a None arrives.
+    :param requests: queue.Queue of Request objects
+    :param max_batch_wait: seconds to wait for more requests to fill a batch once the first one is there
+    :param profiler: a utils.Profiler for this thread (Profilers are not shared between threads)
+    """
+    while True:
+        first = requests.get()
+        if first is None:
+            return
+        batch = [first]
+        deadline = time() + max_batch_wait
+        while len(batch) < batch_size:
+            try:
+                request = requests.get(timeout=max(0.0, deadline - time())) if max_batch_wait else requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None: # leave it for the next round
+                requests.put(None)
+                break
+            batch.append(request)
+
+        start = time()
+        try:
+            with torch.no_grad():
+                answers = pipeline.answer([r.point for r in batch], settings, profiler)
+            error = None
+        except Exception as e: # report, but keep serving
+            answers, error = [None] * len(batch), repr(e)
+        end = time()
+        profiler.record("service", end - start)
+        for request, answer in zip(batch, answers):
+            request.start, request.end, request.batch_size = start, end, len(batch)
+            request.answer, request.error = answer, error
+            request.done.set()
+
+def run_load(pipeline, points, settings, mode, load, workers=1, batch_size=1, max_batch_wait=0.0,
+             arrival_process="uniform", seed=42):
+    """
+    Replay points against the pipeline.
+    :param points: raw points; each one is sent once
+    :param settings: dict with text_length, fb_passes and ps_threshold (see Pipeline.answer())
+    :param mode: 'open' (load is the arrival rate in questions per second) or
+                 'closed' (load is the number of clients)
+    :param workers: number of server threads
+    :param arrival_process: 'uniform' (fixed intervals) or 'poisson' (exponential intervals); for mode 'open'
+    :return: list[Request], list[Profiler] (one per server thread), run start time
+    """
+    requests = queue.Queue()
+    profilers = [Profiler() for _ in range(workers)]
+    servers = [threading.Thread(target=serve, args=(pipeline, requests, settings, batch_size, max_batch_wait, p),
+                                daemon=True)
+               for p in profilers]
+    for s in servers:
+        s.start()
+
+    sent = [Request(point) for point in points]
+    t0 = time()
+    if mode == 'open':
+        rng = random.Random(seed)
+        offset = 0.0
+        for request in sent:
+            delay = t0 + offset - time()
+            if delay > 0:
+                sleep(delay)
+            request.arrival = time()
+            requests.put(request)
+            offset += rng.expovariate(load) if arrival_process == "poisson" else 1.0 / load
+    elif mode == 'closed':
+        pending = iter(sent)
+        lock = threading.Lock()
+
+        def client():
+            while True:
+                with lock:
+                    request = next(pending, None)
+                if request is None:
+                    return
+                request.arrival = time()
+                requests.put(request)
+                request.done.wait()
+
+        clients = [threading.Thread(target=client, daemon=True) for _ in range(int(load))]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+    else:
+        raise ValueError(f"unknown load_mode: {mode} (use 'open' or 'closed')")
+
+    for request in sent:
+        request.done.wait()
+    for _ in servers:
+        requests.put(None)
+    for s in servers:
+        s.join()
+    return sent, profilers, t0
+
+def summarize(requests, profilers, t0, peak_rss, peak_gpu):
+    """
+    :return: dict -- one row of the summary CSV (without the run's parameters)
+    """
+    percentile = Profiler.percentile
+    ms = lambda values: sorted([1000 * v for v in values])
+    latencies = ms([r.end - r.arrival for r in requests])
+    waits = ms([r.start - r.arrival for r in requests])
+    duration = max([r.end for r in requests]) - t0
+
+    row = {"questions": len(requests),
+           "errors": len([r for r in requests if r.error]),
+           "noanswer": len([r for r in requests if r.answer == "noanswer"]),
+           "duration_s": round(duration, 3),
+           "throughput_qps": round(len(requests) / duration, 3),
+           "mean_batch_size": round(sum([r.batch_size for r in requests]) / len(requests), 2),
+           "latency_mean_ms": round(sum(latencies) / len(latencies), 2)}
+    for q in [50, 95, 99]:
+        row[f"latency_p{q}_ms"] = round(percentile(latencies, q), 2)
+    for q in [50, 95, 99]:
+        row[f"queue_wait_p{q}_ms"] = round(percentile(waits, q), 2)
+    for stage in ["service"] + STAGES:
+        samples = ms([s for p in profilers for s in p.samples.get(stage, [])])
+        for q in [50, 95, 99]:
+            row[f"{stage}_p{q}_ms"] = round(percentile(samples, q), 2)
+    row["peak_rss_mb"] = round(peak_rss, 1)
+    row["peak_gpu_mb"] = round(peak_gpu, 1)
+    return row
+
+def as_list(value, default):
+    """ config values can be single values or lists """
+    if value is None or value is False:
+        return [default]
+    return value if type(value) == list else [value]
+
+
+if __name__ == '__main__':
+    # =========== PARAMETER INPUT
+    take_time = Profiler()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_file', metavar='config', type=str,
+                        help='configuration file for the load test')
+    parser.add_argument('dfgn_model_name', metavar='model', type=str,
+                        help="name of the DFGN model's file")
+    args = parser.parse_args()
+    cfg = ConfigReader(args.config_file)
+
+    model_abs_dir = cfg('model_abs_dir') + args.dfgn_model_name + "/"
+    results_abs_dir = cfg('results_abs_dir') if cfg('results_abs_dir') else model_abs_dir
+    summary_abs_path = results_abs_dir + args.dfgn_model_name + ".load.csv"
+    questions_abs_path = results_abs_dir + args.dfgn_model_name + ".load_questions.csv"
+    if not os.path.exists(results_abs_dir):
+        print(f"newly creating {results_abs_dir}")
+        os.makedirs(results_abs_dir)
+
+    device = torch.device('cpu')
+    if cfg("try_gpu") and torch.cuda.is_available():
+        torch.cuda.set_device(cfg("gpu_number") if cfg("gpu_number") else 0)
+        device = torch.device('cuda')
+    if cfg("torch_threads"):
+        torch.set_num_threads(cfg("torch_threads"))
+
+    mode = cfg("load_mode") if cfg("load_mode") else "closed"
+    loads = as_list(cfg("arrival_rates") if mode == "open" else cfg("concurrency"), 1)
+    sweep = {"text_length": as_list(cfg("text_length"), 250),
+             "fb_passes": as_list(cfg("fb_passes"), 2),
+             "ps_threshold": as_list(cfg("ps_threshold"), 0.1),
+             "batch_size": as_list(cfg("batch_size"), 1)}
+    take_time("parameter input")
+
+
+    # =========== DATA AND MODEL LOADING
+    print(f"Reading questions from {cfg('question_data_abs_path')}...")
+    n_questions = cfg("questions_per_run") if cfg("questions_per_run") else 100
+    points = HotPotDataHandler(cfg("question_data_abs_path"), limit=n_questions).data_for_paragraph_selector()
+    points = list(itertools.islice(itertools.cycle(points), n_questions)) # replay the file if it is too short
+    n_warmup = cfg("warmup_questions") if cfg("warmup_questions") else 0
+    take_time("data loading")
+
+    tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+    flair.device = device
+    ner_tagger = flair.models.SequenceTagger.load('ner')
+
+    dfgn = torch.load(model_abs_dir + args.dfgn_model_name, map_location=device)
+    dfgn.eval()
+    if hasattr(dfgn, "selector"): # trained with a shared BERT
+        para_selector = ParagraphSelector.ParagraphSelector(None, net=dfgn.selector)
+    else:
+        para_selector = ParagraphSelector.ParagraphSelector(cfg("ps_model_abs_dir"))
+        para_selector.net.eval()
+        para_selector.net = para_selector.net.to(device)
+
+    pipeline = Pipeline(dfgn, para_selector, ner_tagger, tokenizer, device,
+                        max_nodes=cfg("max_nodes") if cfg("max_nodes") else 40,
+                        sparse_graphs=cfg("sparse_graphs"))
+    take_time("model loading")
+
+
+    # =========== LOAD RUNS
+    summary_file = open(summary_abs_path, "w", newline="")
+    questions_file = open(questions_abs_path, "w", newline="")
+    summary_writer, questions_writer = None, csv.writer(questions_file)
+    questions_writer.writerow(["run", "question_id", "arrival_s", "queue_wait_ms", "service_ms",
+                               "latency_ms", "batch_size", "answer", "error"])
+
+    combinations = list(itertools.product(*sweep.values(), loads))
+    for run, values in enumerate(combinations):
+        settings = dict(zip(SWEEP_PARAMETERS, values[:-1]))
+        load = values[-1]
+        dfgn.encoder.text_length = settings["text_length"]
+        print(f"run {run + 1}/{len(combinations)}: {settings}, {mode} load: {load}")
+
+        if n_warmup: # not recorded
+            with torch.no_grad():
+                pipeline.answer(points[:n_warmup], settings, Profiler())
+
+        monitor = MemoryMonitor(device)
+        monitor.start()
+        requests, profilers, t0 = run_load(pipeline, points, settings, mode, load,
+                                           workers=cfg("server_threads") if cfg("server_threads") else 1,
+                                           batch_size=settings["batch_size"],
+                                           max_batch_wait=cfg("max_batch_wait") if cfg("max_batch_wait") else 0.0,
+                                           arrival_process=cfg("arrival_process") if cfg("arrival_process") else "uniform",
+                                           seed=cfg("shuffle_seed") if cfg("shuffle_seed") else 42)
+        peak_rss, peak_gpu = monitor.stop()
+
+        row = {"run": run, "load_mode": mode,
+               "arrival_rate": load if mode == "open" else "",
+               "concurrency": load if mode == "closed" else "",
+               **settings,
+               **summarize(requests, profilers, t0, peak_rss, peak_gpu)}
+        if summary_writer is None:
+            summary_writer = csv.DictWriter(summary_file, fieldnames=list(row))
+            summary_writer.writeheader()
+        summary_writer.writerow(row)
+        summary_file.flush()
+        for r in requests:
+            questions_writer.writerow([run, r.point[0], round(r.arrival - t0, 4),
+                                       round(1000 * (r.start - r.arrival), 2), round(1000 * (r.end - r.start), 2),
+                                       round(1000 * (r.end - r.arrival), 2), r.batch_size, r.answer, r.error or ""])
+        print(f"   {row['throughput_qps']} questions/s, latency p50/p95/p99: "
+              f"{row['latency_p50_ms']}/{row['latency_p95_ms']}/{row['latency_p99_ms']} ms, "
+              f"peak memory: {row['peak_rss_mb']} MB" + (f" (GPU: {row['peak_gpu_mb']} MB)" if peak_gpu else ""))
+        if row["errors"]:
+            print(f"   WARNING: {row['errors']} questions failed; see {questions_abs_path}")
+        take_time(f"run {run}")
+
+    summary_file.close()
+    questions_file.close()
+    print(f"Summary in {summary_abs_path}, questions in {questions_abs_path}")
+    take_time.total()
+    print("\nTimes taken:\n", take_time)
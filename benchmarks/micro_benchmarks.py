@@ -0,0 +1,296 @@
+"""
+This script benchmarks the hot paths of the pipeline module by module, on
+synthetic HotPotQA-style data and with tiny, randomly initialised BERT models
+(see benchmarks/synthetic.py), so it runs offline and in a few minutes:
+
+- make_context       ParagraphSelector.make_context() for one point (10 paragraphs)
+- entity_graph       EntityGraph construction (with a stub tagger instead of NER)
+- entity_matrix      EntityGraph.entity_matrix()
+- bidaf              BiDAFNet as used in the Encoder (BERT-sized inputs)
+- fusion_block       FusionBlock.forward() for one point (2 passes)
+- fusion_block_batch FusionBlock.forward_batch() (2 passes)
+- predictor          Predictor.forward() for one point
+- predictor_batch    Predictor.forward_batch()
+- predict            answer span and supporting fact decoding (decode_spans() and supporting_sentences()
+                     in modules/Predictor.py)
+
+Each benchmark is run for a sweep of context lengths, node counts and/or batch
+sizes, in inference mode. The results (median, mean and minimum time in
+milliseconds per call) are written to a JSON file. With --baseline, they are
+compared to an earlier result file, and the script exits with status 1 if any
+case is slower than the baseline by more than --tolerance. Baselines are only
+comparable on the same machine with the same number of threads.
+
+Examples:
+python3 benchmarks/micro_benchmarks.py --output benchmarks/baseline.json
+python3 benchmarks/micro_benchmarks.py --output new.json --baseline benchmarks/baseline.json --tolerance 0.15
+python3 benchmarks/micro_benchmarks.py --benchmarks fusion_block predictor --node_counts 40 500
+"""
+
+import os, sys, inspect
+import argparse
+import json
+import platform
+import statistics
+from datetime import datetime
+from time import perf_counter
+import torch
+
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+sys.path.insert(0, current_dir)
+
+from synthetic import SyntheticData, StubTagger, StubTaggedGraph, RandomGraph, tiny_paragraph_selector
+from modules.EntityGraph import EntityGraph, pad_graphs
+from modules.FusionBlock import FusionBlock
+from modules.Predictor import Predictor, decode_spans, supporting_sentences
+from utils import BiDAFNet
+
+EMB_SIZE = 300 # d2 in the paper; the FusionBlock's BiDAF only works with this size
+QUERY_LENGTH = 30
+
+
+def measure(function, repeats, warmup, device):
+    """
+    Time a function without arguments.
+    :param repeats: number of timed calls
+    :param warmup: number of calls before timing (not recorded)
+    :param device: torch device object; GPU calls are synchronized before taking the time
+    :return: dict -- median, mean and minimum time in milliseconds
+    """
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        function()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append((perf_counter() - start) * 1000)
+    return {"median_ms": statistics.median(times),
+            "mean_ms": statistics.mean(times),
+            "min_ms": min(times),
+            "repeats": repeats}
+
+def case_key(benchmark, params):
+    """
+    :return: str -- e.g. 'fusion_block[context_length=256,nodes=40]'
+    """
+    return benchmark + "[" + ",".join(f"{k}={v}" for k, v in sorted(params.items())) + "]"
+
+
+""" BENCHMARKS """
+# Each benchmark is a generator that does all preparations and then yields
+# (params, function) for every case of its sweep; only the function is timed
+# (before the generator continues, so the functions may use the loop variables).
+
+def bench_make_context(args, data, device):
+    selector = tiny_paragraph_selector(data)
+    selector.net.to(device)
+    for text_length in [l for l in args.context_lengths if l <= 512]:
+        # every paragraph is about text_length tokens long
+        point = data.point(n_sentences=4, words_per_sentence=max(1, text_length // 4))
+        for packed in [False, True]:
+            yield ({"text_length": text_length, "packed": packed},
+                   lambda: selector.make_context(point, threshold=0.1, text_length=text_length,
+                                                 device=device, packed=packed))
+
+def bench_entity_graph(args, data, device):
+    tagger = StubTagger()
+    for context_length in args.context_lengths:
+        context = data.context(context_length)
+        for max_nodes in args.node_counts:
+            yield ({"context_length": context_length, "max_nodes": max_nodes},
+                   lambda: StubTaggedGraph(context, context_length=context_length, tagger=tagger,
+                                           max_nodes=max_nodes))
+
+def bench_entity_matrix(args, data, device):
+    tagger = StubTagger()
+    for context_length in args.context_lengths:
+        context = data.context(context_length)
+        for max_nodes in args.node_counts:
+            graph = StubTaggedGraph(context, context_length=context_length, tagger=tagger, max_nodes=max_nodes)
+            yield ({"context_length": context_length, "max_nodes": max_nodes},
+                   lambda: graph.entity_matrix())
+
+def bench_bidaf(args, data, device):
+    bidaf = BiDAFNet(hidden_size=768, output_size=EMB_SIZE).to(device).eval()
+    for batch_size in args.batch_sizes:
+        for context_length in args.context_lengths:
+            query_emb = torch.randn(batch_size, QUERY_LENGTH, 768, device=device)
+            context_emb = torch.randn(batch_size, context_length, 768, device=device)
+            yield ({"batch_size": batch_size, "context_length": context_length},
+                   lambda: bidaf(query_emb, context_emb, batch_processing=True))
+
+def fusion_block(device):
+    fb = FusionBlock(EMB_SIZE, device=device).to(device).eval()
+    for parameter in [fb.V, fb.U, fb.b, fb.W]:
+        torch.nn.init.normal_(parameter, std=0.02)
+    return fb
+
+def bench_fusion_block(args, data, device):
+    fb = fusion_block(device)
+    generator = torch.Generator().manual_seed(args.seed)
+    for context_length in args.context_lengths:
+        for n_nodes in args.node_counts:
+            graph = RandomGraph(context_length, n_nodes, generator=generator).to(device)
+            context_emb = torch.randn(context_length, EMB_SIZE, device=device)
+            query_emb = torch.randn(QUERY_LENGTH, EMB_SIZE, device=device)
+            yield ({"context_length": context_length, "nodes": n_nodes},
+                   lambda: fb(context_emb, query_emb, graph, passes=2))
+
+def bench_fusion_block_batch(args, data, device):
+    fb = fusion_block(device)
+    generator = torch.Generator().manual_seed(args.seed)
+    context_length = args.batch_context_length
+    for batch_size in args.batch_sizes:
+        for n_nodes in args.node_counts:
+            graphs = [RandomGraph(context_length, n_nodes, generator=generator).to(device) for _ in range(batch_size)]
+            bin_M, adjacency, node_mask = pad_graphs(graphs)
+            context_embs = torch.randn(batch_size, context_length, EMB_SIZE, device=device)
+            query_embs = torch.randn(batch_size, QUERY_LENGTH, EMB_SIZE, device=device)
+            yield ({"batch_size": batch_size, "context_length": context_length, "nodes": n_nodes},
+                   lambda: fb.forward_batch(context_embs, query_embs, bin_M, adjacency, node_mask, passes=2))
+
+def bench_predictor(args, data, device):
+    predictor = Predictor(max(args.context_lengths), EMB_SIZE).to(device).eval()
+    for context_length in args.context_lengths:
+        context_emb = torch.randn(context_length, EMB_SIZE, device=device)
+        yield ({"context_length": context_length},
+               lambda: predictor(context_emb))
+
+def bench_predictor_batch(args, data, device):
+    predictor = Predictor(args.batch_context_length, EMB_SIZE).to(device).eval()
+    context_length = args.batch_context_length
+    for batch_size in args.batch_sizes:
+        context_embs = torch.randn(batch_size, context_length, EMB_SIZE, device=device)
+        # contexts of different lengths, like in a real batch
+        lengths = torch.linspace(context_length // 2, context_length, batch_size).long().tolist()
+        yield ({"batch_size": batch_size, "context_length": context_length},
+               lambda: predictor.forward_batch(context_embs, lengths))
+
+def bench_predict(args, data, device):
+    for batch_size in args.batch_sizes:
+        for context_length in args.context_lengths:
+            start_scores = torch.softmax(torch.randn(batch_size, context_length, device=device), 1)
+            end_scores = torch.softmax(torch.randn(batch_size, context_length, device=device), 1)
+            sup_scores = torch.randn(batch_size, context_length, 2, device=device)
+            sentence_lengths = [21] * (context_length // 21 + 1) # as in SyntheticData.context()
+
+            def predict():
+                decode_spans(start_scores, end_scores, max_answer_length=30)
+                for b in range(batch_size):
+                    supporting_sentences(sup_scores[b], sentence_lengths)
+
+            yield ({"batch_size": batch_size, "context_length": context_length}, predict)
+
+BENCHMARKS = {"make_context": bench_make_context,
+              "entity_graph": bench_entity_graph,
+              "entity_matrix": bench_entity_matrix,
+              "bidaf": bench_bidaf,
+              "fusion_block": bench_fusion_block,
+              "fusion_block_batch": bench_fusion_block_batch,
+              "predictor": bench_predictor,
+              "predictor_batch": bench_predictor_batch,
+              "predict": bench_predict}
+
+
+def run(args, device):
+    """
+    Run all selected benchmarks.
+    :return: dict -- {case key: {"benchmark": str, "params": dict, "median_ms": float, ...}}
+    """
+    data = SyntheticData(seed=args.seed)
+    EntityGraph.tokenizer = data.tokenizer() # instead of downloading the BERT tokenizer
+    results = {}
+    with torch.no_grad():
+        for name in args.benchmarks:
+            for params, function in BENCHMARKS[name](args, data, device):
+                key = case_key(name, params)
+                results[key] = {"benchmark": name, "params": params,
+                                **measure(function, args.repeats, args.warmup, device)}
+                print(f"{key:<75}{results[key]['median_ms']:>12.3f} ms")
+    return results
+
+def compare(results, baseline, tolerance, noise_ms=0.05):
+    """
+    Compare the median times of the cases in 'results' to those in 'baseline'.
+    A case regresses if it is slower than the baseline by more than 'tolerance'
+    (relative) and by more than noise_ms (absolute, for very fast cases).
+    :param results: dict as returned by run()
+    :param baseline: dict in the same format
+    :param tolerance: e.g. 0.1 for 10%
+    :return: list[(str, float, float, float)] -- key, baseline, current median (ms) and ratio of each regression
+    """
+    regressions = []
+    print(f"\n{'case':<75}{'baseline':>12}{'current':>12}{'ratio':>8}")
+    for key, result in results.items():
+        if key not in baseline:
+            print(f"{key:<75}{'-':>12}{result['median_ms']:>12.3f}{'new':>8}")
+            continue
+        before, after = baseline[key]["median_ms"], result["median_ms"]
+        ratio = after / before if before > 0 else float('inf')
+        regressed = ratio > 1 + tolerance and after - before > noise_ms
+        print(f"{key:<75}{before:>12.3f}{after:>12.3f}{ratio:>8.2f}" + ("  REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append((key, before, after, ratio))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmarks', type=str, nargs='+', default=list(BENCHMARKS),
+                        choices=list(BENCHMARKS), help='benchmarks to run (default: all)')
+    parser.add_argument('--context_lengths', type=int, nargs='+', default=[128, 256, 512],
+                        help='context lengths in tokens (text_length for make_context)')
+    parser.add_argument('--node_counts', type=int, nargs='+', default=[10, 40, 100],
+                        help='graph sizes (max_nodes for the entity graph)')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--batch_context_length', type=int, default=256,
+                        help='context length for the batched benchmarks that sweep over batch sizes')
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=None, help='number of torch threads (default: torch\'s choice)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--gpu', action='store_true')
+    parser.add_argument('--output', type=str, default=None, help='JSON file for the results')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON file of an earlier run to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='maximum relative slowdown compared to the baseline (0.1 = 10%%)')
+    args = parser.parse_args()
+
+    device = torch.device('cuda') if args.gpu and torch.cuda.is_available() else torch.device('cpu')
+    torch.manual_seed(args.seed)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    print(f"device: {device}, threads: {torch.get_num_threads()}, repeats: {args.repeats}\n")
+    results = run(args, device)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"metadata": {"date": datetime.now().isoformat(timespec="seconds"),
+                                    "machine": platform.node(),
+                                    "processor": platform.processor(),
+                                    "python": platform.python_version(),
+                                    "torch": torch.__version__,
+                                    "device": str(device),
+                                    "threads": torch.get_num_threads(),
+                                    "repeats": args.repeats},
+                       "results": results}, f, indent=2)
+        print(f"\nResults in {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["metadata"]["threads"] != torch.get_num_threads() or baseline["metadata"]["device"] != str(device):
+            print(f"WARNING: the baseline was run with {baseline['metadata']['threads']} threads "
+                  f"on {baseline['metadata']['device']}")
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} case(s) slower than the baseline by more than {args.tolerance:.0%}:")
+            for key, before, after, ratio in regressions:
+                print(f"   {key}: {before:.3f} ms -> {after:.3f} ms ({ratio:.2f}x)")
+            sys.exit(1)
+        print(f"\nNo case is slower than the baseline by more than {args.tolerance:.0%}.")
@@ -0,0 +1,228 @@
+"""
+Synthetic HotPotQA-style data and tiny, randomly initialised models for the
+benchmarks. Nothing here downloads anything: the tokenizer is built from a
+generated vocabulary, BERT from a small BertConfig, and NER is replaced by a
+stub tagger that marks capitalized words as entities.
+"""
+
+import os, sys, inspect
+import random
+import re
+import tempfile
+import torch
+from transformers import BertTokenizer, BertConfig
+
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+
+from modules.EntityGraph import EntityGraph
+from modules.ParagraphSelector import ParagraphSelector, ParagraphSelectorNet
+
+SYLLABLES = ["ka", "to", "mi", "re", "su", "no", "la", "ve", "di", "po", "ga", "fe", "ru", "shi", "ban", "tor"]
+SPECIAL_TOKENS = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", ".", ",", "?"]
+
+
+def make_words(n_words, rng):
+    """
+    Make pronounceable pseudo-words (2-3 syllables) that are all different.
+    :param n_words: number of words
+    :param rng: random.Random object
+    :return: list[str]
+    """
+    words = set()
+    while len(words) < n_words:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))))
+    return sorted(words)
+
+
+class SyntheticData():
+    """
+    Generate HotPotQA-style points from a fixed vocabulary of common words and
+    entity names. All words are single tokens for the tokenizer returned by
+    tokenizer(), so sequence lengths are easy to control: a paragraph with
+    sentences of 'words_per_sentence' words has about as many tokens.
+    """
+
+    def __init__(self, n_words=2000, n_entities=300, entity_rate=0.15, seed=42):
+        """
+        :param n_words: number of common (lower-case) words
+        :param n_entities: number of entity names (capitalized words)
+        :param entity_rate: probability of each word in a sentence to be an entity name
+        :param seed: for the random number generator (the same seed gives the same points)
+        """
+        self.rng = random.Random(seed)
+        words = make_words(n_words + n_entities, self.rng)
+        self.rng.shuffle(words)
+        self.words = words[:n_words]
+        self.entities = [w.capitalize() for w in words[n_words:]]
+        self.entity_rate = entity_rate
+        self._tokenizer = None
+        self._directory = None
+
+    def sentence(self, n_words):
+        """
+        :param n_words: number of words (without the full stop)
+        :return: str -- a sentence; entity names are capitalized, nothing else is
+        """
+        words = [self.rng.choice(self.entities) if self.rng.random() < self.entity_rate
+                 else self.rng.choice(self.words)
+                 for _ in range(n_words)]
+        return " ".join(words) + "."
+
+    def paragraph(self, n_sentences=4, words_per_sentence=20):
+        """
+        :return: list[str, list[str]] -- [title, [sentence, ...]] like the paragraphs in HotPotQA;
+                 the title is an entity name
+        """
+        return [self.rng.choice(self.entities),
+                [self.sentence(words_per_sentence) for _ in range(n_sentences)]]
+
+    def point(self, n_paragraphs=10, n_sentences=4, words_per_sentence=20, n_supporting=2):
+        """
+        Make a point in the format of HotPotDataHandler.data_for_paragraph_selector()
+        (which is also what ParagraphSelector.make_context() takes).
+        :return: (question_id, supporting_facts, query, paragraphs, answer)
+        """
+        paragraphs = [self.paragraph(n_sentences, words_per_sentence) for _ in range(n_paragraphs)]
+        supporting = self.rng.sample(range(n_paragraphs), min(n_supporting, n_paragraphs))
+        supporting_facts = [[paragraphs[p][0], self.rng.randrange(n_sentences)] for p in supporting]
+        answer = self.rng.choice(paragraphs[supporting[0]][1]).split()[0].rstrip(".")
+        query = " ".join(self.rng.choice(self.words) for _ in range(12)) + "?"
+        return ("%024x" % self.rng.getrandbits(96), supporting_facts, query, paragraphs, answer)
+
+    def points(self, n_points, **kwargs):
+        """
+        :param kwargs: passed on to point()
+        :return: list of points
+        """
+        return [self.point(**kwargs) for _ in range(n_points)]
+
+    def context(self, n_tokens, words_per_sentence=20):
+        """
+        Make a context (list of paragraphs, as returned by make_context()) of about n_tokens tokens.
+        """
+        sentences_per_paragraph = 4
+        n_sentences = max(1, round(n_tokens / (words_per_sentence + 1))) # +1 for the full stop
+        n_paragraphs = max(1, -(-n_sentences // sentences_per_paragraph))
+        return [self.paragraph(min(sentences_per_paragraph, n_sentences - p * sentences_per_paragraph),
+                               words_per_sentence)
+                for p in range(n_paragraphs)]
+
+    def tokenizer(self):
+        """
+        A BertTokenizer whose vocabulary contains all words of the data (as one token each).
+        It is made once per object; the vocabulary file lives in a temporary directory.
+        :return: BertTokenizer
+        """
+        if self._tokenizer is None:
+            self._directory = tempfile.TemporaryDirectory()
+            vocab_file = os.path.join(self._directory.name, "vocab.txt")
+            with open(vocab_file, "w", encoding="utf-8") as f:
+                f.write("\n".join(SPECIAL_TOKENS + self.words + [e.lower() for e in self.entities]) + "\n")
+            self._tokenizer = BertTokenizer(vocab_file, do_lower_case=True)
+        return self._tokenizer
+
+
+def tiny_bert_config(vocab_size, hidden_size=64, num_layers=2, num_heads=2):
+    """
+    A small BERT configuration for randomly initialised models.
+    :return: BertConfig
+    """
+    return BertConfig(vocab_size=vocab_size,
+                      hidden_size=hidden_size,
+                      num_hidden_layers=num_layers,
+                      num_attention_heads=num_heads,
+                      intermediate_size=4 * hidden_size,
+                      max_position_embeddings=512)
+
+def tiny_paragraph_selector(data, **config_kwargs):
+    """
+    A ParagraphSelector with a randomly initialised tiny BERT and the tokenizer of 'data'.
+    :param data: a SyntheticData object
+    :param config_kwargs: passed on to tiny_bert_config()
+    :return: ParagraphSelector (in eval mode)
+    """
+    tokenizer = data.tokenizer()
+    net = ParagraphSelectorNet(tiny_bert_config(len(tokenizer.vocab), **config_kwargs))
+    net.eval()
+    return ParagraphSelector(None, tokenizer=tokenizer, net=net)
+
+
+class StubTagger():
+    """
+    Replaces the NER tagger: every capitalized word is an entity.
+    """
+    pattern = re.compile(r"[A-Z]\w*")
+
+    def entities(self, sentence):
+        """
+        :param sentence: str
+        :return: list[(int, int, str)] -- character start, end and text of each entity
+        """
+        return [(m.start(), m.end(), m.group()) for m in self.pattern.finditer(sentence)]
+
+
+class StubTaggedGraph(EntityGraph):
+    """
+    An EntityGraph whose nodes are found by a StubTagger instead of flair or
+    StanfordCoreNLP; everything after NER (links, pruning, M, edge lists,
+    adjacency matrices) is the same as for EntityGraph.
+    Set EntityGraph.tokenizer (e.g., to SyntheticData.tokenizer()) before
+    making graphs, so that the BERT tokenizer isn't downloaded.
+    """
+
+    def _find_nodes(self, tag_with):
+        """
+        :param tag_with: a StubTagger
+        """
+        ent_id = 0
+        for para_id, paragraph in enumerate(self.context):
+            for sent_id, sentence in enumerate([paragraph[0]] + paragraph[1]): # first sentence is the paragraph title
+                for start, end, text in tag_with.entities(sentence):
+                    self.graph[ent_id] = {"address": (para_id, sent_id, start, end),
+                                          "links": [],
+                                          "mention": text}
+                    ent_id += 1
+
+
+class RandomGraph():
+    """
+    The tensors of an entity graph with a given number of nodes (like those of an
+    EntityGraph, which is all that the FusionBlock uses): each node is mentioned
+    once or twice in the context (1-3 tokens per mention) and links to about
+    'degree' other nodes.
+    """
+
+    def __init__(self, n_tokens, n_nodes, degree=4, sparse=False, generator=None):
+        """
+        :param n_tokens: number of context tokens (rows of M)
+        :param n_nodes: number of nodes (columns of M)
+        :param degree: average number of links per node
+        :param sparse: if True, only the edge list is kept (A is None)
+        :param generator: torch.Generator for reproducible graphs
+        """
+        self.M = torch.zeros((n_tokens, n_nodes))
+        for node in range(n_nodes):
+            for _ in range(int(torch.randint(1, 3, (1,), generator=generator))):
+                start = int(torch.randint(n_tokens, (1,), generator=generator))
+                length = int(torch.randint(1, 4, (1,), generator=generator))
+                self.M[start:start + length, node] = 1
+
+        n_links = n_nodes * degree // 2
+        source = torch.randint(n_nodes, (n_links,), generator=generator)
+        target = torch.randint(n_nodes, (n_links,), generator=generator)
+        keep = source != target
+        pairs = torch.stack((source[keep], target[keep]))
+        self.edges = torch.unique(torch.cat((pairs, pairs.flip(0)), dim=1), dim=1) # both directions, no duplicates
+        if sparse:
+            self.A = None
+        else:
+            self.A = torch.zeros((n_nodes, n_nodes))
+            self.A[self.edges[0], self.edges[1]] = 1
+
+    def to(self, device):
+        self.M = self.M.to(device)
+        self.edges = self.edges.to(device)
+        self.A = self.A.to(device) if self.A is not None else None
+        return self
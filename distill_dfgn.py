@@ -0,0 +1,446 @@
+"""
+This script distills a trained DFGN (the teacher) into a DFGN with a smaller
+BERT encoder (the student) and reports answer/supporting fact F1 against
+CPU latency of both models.
+"""
+
+import os, sys, argparse
+import copy
+import pickle
+from time import time
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+from sklearn.model_selection import train_test_split
+from transformers import BertTokenizer, BertModel
+
+import flair  # for NER in the EntityGraph
+from modules import ParagraphSelector
+from train_dfgn import DFGN, prepare_batch, compute_losses, evaluate, EvaluationData
+import utils
+
+
+def make_student_encoder(teacher_encoder_model, num_layers=4, hidden_size=None):
+    """
+    Make a smaller BERT model from the teacher's BERT model.
+    If the student keeps the teacher's hidden size, its embeddings and layers
+    are initialized with the teacher's embeddings and evenly spaced layers
+    (e.g., layers 3, 6, 9 and 12 for a 4-layer student of a 12-layer teacher).
+    Otherwise, the student is initialized randomly and the Encoder adds a
+    projection to the hidden size that BiDAF expects.
+
+    :param teacher_encoder_model: a BertModel (usually the teacher's Encoder.encoder_model)
+    :param num_layers: number of transformer layers of the student
+    :param hidden_size: hidden size of the student; defaults to the teacher's
+    :return: a BertModel
+    """
+    config = copy.deepcopy(teacher_encoder_model.config)
+    teacher_layers = config.num_hidden_layers
+    config.num_hidden_layers = num_layers
+
+    if hidden_size and hidden_size != config.hidden_size:
+        config.hidden_size = hidden_size
+        config.num_attention_heads = max(1, hidden_size // 64)
+        config.intermediate_size = 4 * hidden_size
+        return BertModel(config)
+
+    student = BertModel(config)
+    student.embeddings.load_state_dict(teacher_encoder_model.embeddings.state_dict())
+    for i, layer in enumerate(student.encoder.layer):
+        teacher_layer = round((i + 1) * teacher_layers / num_layers) - 1
+        layer.load_state_dict(teacher_encoder_model.encoder.layer[teacher_layer].state_dict())
+    student.pooler.load_state_dict(teacher_encoder_model.pooler.state_dict())
+    return student
+
+def make_student(teacher, text_length, emb_size, num_layers=4, hidden_size=None,
+                 device=torch.device('cpu'), fb_dropout=0.5, predictor_dropout=0.3):
+    """
+    Make a student DFGN with a smaller encoder. FusionBlock, Predictor and
+    BiDAF start out with the teacher's parameters.
+
+    :param teacher: a trained DFGN
+    :param text_length: max text length for the context
+    :param emb_size: hidden size of the context embedding (d2 in the paper)
+    :param num_layers: number of transformer layers of the student's BERT
+    :param hidden_size: hidden size of the student's BERT; defaults to the teacher's
+    :return: a DFGN
+    """
+    student_bert = make_student_encoder(teacher.encoder.encoder_model,
+                                        num_layers=num_layers,
+                                        hidden_size=hidden_size)
+    student = DFGN(text_length=text_length,
+                   emb_size=emb_size,
+                   device=device,
+                   fb_dropout=fb_dropout,
+                   predictor_dropout=predictor_dropout,
+                   encoder_model=student_bert)
+
+    # everything but the BERT model has the same shape in teacher and student
+    teacher_state = {k: v for k, v in teacher.state_dict().items()
+                     if not k.startswith("encoder.encoder_model.")}
+    student.load_state_dict(teacher_state, strict=False)
+    return student
+
+def record_hidden_states(encoder, store):
+    """
+    Append the (projected) last hidden state of an Encoder's BERT model to
+    'store' every time the Encoder runs BERT.
+    :param encoder: an Encoder object
+    :param store: list to which the hidden states are appended
+    :return: a hook handle (call its remove() method to stop recording)
+    """
+    module = encoder.projection if hasattr(encoder, 'projection') else encoder.encoder_model
+
+    def hook(module, inputs, output):
+        store.append(output if torch.is_tensor(output) else output[0])
+
+    return module.register_forward_hook(hook)
+
+def soft_cross_entropy(student_logits, teacher_logits, temperature=1.0):
+    """
+    KL divergence between the teacher's and the student's distributions,
+    both softened with a temperature (Hinton et al., 2015).
+    :param student_logits: Tensor (..., classes)
+    :param teacher_logits: Tensor (..., classes)
+    :param temperature: float
+    :return: Tensor (scalar)
+    """
+    student_logits = student_logits.reshape(-1, student_logits.shape[-1])
+    teacher_logits = teacher_logits.reshape(-1, teacher_logits.shape[-1])
+    return F.kl_div(F.log_softmax(student_logits / temperature, dim=-1),
+                    F.softmax(teacher_logits / temperature, dim=-1),
+                    reduction='batchmean') * temperature ** 2
+
+def distillation_loss(student_outputs, teacher_outputs, temperature=1.0):
+    """
+    Match the student's predictor outputs to the teacher's.
+    Supporting fact and type scores are logits; start and end scores are
+    probabilities, so their logarithm is used as logits.
+
+    :param student_outputs: list of outputs as produced by the Predictor's forward function
+    :param teacher_outputs: list of outputs as produced by the Predictor's forward function
+    :param temperature: float
+    :return: Tensor (scalar) -- averaged over the data points
+    """
+    loss = 0
+    for (s_sup, s_start, s_end, s_type), (t_sup, t_start, t_end, t_type) in zip(student_outputs, teacher_outputs):
+        loss += soft_cross_entropy(s_sup, t_sup, temperature)
+        loss += soft_cross_entropy(s_start.clamp(min=1e-12).log(), t_start.clamp(min=1e-12).log(), temperature)
+        loss += soft_cross_entropy(s_end.clamp(min=1e-12).log(), t_end.clamp(min=1e-12).log(), temperature)
+        loss += soft_cross_entropy(s_type, t_type, temperature)
+    return loss / len(student_outputs)
+
+def distill(teacher, student, train_data, para_selector,
+            ps_threshold=0.1, ner_device=torch.device('cpu'), training_device=torch.device('cpu'),
+            text_length=250, fb_passes=1, coefs=(0.5, 0.5),
+            epochs=1, learning_rate=1e-4,
+            temperature=2.0, alpha=0.5, hidden_loss_weight=1.0,
+            pack_sequences=False):
+    """
+    Train the student on the teacher's outputs (and the gold labels).
+    The loss is alpha * formula 15 + (1 - alpha) * distillation loss
+    + hidden_loss_weight * MSE between the encoders' last hidden states.
+
+    :param teacher: a trained DFGN
+    :param student: a DFGN as returned by make_student()
+    :param train_data: training data (raw points), split into batches
+    :param para_selector: a ParagraphSelector object
+    :param ps_threshold: threshold for the paragraph selector
+    :param ner_device: torch device object on which to do the NER tagging
+    :param training_device: torch device object on which to do the training
+    :param text_length: limit the context's number of tokens
+    :param fb_passes: number of passes through the fusion block
+    :param coefs: (float,float) coefficients for formula 15
+    :param epochs: number of epochs (int)
+    :param learning_rate: learning rate (float)
+    :param temperature: temperature for softening the predictor outputs
+    :param alpha: weight of the gold-label loss
+    :param hidden_loss_weight: weight of the hidden state loss
+    :param pack_sequences: if True, pack BERT inputs into 512-token windows
+    :return: list[(real_batch_size, overall_loss, task_loss, distillation_loss, hidden_loss)]
+    """
+    tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+
+    flair.device = torch.device(ner_device)
+    ner_tagger = flair.models.SequenceTagger.load('ner') # this hard-codes flair tagging!
+
+    optimizer = torch.optim.Adam(student.parameters(), lr=learning_rate)
+
+    teacher.eval()
+    teacher = teacher.to(training_device)
+    student.train()
+    student = student.to(training_device)
+
+    teacher_hidden, student_hidden = [], []
+    handles = [record_hidden_states(teacher.encoder, teacher_hidden),
+               record_hidden_states(student.encoder, student_hidden)]
+
+    losses = []
+    print("Distilling...")
+    for epoch in range(epochs):
+        print('Epoch %d/%d' % (epoch + 1, epochs))
+
+        for batch in tqdm(train_data, desc="Iteration"):
+            ids, q_ids_list, c_ids_list, graphs, labels, _ = prepare_batch(batch,
+                                                                           para_selector,
+                                                                           ner_tagger,
+                                                                           student.encoder,
+                                                                           tokenizer,
+                                                                           ps_threshold=ps_threshold,
+                                                                           text_length=text_length,
+                                                                           pack_sequences=pack_sequences)
+            if not ids:
+                continue
+
+            q_ids_list = [t.to(training_device) for t in q_ids_list]
+            c_ids_list = [t.to(training_device) for t in c_ids_list]
+            for g in graphs:
+                g.to(training_device) # moves M and A
+            labels = [l.to(training_device) for l in labels]
+
+            teacher_hidden.clear()
+            student_hidden.clear()
+
+            with torch.no_grad():
+                teacher_outputs = teacher.forward_batch(q_ids_list, c_ids_list, graphs,
+                                                        fb_passes=fb_passes, packed=pack_sequences)
+
+            optimizer.zero_grad()
+            student_outputs = student.forward_batch(q_ids_list, c_ids_list, graphs,
+                                                    fb_passes=fb_passes, packed=pack_sequences)
+
+            task_loss = compute_losses(student_outputs, labels, coefs=coefs)[0]
+            kd_loss = distillation_loss(student_outputs, teacher_outputs, temperature=temperature)
+            hidden_loss = sum([F.mse_loss(s, t) for s, t in zip(student_hidden, teacher_hidden)]) / len(teacher_hidden)
+
+            loss = alpha * task_loss + (1 - alpha) * kd_loss + hidden_loss_weight * hidden_loss
+            loss.backward()
+            optimizer.step()
+
+            losses.append((len(ids), loss.item(), task_loss.item(), kd_loss.item(), hidden_loss.item()))
+
+    for handle in handles:
+        handle.remove()
+
+    return losses
+
+def measure_latency(net, raw_points, para_selector, ner_tagger, tokenizer,
+                    ps_threshold=0.1, text_length=250, fb_passes=1, pack_sequences=False):
+    """
+    Measure the time that a DFGN network takes per question on the CPU
+    (Encoder, FusionBlock and Predictor; without paragraph selection and NER).
+
+    :param net: a DFGN network
+    :param raw_points: list of raw points
+    :return: list[float] -- seconds per question
+    """
+    device = torch.device('cpu')
+    net.eval()
+    net = net.to(device)
+
+    ids, q_ids_list, c_ids_list, graphs, _, _ = prepare_batch(raw_points,
+                                                              para_selector,
+                                                              ner_tagger,
+                                                              net.encoder,
+                                                              tokenizer,
+                                                              ps_threshold=ps_threshold,
+                                                              text_length=text_length,
+                                                              pack_sequences=pack_sequences)
+    for g in graphs:
+        g.to(device) # moves M and A
+
+    times = []
+    with torch.no_grad():
+        for query, context, graph in zip(q_ids_list, c_ids_list, graphs):
+            t0 = time()
+            net.forward_batch([query], [context], [graph], fb_passes=fb_passes, packed=pack_sequences)
+            times.append(time() - t0)
+    return times
+
+def write_report(filename, rows):
+    """
+    Write a table of scores and latencies.
+    :param filename: path to the report file
+    :param rows: list[dict] -- one row per model (keys: see 'columns' below)
+    """
+    columns = ["model", "layers", "hidden_size", "parameters",
+               "f1", "sp_f1", "joint_f1", "latency_ms", "latency_p95_ms", "speedup"]
+    with open(filename, "w") as f:
+        f.write("\t".join(columns) + "\n")
+        for row in rows:
+            f.write("\t".join([str(row[c]) for c in columns]) + "\n")
+
+
+if __name__ == '__main__':
+
+    #=========== PARAMETER INPUT
+    take_time = utils.Timer()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_file', metavar='config', type=str,
+                        help='configuration file for distillation')
+    parser.add_argument('model_name', metavar='model', type=str,
+                        help="name of the student model's file")
+    args = parser.parse_args()
+
+    cfg = utils.ConfigReader(args.config_file)
+
+    model_abs_path = cfg('model_abs_dir') + args.model_name + "/"
+    model_filepath = model_abs_path + args.model_name
+    losses_abs_path = model_abs_path + "losses" # contains (batch_size, overall_loss, task_l., distillation_l., hidden_l.)
+    report_abs_path = model_abs_path + "distill_report"
+    traintime_abs_path = model_abs_path + "times"
+
+    eval_data_dump_dir = cfg("eval_data_dump_dir")
+    eval_data_dump_filepath =  eval_data_dump_dir + "gold"
+    eval_preds_dump_filepath = eval_data_dump_dir + "predictions"
+
+    for path in [cfg("data_abs_path"), cfg("teacher_model_abs_path")]:
+        try:
+            f = open(path, "r")
+            f.close()
+        except FileNotFoundError as e:
+            print(e)
+            sys.exit()
+    for path in [model_abs_path, eval_data_dump_dir]:
+        if not os.path.exists(path):
+            print(f"newly creating {path}")
+            os.makedirs(path)
+
+    take_time("parameter input")
+
+
+    #========== DATA PREPARATION
+    try:
+        with open(cfg("pickled_train_data"), "rb") as f:
+            train_data_raw = pickle.load(f)
+        with open(cfg("pickled_dev_data"), "rb") as f:
+            dev_data_raw = pickle.load(f)
+        dh = utils.HotPotDataHandler(cfg("data_abs_path")) # required for make_eval_data()
+
+    except:
+        print(f"Reading data from {cfg('data_abs_path')}...")
+        dh = utils.HotPotDataHandler(cfg("data_abs_path"), limit=cfg("training_dataset_size"))
+        raw_data = dh.data_for_paragraph_selector() # get raw points (the rest of the file is not read)
+
+        print("Splitting data...")
+        train_data_raw, dev_data_raw = train_test_split(raw_data,
+                                                        test_size=cfg('percent_for_eval_during_training'),
+                                                        random_state=cfg('shuffle_seed'),
+                                                        shuffle=True)
+
+    # group training data into batches
+    bs = cfg("batch_size")
+    train_data_raw = [train_data_raw[i : i+bs] for i in range(0, len(train_data_raw), bs)]
+
+    take_time("data preparation")
+
+
+    training_device = torch.device('cpu')
+    if cfg("try_training_on_gpu") and torch.cuda.is_available():
+        torch.cuda.set_device(cfg("gpu_number"))
+        training_device = torch.device('cuda')
+    tagger_device = torch.device('cuda') if cfg("use_gpu_for_ner") else torch.device('cpu')
+
+
+    #========== MODELS
+    para_selector = ParagraphSelector.ParagraphSelector(cfg("ps_model_abs_path"))
+
+    dh.make_eval_data(para_selector,
+                      dev_data_raw,
+                      eval_data_dump_filepath,
+                      cfg)
+
+    teacher = torch.load(cfg("teacher_model_abs_path"))
+    student = make_student(teacher,
+                           text_length=cfg("text_length"),
+                           emb_size=cfg("emb_size"),
+                           num_layers=cfg("student_layers"),
+                           hidden_size=cfg("student_hidden_size"),
+                           device=training_device,
+                           fb_dropout=cfg("fb_dropout"),
+                           predictor_dropout=cfg("predictor_dropout"))
+    take_time("model preparation")
+
+
+    #========== DISTILLATION
+    losses = distill(teacher, student, train_data_raw, para_selector,
+                     ps_threshold=cfg("ps_threshold"),
+                     ner_device=tagger_device,
+                     training_device=training_device,
+                     text_length=cfg("text_length"),
+                     fb_passes=cfg("fb_passes"),
+                     coefs=(cfg("lambda_s"), cfg("lambda_t")),
+                     epochs=cfg("epochs"),
+                     learning_rate=cfg("learning_rate"),
+                     temperature=cfg("distill_temperature"),
+                     alpha=cfg("distill_alpha"),
+                     hidden_loss_weight=cfg("hidden_loss_weight"),
+                     pack_sequences=cfg("pack_sequences"))
+    take_time("distillation")
+
+    print(f"saving model to {model_filepath}...")
+    torch.save(student, model_filepath)
+
+
+    #========== REPORT: SCORES AND LATENCY
+    tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+    ner_tagger = flair.models.SequenceTagger.load('ner')
+
+    # featurized once for both models (they use the same tokenizer)
+    eval_data = EvaluationData(utils.HotPotDataHandler(eval_data_dump_filepath).data_for_paragraph_selector(),
+                               tokenizer, ner_tagger, teacher.encoder,
+                               device=training_device,
+                               text_length=cfg("text_length"))
+
+    rows = []
+    for name, net in [("teacher", teacher), ("student", student)]:
+        net.eval()
+        with torch.no_grad():
+            metrics = evaluate(net.to(training_device),
+                               tokenizer, ner_tagger,
+                               training_device, eval_data_dump_filepath, eval_preds_dump_filepath,
+                               fb_passes=cfg("fb_passes"),
+                               text_length=cfg("text_length"),
+                               pack_sequences=cfg("pack_sequences"),
+                               eval_data=eval_data)
+        times = sorted(measure_latency(net, dev_data_raw[:cfg("latency_sample_size")],
+                                       para_selector, ner_tagger, tokenizer,
+                                       ps_threshold=cfg("ps_threshold"),
+                                       text_length=cfg("text_length"),
+                                       fb_passes=cfg("fb_passes"),
+                                       pack_sequences=cfg("pack_sequences")))
+        bert_config = net.encoder.encoder_model.config
+        rows.append({"model": name,
+                     "layers": bert_config.num_hidden_layers,
+                     "hidden_size": bert_config.hidden_size,
+                     "parameters": sum([p.numel() for p in net.parameters()]),
+                     "f1": round(metrics["f1"], 4),
+                     "sp_f1": round(metrics["sp_f1"], 4),
+                     "joint_f1": round(metrics["joint_f1"], 4),
+                     "latency_ms": round(1000 * sum(times) / len(times), 2),
+                     "latency_p95_ms": round(1000 * times[int(0.95 * (len(times) - 1))], 2)})
+        take_time(f"report_{name}")
+
+    for row in rows:
+        row["speedup"] = round(rows[0]["latency_ms"] / row["latency_ms"], 2)
+
+    print(f"Saving report in {report_abs_path}...")
+    write_report(report_abs_path, rows)
+
+    #========== LOGGING
+    print(f"Saving losses in {losses_abs_path}...")
+    with open(losses_abs_path, "w") as f:
+        f.write("batch_size\toverall_loss\ttask_loss\tdistillation_loss\thidden_loss\n")
+        f.write("\n".join(["\t".join([str(l) for l in step]) for step in losses]))
+
+    print(f"Saving config and times taken to {traintime_abs_path}...")
+    with open(traintime_abs_path, 'w', encoding='utf-8') as f:
+        f.write("Configuration in: " + args.config_file + "\n")
+        f.write(str(cfg)+"\n")
+        take_time("saving results")
+        take_time.total()
+        f.write("\n Overall times taken:\n" + str(take_time) + "\n")
+
+    print("\nTimes taken:\n", take_time)
+    print("done.")
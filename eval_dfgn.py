@@ -2,25 +2,26 @@
 
 import os, sys, argparse
 import json
+import itertools
 import torch
 from tqdm import tqdm
 
 import flair # for NER in the EntityGraph
 from transformers import BertTokenizer
-import hotpot_evaluate_v1 as official_eval_script
 
 import utils
-from utils import Timer
+import featurize
+from utils import Profiler
 from utils import HotPotDataHandler
 from utils import ConfigReader
-from modules import ParagraphSelector, EntityGraph
-from train_dfgn import predict, DFGN
+from modules import ParagraphSelector, EntityGraph, FastPath
+from train_dfgn import predict, predict_batch, DFGN
 
 
 def prepare_prediction(raw_data_points,
                        para_selector, ps_threshold, text_length,
                        ner_tagger,
-                       timer):
+                       timer, pack_sequences=False, max_nodes=40, sparse_graphs=False):
     """
     Starting from a raw point (or a list of raw points), prepare all
     the data structures required by the DFGN module in order to predict
@@ -31,7 +32,10 @@ def prepare_prediction(raw_data_points,
     :param ps_threshold: threshold for the paragraph selector (relevance score between paragraph and query)
     :param text_length: max text length for the context
     :param ner_tagger: NER tagger
-    :param timer: a timer object (see utils)
+    :param timer: a utils.Profiler (stages: selection, ner, graph, alignment; counters: nodes, edges, dropped points)
+    :param pack_sequences: if True, the paragraph selector scores paragraphs in packed sequences
+    :param max_nodes: maximum number of nodes per entity graph
+    :param sparse_graphs: if True, entity graphs only have edge lists (see FusionBlock.graph_attention_sparse())
     :return: required data if possible, or None if data not usable by the network's components
     """
 
@@ -49,14 +53,18 @@ def prepare_prediction(raw_data_points,
 
         """ DATA PROCESSING """
         # make a list[ list[str, list[str]] ] for each point in the batch
-        context = para_selector.make_context(point,
-                                             threshold=ps_threshold,
-                                             context_length=text_length)
-        timer.again("ParagraphSelector_prediction")
+        with timer.span("selection"):
+            context = para_selector.make_context(point,
+                                                 threshold=ps_threshold,
+                                                 context_length=text_length,
+                                                 device=next(para_selector.net.parameters()).device,
+                                                 packed=pack_sequences)
         graph = EntityGraph.EntityGraph(context,
                                         context_length=text_length,
-                                        tagger=ner_tagger)
-        timer.again("EntityGraph_construction")
+                                        tagger=ner_tagger,
+                                        max_nodes=max_nodes,
+                                        sparse=sparse_graphs,
+                                        profiler=timer) # ner, graph, alignment
 
         if graph.graph:
             ids.append(point[0])
@@ -70,8 +78,11 @@ def prepare_prediction(raw_data_points,
                                          len(graph.relation_triplets()),
                                          1])]
             point_usage_log[0] += 1
+            timer.count("nodes", len(graph.graph))
+            timer.count("edges", graph.edges.shape[1])
         else:  # if the NER in EntityGraph doesn't find entities, the datapoint is useless.
             point_usage_log[1] += 1
+            timer.count("dropped_points")
 
     # update the batch to exclude useless data points
     if not ids:
@@ -90,20 +101,20 @@ def encode_to_device(queries, contexts, graphs, encoder, device, timer):
     :param graphs: list[EntityGraph]
     :param encoder: Encoder object
     :param device: torch.device object ('cuda' or 'cpu')
-    :param timer: utils.Timer object
+    :param timer: utils.Profiler object
     :return: lists of query/context token id tensors, graphs, timer (all tensor parts moved to the device)
     """
 
     # turn the texts into tensors in order to put them on the GPU
-    qc_ids = [encoder.token_ids(q, c) for q, c in zip(queries, contexts)]  # list[ (list[int], list[int]) ]
-    q_ids, c_ids = list(zip(*qc_ids))  # tuple(list[int]), tuple(list[int])
-    q_ids_list = [torch.tensor(q).to(device) for q in q_ids]  # list[Tensor]
-    c_ids_list = [torch.tensor(c).to(device) for c in c_ids]  # list[Tensor]
+    with timer.span("tokenization"):
+        qc_ids = [encoder.token_ids(q, c) for q, c in zip(queries, contexts)]  # list[ (list[int], list[int]) ]
+        q_ids, c_ids = list(zip(*qc_ids))  # tuple(list[int]), tuple(list[int])
+        q_ids_list = [torch.tensor(q).to(device) for q in q_ids]  # list[Tensor]
+        c_ids_list = [torch.tensor(c).to(device) for c in c_ids]  # list[Tensor]
 
-    for i, g in enumerate(graphs):
-        graphs[i].M = g.M.to(device)  # work with enumerate to actually mutate the graph objects
-
-    timer.again("encode_to_device")
+        for g in graphs:
+            g.to(device) # moves M and A
+    timer.count("tokens", sum([len(q) + len(c) for q, c in qc_ids]))
 
     return q_ids_list, c_ids_list, graphs, timer
 
@@ -136,25 +147,25 @@ def output_scores(metrics, mode='print', filehandle=None):
         print("exact match:", metrics["joint_em"])
         print('=========================\n')
     elif mode == 'write' and filehandle:
-        f.write("\n=========================")
-        f.write("\nANSWER SCORES")
-        f.write("\nPrecision:  " + str(metrics["prec"]))
-        f.write("\nRecall:     " + str(metrics["recall"]))
-        f.write("\nF score:    " + str(metrics["f1"]))
-        f.write("\nexact match:" + str(metrics["em"]))
-        f.write('\n-------------------------\n')
-        f.write("\nSUPPORTING FACT SCORES")
-        f.write("\nPrecision:  " + str(metrics["sp_prec"]))
-        f.write("\nRecall:     " + str(metrics["sp_recall"]))
-        f.write("\nF score:    " + str(metrics["sp_f1"]))
-        f.write("\nexact match:" + str(metrics["sp_em"]))
-        f.write('\n-------------------------\n')
-        f.write("\nSUPPORTING FACT SCORES")
-        f.write("\nPrecision:  " + str(metrics["joint_prec"]))
-        f.write("\nRecall:     " + str(metrics["joint_recall"]))
-        f.write("\nF score:    " + str(metrics["joint_f1"]))
-        f.write("\nexact match:" + str(metrics["joint_em"]))
-        f.write('\n=========================\n')
+        filehandle.write("\n=========================")
+        filehandle.write("\nANSWER SCORES")
+        filehandle.write("\nPrecision:  " + str(metrics["prec"]))
+        filehandle.write("\nRecall:     " + str(metrics["recall"]))
+        filehandle.write("\nF score:    " + str(metrics["f1"]))
+        filehandle.write("\nexact match:" + str(metrics["em"]))
+        filehandle.write('\n-------------------------\n')
+        filehandle.write("\nSUPPORTING FACT SCORES")
+        filehandle.write("\nPrecision:  " + str(metrics["sp_prec"]))
+        filehandle.write("\nRecall:     " + str(metrics["sp_recall"]))
+        filehandle.write("\nF score:    " + str(metrics["sp_f1"]))
+        filehandle.write("\nexact match:" + str(metrics["sp_em"]))
+        filehandle.write('\n-------------------------\n')
+        filehandle.write("\nSUPPORTING FACT SCORES")
+        filehandle.write("\nPrecision:  " + str(metrics["joint_prec"]))
+        filehandle.write("\nRecall:     " + str(metrics["joint_recall"]))
+        filehandle.write("\nF score:    " + str(metrics["joint_f1"]))
+        filehandle.write("\nexact match:" + str(metrics["joint_em"]))
+        filehandle.write('\n=========================\n')
     else:
         print("WARNING: could neither print, nor write the scores!",
               "Check your file paths!")
@@ -198,7 +209,7 @@ def write_results(filename, metrics, timer, graph_stats, point_stats):
         return timer
 
 # =========== PARAMETER INPUT
-take_time = Timer()
+take_time = Profiler()
 
 parser = argparse.ArgumentParser()
 parser.add_argument('config_file', metavar='config', type=str,
@@ -211,6 +222,8 @@ cfg = ConfigReader(args.config_file)
 model_abs_dir = cfg('model_abs_dir') + args.dfgn_model_name + "/" # there is a .bin in this directory; that's the model
 results_abs_path = model_abs_dir + args.dfgn_model_name + ".test_scores"
 predictions_abs_path = cfg('predictions_abs_dir') + args.dfgn_model_name + ".predicitons"
+fb_passes_abs_path = model_abs_dir + args.dfgn_model_name + ".fb_passes" # number of fusion block passes per question
+profile_abs_path = model_abs_dir + args.dfgn_model_name + ".profile" # stage statistics (.json) and trace (.trace.json)
 
 # check all relevant file paths and directories before starting training
 try:
@@ -230,8 +243,6 @@ if not os.path.exists(cfg('predictions_abs_dir')):
     os.makedirs(cfg('predictions_abs_dir'))
 else:
     print(f"overwriting {predictions_abs_path} with new predictions!")
-    with open(predictions_abs_path, 'w') as f:  #
-        f.write("")
 
 # handle GPU usage (all parts on the same device)
 device = torch.device('cpu')
@@ -243,10 +254,31 @@ take_time("parameter input")
 
 
 # =========== DATA LOADING
-print(f"Reading data from {cfg('test_data_abs_path')}...")  # the whole HotPotQA training set
-dh = HotPotDataHandler(cfg("test_data_abs_path")) # the whole HotPotQA dev set
-raw_data = dh.data_for_paragraph_selector() # get raw points
-data_limit = cfg("testset_size") if cfg("testset_size") else len(raw_data)
+feature_store = None
+if cfg("feature_store"): # preprocessed with featurize.py; no paragraph selection and NER needed
+    print(f"Reading featurized data from {cfg('feature_store')}...")
+    feature_store = featurize.FeatureStore(cfg("feature_store"))
+    data_limit = min(cfg("testset_size"), len(feature_store)) if cfg("testset_size") else len(feature_store)
+    # the store has no gold answers; only these (not the contexts) are kept from the raw data, for the
+    # store's first data_limit points and for the points that were left out (no entities; scored as "noanswer")
+    store_ids = set(feature_store.ids[:data_limit])
+    useless_ids = set(feature_store.useless_ids) if feature_store.useless_ids is not None else None
+    all_ids = set(feature_store.ids) if useless_ids is None else None # older stores: left out = not in the store
+    gold = {} # {question_id: (answer, supporting facts)}
+    left_out = [] # [(question_id, answer, supporting facts)]
+    for point in HotPotDataHandler(cfg("test_data_abs_path")).points(): # read one point at a time
+        if point[0] in store_ids:
+            gold[point[0]] = (point[4], point[1])
+        elif (point[0] in useless_ids) if useless_ids is not None else (point[0] not in all_ids):
+            left_out.append((point[0], point[4], point[1]))
+        # older stores (useless_ids is None) are read to the end, so that no left-out points are missed
+        if len(gold) == len(store_ids) and useless_ids is not None and \
+                (data_limit < len(feature_store) or len(left_out) == len(useless_ids)):
+            break # points after this weren't featurized, or are beyond testset_size
+else:
+    print(f"Reading data from {cfg('test_data_abs_path')}...")
+    dh = HotPotDataHandler(cfg("test_data_abs_path"), limit=cfg("testset_size")) # the HotPotQA dev set, up to testset_size points
+    raw_data = dh.points() # a generator of raw points; they are read in slices of prediction_batch_size
 take_time("data loading")
 
 
@@ -257,68 +289,129 @@ tokenizer = BertTokenizer.from_pretrained('bert-base-uncased') # needed?
 flair.device = device
 ner_tagger = flair.models.SequenceTagger.load('ner')  # this hard-codes flair tagging!
 
-para_selector = ParagraphSelector.ParagraphSelector(cfg("ps_model_abs_dir")) # looks for the 'pytorch_model.bin' in this directory
-para_selector.net.eval() # ParagraphSelector itself does not inherit from nn.Module.
-para_selector.net = para_selector.net.to(device)
-
 dfgn = torch.load(model_abs_dir+args.dfgn_model_name)
 dfgn.eval()
 dfgn = dfgn.to(device)
+
+if hasattr(dfgn, "selector"): # the DFGN was trained with a shared BERT; it contains the selector
+    para_selector = ParagraphSelector.ParagraphSelector(None, net=dfgn.selector)
+else:
+    para_selector = ParagraphSelector.ParagraphSelector(cfg("ps_model_abs_dir")) # looks for the 'pytorch_model.bin' in this directory
+    para_selector.net.eval() # ParagraphSelector itself does not inherit from nn.Module.
+    para_selector.net = para_selector.net.to(device)
 take_time("model loading")
 
+# optional compiled inference for fusion block and predictor ('compile' or 'script'; False = eager)
+fast_path = None
+if cfg("compiled_inference"):
+    fast_path = FastPath.FastPath(dfgn, passes=cfg("fb_passes"), mode=cfg("compiled_inference"),
+                                  batch_buckets=cfg("batch_buckets"),
+                                  node_buckets=cfg("node_buckets"),
+                                  context_buckets=cfg("context_buckets"),
+                                  query_buckets=cfg("query_buckets"))
+    fast_path.warmup(dfgn.predictor.f0.hidden_size, device=device) # compile everything before timing predictions
+    take_time("compilation")
+
 
 # =========== PREDICTIONS
+# points are processed in chunks of prediction_batch_size; predictions are written
+# and scored on the fly, so that memory doesn't depend on the number of points
 counter = 0 # counts up with each question ( = each data point)
-graph_stats = []
-point_usage_stats = []
-
-batch_size = data_limit if not cfg("prediction_batch_size") else cfg("prediction_batch_size")
-for pos in range(0, data_limit, batch_size):
-
-    answers = [] # predicted answers
-    sp = []      # predicted supporting facts
-
-    # prepare data: select paragraphs, make graphs, ...
-    # shape of sent_lengths: list[ list[list[int]] ] sentences' lengths per paragraph; for multiple data points
-    ids, queries, contexts, graphs, sent_lengths, \
-    take_time, graph_log, point_usage_log = prepare_prediction(raw_data[pos : pos+data_limit],
-                                                               para_selector,
-                                                               cfg("ps_threshold"),
-                                                               cfg("text_length"),
-                                                               ner_tagger,
-                                                               take_time)
-    # encode strings to IDs and put the tensors on the device
-    queries, contexts, graphs, take_time = encode_to_device(queries,
-                                                            contexts,
-                                                            graphs,
-                                                            dfgn.encoder,
-                                                            device,
-                                                            take_time)
-
-    for id, query, context, graph, s_lens in tqdm(zip(ids, queries, contexts, graphs, sent_lengths),desc="predictions"):
-        counter += 1 # just for keeping track.
-        if cfg("verbose_evaluation"): print(f"({counter}) {id}\n   {query}")
-
-        answer, sup_fact_pairs = predict(dfgn, query, context, graph,
-                                         tokenizer, s_lens, fb_passes=cfg("fb_passes"))
-        take_time.again("prediction")
-
-        answers[id] = answer  # {question_id: str}
-        sp[id] = sup_fact_pairs  # {question_id: list[list[paragraph_title, sent_num]]}
-        if cfg("verbose_evaluation"): print(f"   {answer}\n")
-
-    with open(predictions_abs_path, 'a') as f:
-        json.dump({"answer": answers, "sp": sp}, f)
-    take_time.again("dump_predictions")
+n_fb_passes = [0, 0] # [number of questions, fusion block passes]
+graph_stats = [0,0,0] # [total nodes, total connections, number of graphs]
+point_usage_stats = [0,0] # [used points, unused points]
+sink = utils.StreamingEvaluation(predictions_abs_path + ".jsonl")
+fb_passes_file = open(fb_passes_abs_path, "w")
+fb_passes_file.write("question_id\tfb_passes")
+if feature_store is not None: # points that the store left out count as unanswered, like in evaluation from raw data
+    for point_id, gold_answer, gold_sp in left_out:
+        sink.add(point_id, "noanswer", [], gold_answer, gold_sp)
+    point_usage_stats[1] += len(left_out)
+
+batch_size = cfg("prediction_batch_size") if cfg("prediction_batch_size") else 16
+if feature_store is not None:
+    batches = (range(pos, min(pos + batch_size, data_limit)) for pos in range(0, data_limit, batch_size))
+else:
+    batches = iter(lambda: list(itertools.islice(raw_data, batch_size)), []) # the last one may be smaller
+for batch in batches: # positions in the store, or raw points
+
+    with take_time.span("batch"): # stages are nested in this (e.g. batch/selection, batch/dfgn/encode)
+        if feature_store is not None: # everything was preprocessed; just read it and put it on the device
+            with take_time.span("reading"):
+                points = [feature_store.point(i, sparse_graph=cfg("sparse_graphs")) for i in batch]
+                ids, queries, contexts, graphs, _, sent_lengths = [list(x) for x in zip(*points)]
+                queries = [q.to(device) for q in queries]
+                contexts = [c.to(device) for c in contexts]
+                graphs = [g.to(device) for g in graphs]
+            graph_log = [sum([len(g.graph) for g in graphs]), sum([len(g.relation_triplets()) for g in graphs]), len(graphs)]
+            point_usage_log = [len(ids), 0]
+            golds = [gold[id] for id in ids]
+        else:
+            # prepare data: select paragraphs, make graphs, ...
+            # shape of sent_lengths: list[ list[list[int]] ] sentences' lengths per paragraph; for multiple data points
+            ids, queries, contexts, graphs, sent_lengths, \
+            take_time, graph_log, point_usage_log = prepare_prediction(batch,
+                                                                       para_selector,
+                                                                       cfg("ps_threshold"),
+                                                                       cfg("text_length"),
+                                                                       ner_tagger,
+                                                                       take_time,
+                                                                       pack_sequences=cfg("pack_sequences"),
+                                                                       max_nodes=cfg("max_nodes") if cfg("max_nodes") else 40,
+                                                                       sparse_graphs=cfg("sparse_graphs"))
+            # return useless datapoints (no entities) unanswered
+            ids = ids if ids else []
+            for point in batch:
+                if point[0] not in ids:
+                    sink.add(point[0], "noanswer", [], point[4], point[1])
+            golds = [(point[4], point[1]) for point in batch if point[0] in ids]
+
+            # encode strings to IDs and put the tensors on the device
+            if ids:
+                queries, contexts, graphs, take_time = encode_to_device(queries,
+                                                                        contexts,
+                                                                        graphs,
+                                                                        dfgn.encoder,
+                                                                        device,
+                                                                        take_time)
+
+        if ids:
+            # predict the whole batch at once
+            with take_time.span("dfgn"):
+                predictions = predict_batch(dfgn, queries, contexts, graphs,
+                                            tokenizer, sent_lengths, fb_passes=cfg("fb_passes"),
+                                            packed=cfg("pack_sequences"),
+                                            max_answer_length=cfg("max_answer_length") if cfg("max_answer_length") else 30,
+                                            fb_tolerance=cfg("fb_tolerance") if cfg("fb_tolerance") else None,
+                                            fast_path=fast_path,
+                                            profiler=take_time)
+
+            with take_time.span("scoring"):
+                for id, (answer, sup_fact_pairs, _), n_passes, (gold_answer, gold_sp) \
+                        in zip(ids, predictions, dfgn.last_fb_passes, golds):
+                    counter += 1 # just for keeping track.
+                    sink.add(id, answer, sup_fact_pairs, gold_answer, gold_sp)
+                    fb_passes_file.write(f"\n{id}\t{n_passes}")
+                    n_fb_passes = [n_fb_passes[0] + 1, n_fb_passes[1] + n_passes]
+                    if cfg("verbose_evaluation"): print(f"({counter}) {id}\n   {answer}\n")
+
+    # latency per question (the batch's time divided among its questions)
+    take_time.record("question", take_time.samples["batch"][-1] / len(batch))
+    take_time.count("questions", len(batch))
 
     graph_stats = [old+new for old,new in zip(graph_stats, graph_log)]
     point_usage_stats = [old+new for old,new in zip(point_usage_stats, point_usage_log)]
 
+fb_passes_file.close()
+print(f"Saved the numbers of fusion block passes in {fb_passes_abs_path}")
+if n_fb_passes[0]:
+    print(f"average number of fusion block passes: {n_fb_passes[1] / n_fb_passes[0]}")
 
 
 #=========== EVALUATION
 print("Evaluating...")
-metrics = official_eval_script.eval(predictions_abs_path, cfg("test_data_abs_path"))
+# the metrics were updated with each prediction; this writes the predictions in the official format
+metrics = sink.merge(predictions_abs_path)
 #{'em',       'f1',       'prec',       'recall',
 # 'sp_em',    'sp_f1',    'sp_prec',    'sp_recall',
 # 'joint_em', 'joint_f1', 'joint_prec', 'joint_recall'}
@@ -328,5 +421,8 @@ take_time("evaluation")
 
 #========== LOGGING
 take_time = write_results(results_abs_path, metrics, take_time, graph_stats, point_usage_stats)
+take_time.to_json(profile_abs_path + ".json")
+take_time.to_chrome_trace(profile_abs_path + ".trace.json")
+print(f"Profile in {profile_abs_path}.json (trace for chrome://tracing in {profile_abs_path}.trace.json)")
 print("\nTimes taken:\n", take_time)
 print("done.")
\ No newline at end of file
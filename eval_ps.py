@@ -2,7 +2,7 @@
 This is for evaluating the paragraph selector.
 """
 
-from utils import Timer
+from utils import Profiler
 from utils import HotPotDataHandler
 from utils import ConfigReader
 
@@ -13,7 +13,7 @@ import sys
 import os
 
 # =========== PARAMETER INPUT
-take_time = Timer()
+take_time = Profiler()
 
 parser = argparse.ArgumentParser()
 parser.add_argument('config_file', metavar='config', type=str,
@@ -26,6 +26,8 @@ cfg = ConfigReader(args.config_file)
 model_abs_path = cfg('model_abs_dir') + args.model_name + "/"
 results_abs_path = model_abs_path + args.model_name + ".test_scores"
 predictions_abs_path = cfg('predictions_abs_dir') + args.model_name + ".predictions"
+exit_benchmark_abs_path = model_abs_path + args.model_name + ".exit_benchmark"
+profile_abs_path = model_abs_path + args.model_name + ".profile"
 
 # check all relevant file paths and directories before starting training
 try:
@@ -43,13 +45,14 @@ for path in [model_abs_path, cfg('predictions_abs_dir') ]:
 take_time("parameter input")
 
 
-print(f"Reading data from {cfg('dev_data_abs_path')}...")  # the whole HotPotQA training set
-dh = HotPotDataHandler(cfg("dev_data_abs_path")) # the whole HotPotQA dev set
+print(f"Reading data from {cfg('dev_data_abs_path')}...")
+dh = HotPotDataHandler(cfg("dev_data_abs_path"), limit=cfg("testset_size")) # the HotPotQA dev set, up to testset_size points
 raw_data = dh.data_for_paragraph_selector() # get raw points
 
-data_limit = cfg("testset_size") if cfg("testset_size") else len(raw_data)
+data_limit = len(raw_data)
 
-model = ParagraphSelector.ParagraphSelector(model_abs_path) # looks for the 'pytorch_model.bin' in this directory
+model = ParagraphSelector.ParagraphSelector(model_abs_path, # looks for the 'pytorch_model.bin' in this directory
+                                            early_exit_threshold=cfg("early_exit_threshold"))
 
 take_time("data  loading")
 
@@ -58,7 +61,8 @@ print("Evaluating...")
 precision, recall, f1, accuracy, ids, y_true, y_pred = model.evaluate(raw_data[:data_limit],
                                                             threshold=cfg("threshold"),
                                                             text_length=cfg("text_length"),
-                                                            try_gpu=cfg("try_gpu"))
+                                                            try_gpu=cfg("try_gpu"),
+                                                            profiler=take_time)
 print("Precision:", precision)
 print("Recall:   ", recall)
 print("F score:  ", f1)
@@ -72,6 +76,19 @@ with open(predictions_abs_path, 'w', encoding='utf-8') as f:
                 ','.join([str(int(j)) for j in y_true[i]]) + "\t" + \
                 ','.join([str(int(j)) for j in y_pred[i]]) + "\n")
 
+if cfg("benchmark_exit_layers"):
+    print("Benchmarking exit layers...")
+    exit_results = model.benchmark_exits(raw_data[:data_limit],
+                                         threshold=cfg("threshold"),
+                                         text_length=cfg("text_length"),
+                                         try_gpu=cfg("try_gpu"),
+                                         exit_thresholds=cfg("exit_thresholds") if cfg("exit_thresholds") else [])
+    with open(exit_benchmark_abs_path, 'w', encoding='utf-8') as f:
+        f.write("mode\tvalue\tavg_exit_layer\tprecision\trecall\tf1\taccuracy\tseconds_per_point\n")
+        f.write("\n".join(["\t".join([str(v) for v in row]) for row in exit_results]) + "\n")
+    print(f"Exit layer benchmark in {exit_benchmark_abs_path}")
+    take_time("exit benchmark")
+
 with open(results_abs_path, 'w', encoding='utf-8') as f:
     f.write("Configuration in: " + args.config_file + "\n")
     f.write("Outputs in:  " + predictions_abs_path + \
@@ -83,4 +100,8 @@ with open(results_abs_path, 'w', encoding='utf-8') as f:
 
     take_time.total()
     f.write("\n\nTimes taken:\n" + str(take_time))
-    print("\ntimes taken:\n", take_time)
\ No newline at end of file
+    print("\ntimes taken:\n", take_time)
+
+take_time.to_json(profile_abs_path + ".json")
+take_time.to_chrome_trace(profile_abs_path + ".trace.json")
+print(f"Profile in {profile_abs_path}.json (open {profile_abs_path}.trace.json in chrome://tracing)")
\ No newline at end of file
@@ -0,0 +1,105 @@
+"""
+This script exports a trained DFGN model to TorchScript and ONNX,
+using the tensor-only interface DFGN.forward_tensors().
+The exported models take token IDs and graph tensors (see EntityGraph.tensors())
+and return the Predictor's outputs (supporting fact, start, end and type scores).
+The graph's adjacency matrix has no relation types (A[i][j] = 1 for any link from
+node i to node j), as the fusion block's graph attention doesn't use them.
+"""
+
+import os, sys, argparse
+import torch
+
+import utils
+from train_dfgn import DFGN
+
+
+class TensorDFGN(torch.nn.Module):
+    """
+    Wrap a DFGN so that its forward function is DFGN.forward_tensors(),
+    with a fixed number of fusion block passes. This is what gets exported.
+    """
+    def __init__(self, dfgn, fb_passes=1):
+        super(TensorDFGN, self).__init__()
+        self.dfgn = dfgn
+        self.fb_passes = fb_passes
+
+    def forward(self, query_ids, context_ids, bin_M, adjacency, node_mask):
+        return self.dfgn.forward_tensors(query_ids, context_ids, bin_M, adjacency, node_mask,
+                                         fb_passes=self.fb_passes)
+
+def example_inputs(text_length, query_length, n_nodes, device=torch.device('cpu')):
+    """
+    Make random inputs of the right shapes for tracing.
+    :param text_length: number of context tokens (M)
+    :param query_length: number of query tokens (L)
+    :param n_nodes: number of graph nodes (N)
+    :return: query_ids (L), context_ids (M), bin_M (M, N), adjacency (N, N), node_mask (N)
+    """
+    query_ids = torch.randint(1000, 30000, (query_length,), device=device)
+    context_ids = torch.randint(1000, 30000, (text_length,), device=device)
+    bin_M = torch.zeros((text_length, n_nodes), device=device)
+    bin_M[torch.randperm(text_length, device=device)[:n_nodes], torch.arange(n_nodes, device=device)] = 1
+    adjacency = (torch.rand((n_nodes, n_nodes), device=device) < 0.1).float()
+    adjacency = torch.max(adjacency, adjacency.T) # links are symmetric
+    node_mask = torch.ones(n_nodes, dtype=torch.bool, device=device)
+    return query_ids, context_ids, bin_M, adjacency, node_mask
+
+def max_difference(outputs1, outputs2):
+    """ largest absolute difference between two tuples of output tensors """
+    return max([(o1 - o2).abs().max().item() for o1, o2 in zip(outputs1, outputs2)])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_file', metavar='config', type=str,
+                        help='configuration file for exporting')
+    parser.add_argument('model_name', metavar='model', type=str,
+                        help="name of the DFGN model's file")
+    args = parser.parse_args()
+    cfg = utils.ConfigReader(args.config_file)
+
+    model_abs_dir = cfg('model_abs_dir') + args.model_name + "/"
+    model_filepath = model_abs_dir + args.model_name
+    torchscript_filepath = model_filepath + ".torchscript.pt"
+    onnx_filepath = model_filepath + ".onnx"
+
+    try:
+        f = open(model_filepath, "rb")
+        f.close()
+    except FileNotFoundError as e:
+        print(e)
+        sys.exit()
+
+    dfgn = torch.load(model_filepath, map_location=torch.device('cpu'))
+    dfgn.eval()
+    model = TensorDFGN(dfgn, fb_passes=cfg("fb_passes"))
+
+    # queries can have any length (up to 512 - text_length); graphs are padded to max_nodes
+    inputs = example_inputs(dfgn.encoder.text_length, cfg("query_length"), cfg("max_nodes"))
+    input_names = ["query_ids", "context_ids", "bin_M", "adjacency", "node_mask"]
+    output_names = ["sup_scores", "start_scores", "end_scores", "type_scores"]
+
+    with torch.no_grad():
+        eager_outputs = model(*inputs)
+
+        print(f"Tracing the model to {torchscript_filepath}...")
+        traced = torch.jit.trace(model, inputs, check_trace=False)
+        traced.save(torchscript_filepath)
+        print(f"max. difference to the original model: {max_difference(eager_outputs, traced(*inputs))}")
+
+        print(f"Exporting the model to {onnx_filepath}...")
+        torch.onnx.export(model, inputs, onnx_filepath,
+                          input_names=input_names,
+                          output_names=output_names,
+                          dynamic_axes={"query_ids": {0: "query_length"}},
+                          opset_version=cfg("onnx_opset") if cfg("onnx_opset") else 18)
+
+    try: # check the exported model if onnxruntime is available
+        import onnxruntime
+        session = onnxruntime.InferenceSession(onnx_filepath)
+        onnx_outputs = session.run(None, {name: t.numpy() for name, t in zip(input_names, inputs)})
+        print(f"max. difference to the original model: {max_difference(eager_outputs, [torch.from_numpy(o) for o in onnx_outputs])}")
+    except ImportError:
+        print("onnxruntime is not installed; the ONNX model was not checked.")
@@ -0,0 +1,337 @@
+"""
+Run the DFGN's preprocessing (paragraph selection, NER, entity graph,
+tokenization and labels) once over a HotPotQA file and write the results
+to a feature store: sharded, memory-mapped numpy arrays with an index.
+train_dfgn.py and eval_dfgn.py can then read their inputs from the store
+instead of preprocessing the raw points again.
+
+usage: python3 featurize.py config/featurize.cfg
+"""
+
+import os, sys, argparse
+import json
+import multiprocessing
+import numpy as np
+import torch
+from tqdm import tqdm
+from transformers import BertTokenizer
+
+import flair  # for NER in the EntityGraph
+import utils
+from modules import ParagraphSelector, EntityGraph, Encoder
+
+
+# each field is a concatenation of the points' arrays along the first dimension
+FIELDS = {"query_ids":        (np.int64, ()),   # (L) token IDs of the query
+          "context_ids":      (np.int64, ()),   # (M) token IDs of the context (padded to text_length)
+          "entity_map":       (np.int16, (2,)), # (K, 2) (token, node) pairs; the non-zero entries of M
+          "edges":            (np.int16, (3,)), # (E, 3) (source, target, relation type) of each link
+          "sup_labels":       (np.int8,  ()),   # (M) supporting fact label of each token
+          "sentence_lengths": (np.int16, ()),   # (S) number of tokens of each sentence (titles included)
+          "scalars":          (np.int64, (5,))} # (1, 5) start label, end label, type label, #nodes, #paragraphs
+
+
+def featurize_point(point, para_selector, ner_tagger, tokenizer,
+                    ps_threshold=0.1, text_length=250, pack_sequences=False, max_nodes=40):
+    """
+    Make all inputs and labels of the DFGN for one raw point (like train_dfgn.prepare_batch()).
+
+    :param point: raw point as returned by HotPotDataHandler.data_for_paragraph_selector()
+    :param para_selector: a ParagraphSelector object
+    :param ner_tagger: NER tagger passed on to EntityGraph
+    :param tokenizer: a BertTokenizer
+    :param ps_threshold: threshold for the paragraph selector (relevance score between paragraph and query)
+    :param text_length: limit the context's number of tokens (used in ParagraphSelector and EntityGraph)
+    :param pack_sequences: if True, the paragraph selector scores paragraphs in packed sequences
+    :param max_nodes: maximum number of nodes per entity graph
+    :return: (features, meta) -- dict{field: numpy array} (see FIELDS) and [question_id, [[title, #sentences]]],
+             or None if the NER doesn't find any entities (then the point is useless)
+    """
+    with torch.no_grad():
+        context = para_selector.make_context(point,
+                                             threshold=ps_threshold,
+                                             context_length=text_length,
+                                             device=next(para_selector.net.parameters()).device,
+                                             packed=pack_sequences)
+    graph = EntityGraph.EntityGraph(context,
+                                    context_length=text_length,
+                                    tagger=ner_tagger,
+                                    max_nodes=max_nodes,
+                                    sparse=True)
+    if not graph.graph:
+        return None
+
+    q_ids, c_ids = Encoder.token_ids(point[2], context, tokenizer, text_length=text_length)
+    sup_labels, start_label, end_label, type_label = utils.make_labeled_data_for_predictor(graph, point, tokenizer)
+    s_lens = utils.sentence_lengths(context, tokenizer)
+
+    features = {"query_ids":        np.array(q_ids),
+                "context_ids":      np.array(c_ids),
+                "entity_map":       graph.M.nonzero().numpy(),
+                "edges":            torch.cat((graph.edges.T, graph.edge_types.unsqueeze(1)), dim=1).numpy(),
+                "sup_labels":       sup_labels.numpy(),
+                "sentence_lengths": np.array([l for p in s_lens for l in p]),
+                "scalars":          np.array([[int(start_label[0]), int(end_label[0]), int(type_label[0]),
+                                               len(graph.graph), len(context)]])}
+    meta = [point[0], [[para[0], len(p_lens)] for para, p_lens in zip(context, s_lens)]]
+    return features, meta
+
+
+class FeatureStoreWriter():
+    """
+    Write featurized points (see featurize_point()) to a directory. Points are
+    collected in memory until a shard is full; each shard is then written as
+    one .npy file per field plus the points' offsets and their metadata.
+    """
+
+    def __init__(self, directory, shard_size=10000, config=None):
+        """
+        :param directory: directory of the store (created if necessary)
+        :param shard_size: number of points per shard
+        :param config: dict of featurization parameters (saved in the store's index)
+        """
+        self.directory = directory
+        self.shard_size = shard_size
+        self.config = config if config else {}
+        self.shards = [] # list[(shard name, number of points)]
+        self.n_useless = 0
+        self.useless_ids = [] # question IDs of the points that were left out
+        self.buffer = []
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def add(self, featurized, question_id=None):
+        """
+        :param featurized: (features, meta) as returned by featurize_point(), or None for a useless point
+        :param question_id: ID of the point; needed for useless points, so that they can be scored in evaluation
+        """
+        if featurized is None:
+            self.n_useless += 1
+            if question_id is not None:
+                self.useless_ids.append(question_id)
+            return
+        self.buffer.append(featurized)
+        if len(self.buffer) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """ write the collected points as a new shard """
+        if not self.buffer:
+            return
+        name = f"shard_{len(self.shards):05d}"
+        features, meta = list(zip(*self.buffer))
+
+        # offsets[i, f] is the start of point i in field f; row -1 contains the ends
+        lengths = np.array([[len(point[f]) for f in FIELDS] for point in features], dtype=np.int64)
+        offsets = np.zeros((len(features) + 1, len(FIELDS)), dtype=np.int64)
+        offsets[1:] = lengths.cumsum(axis=0)
+        np.save(os.path.join(self.directory, f"{name}.offsets.npy"), offsets)
+
+        for j, (field, (dtype, shape)) in enumerate(FIELDS.items()):
+            path = os.path.join(self.directory, f"{name}.{field}.npy")
+            if offsets[-1, j] == 0: # empty files can't be memory-mapped
+                np.save(path, np.zeros((0,) + shape, dtype=dtype))
+                continue
+            array = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(int(offsets[-1, j]),) + shape)
+            for i, point in enumerate(features):
+                array[offsets[i, j]:offsets[i + 1, j]] = point[field].reshape((-1,) + shape)
+            array.flush()
+            del array
+
+        with open(os.path.join(self.directory, f"{name}.meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        self.shards.append((name, len(features)))
+        self.buffer = []
+
+    def close(self):
+        """ write the last shard and the index (store.json) """
+        self.flush()
+        with open(os.path.join(self.directory, "store.json"), "w") as f:
+            json.dump({"fields": list(FIELDS),
+                       "shards": self.shards,
+                       "n_useless": self.n_useless,
+                       "useless_ids": self.useless_ids,
+                       "config": self.config}, f, indent=1)
+
+
+class FeatureStore():
+    """
+    Read a feature store that was written by FeatureStoreWriter. The shards'
+    arrays are memory-mapped (copy-on-write), so that a point's tensors are
+    views of the files' contents and nothing is read before it is needed.
+    """
+
+    def __init__(self, directory, tokenizer=None):
+        """
+        :param directory: directory of the store
+        :param tokenizer: tokenizer that was used for featurization (for turning token IDs back into tokens)
+        """
+        self.directory = directory
+        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased') if not tokenizer else tokenizer
+        with open(os.path.join(directory, "store.json"), "r") as f:
+            index = json.load(f)
+        self.config = index["config"]
+        self.n_useless = index["n_useless"]
+        self.useless_ids = index.get("useless_ids") # None for stores that didn't record them
+
+        self.shards = []  # list[ (dict{field: memmap}, offsets) ]
+        self.meta = []    # list[ [question_id, [[title, #sentences]]] ] for all points
+        self.position = [] # list[(shard number, position in the shard)] for all points
+        for s, (name, size) in enumerate(index["shards"]):
+            arrays = {field: self.load_array(os.path.join(directory, f"{name}.{field}.npy"))
+                      for field in FIELDS}
+            offsets = np.load(os.path.join(directory, f"{name}.offsets.npy"))
+            self.shards.append((arrays, offsets))
+            with open(os.path.join(directory, f"{name}.meta.json"), "r") as f:
+                self.meta.extend(json.load(f))
+            self.position.extend([(s, i) for i in range(size)])
+
+        self.ids = [m[0] for m in self.meta]
+
+    def __len__(self):
+        return len(self.meta)
+
+    @staticmethod
+    def load_array(path):
+        """ memory-map a .npy file (copy-on-write, so that tensors can be made from it without copying) """
+        try:
+            return np.load(path, mmap_mode="c")
+        except ValueError: # empty arrays can't be memory-mapped
+            return np.load(path)
+
+    def __getitem__(self, i):
+        """
+        :param i: number of the point in the store
+        :return: dict{field: Tensor} -- views of the memory-mapped arrays
+        """
+        s, p = self.position[i]
+        arrays, offsets = self.shards[s]
+        return {field: torch.from_numpy(arrays[field][offsets[p, j]:offsets[p + 1, j]])
+                for j, field in enumerate(FIELDS)}
+
+    def point(self, i, sparse_graph=False):
+        """
+        Everything that the DFGN needs for point i.
+        :param i: number of the point in the store
+        :param sparse_graph: if True, the graph only has an edge list (see EntityGraph)
+        :return: question_id, query token IDs, context token IDs, EntityGraph, labels
+                 ((M), (1), (1), (1); like utils.make_labeled_data_for_predictor()),
+                 sentence lengths (list[list[int]], like utils.sentence_lengths())
+        """
+        features = self[i]
+        question_id, paragraphs = self.meta[i]
+        start, end, answer_type, n_nodes, _ = features["scalars"][0].tolist()
+
+        context = [[title, []] for title, _ in paragraphs] # the sentences' texts are not stored
+        graph = EntityGraph.EntityGraph.from_features(context,
+                                                      self.tokenizer.convert_ids_to_tokens(features["context_ids"].tolist()),
+                                                      features["entity_map"],
+                                                      n_nodes,
+                                                      features["edges"],
+                                                      sparse=sparse_graph)
+
+        labels = (features["sup_labels"].long(),
+                  torch.tensor([start]), torch.tensor([end]), torch.tensor([answer_type]))
+
+        s_lens, position = [], 0
+        sentence_lengths = features["sentence_lengths"].tolist()
+        for _, n_sentences in paragraphs:
+            s_lens.append(sentence_lengths[position:position + n_sentences])
+            position += n_sentences
+
+        return question_id, features["query_ids"], features["context_ids"], graph, labels, s_lens
+
+    def batch(self, indices, sparse_graphs=False):
+        """
+        Read a batch of points; the return values are like those of train_dfgn.prepare_batch().
+        :param indices: list[int] -- numbers of the points in the store
+        :param sparse_graphs: if True, the graphs only have edge lists (see EntityGraph)
+        :return: ids, query token IDs, context token IDs, graphs, labels, n_useless (always 0)
+        """
+        points = [self.point(i, sparse_graph=sparse_graphs) for i in indices]
+        ids, q_ids_list, c_ids_list, graphs, labels, _ = list(zip(*points))
+        labels = tuple(torch.stack(l) for l in zip(*labels))
+        return list(ids), list(q_ids_list), list(c_ids_list), list(graphs), labels, 0
+
+
+# the models of a worker process (see init_worker())
+_worker = {}
+
+def init_worker(cfg_params):
+    """
+    Load the models that a worker process needs for featurize_point().
+    :param cfg_params: dict of config parameters
+    """
+    torch.set_num_threads(1) # the processes run in parallel anyway
+    flair.device = torch.device('cpu')
+    _worker["para_selector"] = ParagraphSelector.ParagraphSelector(cfg_params["ps_model_abs_dir"])
+    _worker["para_selector"].net.eval()
+    _worker["ner_tagger"] = flair.models.SequenceTagger.load('ner')
+    _worker["tokenizer"] = BertTokenizer.from_pretrained('bert-base-uncased')
+    _worker["params"] = cfg_params
+
+def featurize_in_worker(point):
+    """
+    featurize_point() with the models of the worker process
+    :return: question_id, result of featurize_point()
+    """
+    params = _worker["params"]
+    return point[0], featurize_point(point,
+                                     _worker["para_selector"],
+                                     _worker["ner_tagger"],
+                                     _worker["tokenizer"],
+                                     ps_threshold=params["ps_threshold"],
+                                     text_length=params["text_length"],
+                                     pack_sequences=bool(params["pack_sequences"]),
+                                     max_nodes=params["max_nodes"] if params["max_nodes"] else 40)
+
+
+
+if __name__ == '__main__':
+
+    #=========== PARAMETER INPUT
+    take_time = utils.Timer()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_file', metavar='config', type=str,
+                        help='configuration file for featurization')
+    args = parser.parse_args()
+
+    cfg = utils.ConfigReader(args.config_file)
+    params = {k: cfg(k) for k in ["ps_model_abs_dir", "ps_threshold", "text_length", "pack_sequences", "max_nodes"]}
+    take_time("parameter input")
+
+    #=========== DATA LOADING
+    print(f"Reading data from {cfg('data_abs_path')}...")
+    dh = utils.HotPotDataHandler(cfg("data_abs_path"), limit=cfg("dataset_size"))
+    raw_data = dh.points() # a generator: points are read one at a time, up to dataset_size
+    n_points = cfg("dataset_size") if cfg("dataset_size") else None # only for the progress bar
+    take_time("data loading")
+
+    #=========== FEATURIZATION
+    writer = FeatureStoreWriter(cfg("feature_store_abs_dir"),
+                                shard_size=cfg("shard_size") if cfg("shard_size") else 10000,
+                                config=params)
+    num_workers = cfg("num_workers") if cfg("num_workers") else 1
+    if num_workers > 1:
+        # 'spawn' because torch and flair don't like to be forked
+        with multiprocessing.get_context("spawn").Pool(num_workers, initializer=init_worker, initargs=(params,)) as pool:
+            for question_id, featurized in tqdm(pool.imap(featurize_in_worker, raw_data,
+                                                          chunksize=cfg("chunk_size") if cfg("chunk_size") else 16),
+                                                total=n_points, desc="featurizing"):
+                writer.add(featurized, question_id)
+    else:
+        init_worker(params)
+        for point in tqdm(raw_data, total=n_points, desc="featurizing"):
+            question_id, featurized = featurize_in_worker(point)
+            writer.add(featurized, question_id)
+    writer.close()
+    take_time("featurization")
+
+    n_stored = sum([size for _, size in writer.shards])
+    print(f"Wrote {n_stored} points ({writer.n_useless} useless points left out) "
+          f"to {cfg('feature_store_abs_dir')}")
+    take_time.total()
+    print("\nTimes taken:\n", take_time)
+    print("done.")
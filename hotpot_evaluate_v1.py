@@ -81,12 +81,31 @@ def update_sp(metrics, prediction, gold):
     metrics['sp_recall'] += recall
     return em, prec, recall
 
+def update_point(metrics, answer, sp, gold_answer, gold_sp):
+    """ like one step of eval_dicts(), for a point with both predictions (metrics are summed, not averaged) """
+    em, prec, recall = update_answer(metrics, answer, gold_answer)
+    sp_em, sp_prec, sp_recall = update_sp(metrics, sp, gold_sp)
+
+    joint_prec = prec * sp_prec
+    joint_recall = recall * sp_recall
+    if joint_prec + joint_recall > 0:
+        joint_f1 = 2 * joint_prec * joint_recall / (joint_prec + joint_recall)
+    else:
+        joint_f1 = 0.
+    metrics['joint_em'] += em * sp_em
+    metrics['joint_f1'] += joint_f1
+    metrics['joint_prec'] += joint_prec
+    metrics['joint_recall'] += joint_recall
+
 def eval(prediction_file, gold_file):
     with open(prediction_file) as f:
         prediction = json.load(f)
     with open(gold_file) as f:
         gold = json.load(f)
+    return eval_dicts(prediction, gold)
 
+def eval_dicts(prediction, gold):
+    """ like eval(), but with the predictions and the gold data already loaded """
     metrics = {'em': 0, 'f1': 0, 'prec': 0, 'recall': 0,
         'sp_em': 0, 'sp_f1': 0, 'sp_prec': 0, 'sp_recall': 0,
         'joint_em': 0, 'joint_f1': 0, 'joint_prec': 0, 'joint_recall': 0}
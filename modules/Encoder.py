@@ -2,13 +2,14 @@
 This module implements the Encoder from the paper (Section 3.3)
 """
 
+import copy
 import torch
 from transformers import BertTokenizer, BertModel
 import os,sys,inspect
 current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parent_dir = os.path.dirname(current_dir)
 sys.path.insert(0, parent_dir) 
-from utils import flatten_context, Linear, BiDAFNet
+from utils import flatten_context, Linear, BiDAFNet, pack_sequences
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -19,16 +20,22 @@ class Encoder(torch.nn.Module):
     embedding from a query and a context.
     Both BERT and the BiDAF component are trained.
     """
+    MAX_LEN = 512  # BERT's maximum input length
 
     def __init__(self, text_length=512, pad_token_id=0, tokenizer=None,
-                 hidden_size=768, output_size=300, dropout=0.0, encoder_model=None):
+                 hidden_size=768, output_size=300, dropout=0.0, encoder_model=None, num_layers=None):
         """
         Instantiate a Bert tokenizer and a BiDAF net which contains the BERT encoder.
         Sizes of input and output (768,300) are not implemented to be changeable.
         :param text_length: maximum number of tokens (query+context)
         :param pad_token_id: for padding to text_length
         :param tokenizer: defaults to 'bert-base-uncased'
-        :param encoder_model: defaults to 'bert-base-uncased'
+        :param encoder_model: defaults to 'bert-base-uncased'. If its hidden size differs from
+                              hidden_size (e.g., a small, distilled model), its outputs are
+                              projected to hidden_size before BiDAF.
+        :param num_layers: only use the first num_layers layers of the encoder model (default: all of them);
+                           a given encoder_model is not changed: the Encoder uses a truncated copy of it
+                           (which doesn't share its weights with encoder_model)
         """
         super(Encoder, self).__init__()
 
@@ -39,6 +46,13 @@ class Encoder(torch.nn.Module):
         self.encoder_model = BertModel.from_pretrained('bert-base-uncased',
                          output_hidden_states=True, # TODO leave out output_attentions? (This implies some other changes!)
                          output_attentions=True) if not encoder_model else encoder_model
+        if num_layers and num_layers < len(self.encoder_model.encoder.layer):
+            if encoder_model: # it might be used elsewhere (e.g., by a paragraph selector)
+                self.encoder_model = copy.deepcopy(encoder_model)
+            self.encoder_model.encoder.layer = self.encoder_model.encoder.layer[:num_layers]
+            self.encoder_model.config.num_hidden_layers = num_layers
+        if self.encoder_model.config.hidden_size != hidden_size:
+            self.projection = Linear(self.encoder_model.config.hidden_size, hidden_size)
         self.bidaf = BiDAFNet(hidden_size=hidden_size,
                               output_size=output_size,
                               dropout=dropout)
@@ -51,25 +65,14 @@ class Encoder(torch.nn.Module):
         :param c_token_ids: list[int] or Tensor[int] - obtained from a tokenizer
         :return: encoded and BiDAF-ed context of shape (batch, c_len, output_size)
         """
-        MAX_LEN = 512
-
         #TODO rename variables to avoid confusion!!!
 
         #TODO maybe change this in order to avoid unnecessary computing?
 
+        q_token_ids, c_token_ids = self.trim(q_token_ids, c_token_ids)
         len_query = q_token_ids.shape[0]
         len_context = c_token_ids.shape[0]
 
-        # we need to trim, otherwise (1) Bert will explode or (2) our context is longer than specified
-        if (len_query + len_context > MAX_LEN) or (len_query + len_context > self.text_length):
-            cut_point = min(MAX_LEN - len_query, self.text_length)
-            if len_context >= len_query:  # trim whatever 'context' is
-                c_token_ids = c_token_ids[:cut_point]
-                len_context = c_token_ids.shape[0]
-            else:  # trim whatever 'query' is
-                q_token_ids = q_token_ids[:cut_point]
-                len_query = q_token_ids.shape[0]
-
         all_token_ids = torch.cat((q_token_ids, c_token_ids))
         len_all = all_token_ids.shape[0]
 
@@ -81,30 +84,119 @@ class Encoder(torch.nn.Module):
             all_token_ids = torch.cat((all_token_ids, padding))
 
         # get the embeddings corresponding to the token IDs
-        all_hidden_states, all_attentions = self.encoder_model(all_token_ids.unsqueeze(0))[-2:]
+        last_hidden_state = self.embed(all_token_ids.unsqueeze(0))
 
         # This is the embedding of the context + query
-        # [-1] = last hidden state
         # [0] = first sentence ('sentence' = sequence of characters)
-        q_emb = all_hidden_states[-1][0][:len_query]
+        q_emb = last_hidden_state[0][:len_query]
 
         # If query + context is longer than text_length (512 by default),
         # the context embedding includes everything except the query
         if len_all > self.text_length:
-            c_emb = all_hidden_states[-1][0][len_query:]
+            c_emb = last_hidden_state[0][len_query:]
         # Else (query + context shorter than text_length),
         # the context embedding will start after the query embedding,
         # and end after len_query+len_context elements
         # This will prevent us from taking the padding embeddings as
         # parts of the context embedding
         else:
-            c_emb = all_hidden_states[-1][0][len_query:len_query+len_context]
+            c_emb = last_hidden_state[0][len_query:len_query+len_context]
 
         # TODO check whether we actually always return something with text_length!!!
         #  (in cases with large text_length and >512, we might return a context that is shorter than text_length)
         g = self.bidaf(q_emb, c_emb)
         return g
 
+    def forward_packed(self, q_token_ids_list, c_token_ids_list, window=512):
+        """
+        Like forward(), but for many query/context pairs at once: the pairs are
+        stripped of their padding and packed into as few BERT windows as
+        possible (see utils.pack_sequences()). Each pair only attends to itself
+        and has its own position IDs. The packed output is split up again and
+        BiDAF is applied to each pair individually.
+        Context embeddings keep the length of the (trimmed) context token IDs;
+        positions that were padding are filled with zeros instead of being
+        encoded by BERT.
+        :param q_token_ids_list: list[Tensor[int]] -- one query per pair
+        :param c_token_ids_list: list[Tensor[int]] -- one context per pair
+        :param window: length of a packed sequence; at most 512 for BERT
+        :return: list[Tensor] -- encoded and BiDAF-ed contexts, each of shape (c_len, output_size)
+        """
+        window = min(window, self.MAX_LEN)
+
+        pairs = [self.trim(q, c) for q, c in zip(q_token_ids_list, c_token_ids_list)]
+        segments = []
+        real_lengths = []  # list[(int, int)] -- number of non-padding tokens of query and context
+        for q, c in pairs:
+            q_len = self.unpadded_length(q)
+            c_len = self.unpadded_length(c)
+            segments.append(torch.cat((q[:q_len], c[:c_len])))
+            real_lengths.append((q_len, c_len))
+
+        token_ids, attention_mask, position_ids, layout = pack_sequences(segments,
+                                                                         window=window,
+                                                                         pad_token_id=self.pad_token_id)
+        last_hidden_state = self.embed(token_ids,
+                                       attention_mask=attention_mask,
+                                       position_ids=position_ids)  # (P, window, hidden_size)
+
+        result = []
+        for (q, c), (q_len, c_len), (p, offset, _) in zip(pairs, real_lengths, layout):
+            q_emb = last_hidden_state[p][offset:offset+q_len]
+            c_emb = last_hidden_state[p][offset+q_len:offset+q_len+c_len]
+            if c_emb.shape[0] < c.shape[0]:  # re-introduce the stripped padding
+                padding = c_emb.new_zeros((c.shape[0] - c_emb.shape[0], c_emb.shape[1]))
+                c_emb = torch.cat((c_emb, padding))
+            result.append(self.bidaf(q_emb, c_emb))
+
+        return result
+
+    def embed(self, token_ids, attention_mask=None, position_ids=None):
+        """
+        Run the encoder model and return its last hidden state, projected to
+        hidden_size if the encoder model has a different size.
+        :param token_ids: Tensor of shape (batch, seq_len)
+        :param attention_mask: passed on to the encoder model
+        :param position_ids: passed on to the encoder model
+        :return: Tensor of shape (batch, seq_len, hidden_size)
+        """
+        # [0] = last hidden state, which is the same as all_hidden_states[-1]
+        last_hidden_state = self.encoder_model(token_ids,
+                                               attention_mask=attention_mask,
+                                               position_ids=position_ids)[0]
+        if hasattr(self, 'projection'):
+            last_hidden_state = self.projection(last_hidden_state)
+        return last_hidden_state
+
+    def trim(self, q_token_ids, c_token_ids):
+        """
+        Trim a query/context pair so that together, they neither exceed BERT's
+        maximum input length nor (in most cases) text_length.
+        :param q_token_ids: Tensor[int]
+        :param c_token_ids: Tensor[int]
+        :return: Tensor[int], Tensor[int] -- trimmed query and context token IDs
+        """
+        len_query = q_token_ids.shape[0]
+        len_context = c_token_ids.shape[0]
+
+        # we need to trim, otherwise (1) Bert will explode or (2) our context is longer than specified
+        if (len_query + len_context > self.MAX_LEN) or (len_query + len_context > self.text_length):
+            cut_point = min(self.MAX_LEN - len_query, self.text_length)
+            if len_context >= len_query:  # trim whatever 'context' is
+                c_token_ids = c_token_ids[:cut_point]
+            else:  # trim whatever 'query' is
+                q_token_ids = q_token_ids[:cut_point]
+
+        return q_token_ids, c_token_ids
+
+    def unpadded_length(self, token_ids):
+        """
+        Number of tokens before the trailing padding starts.
+        :param token_ids: Tensor[int]
+        :return: int
+        """
+        is_token = (token_ids != self.pad_token_id).nonzero()
+        return 0 if is_token.shape[0] == 0 else int(is_token[-1]) + 1
 
     def token_ids(self, query=None, context=None):
         """
@@ -132,19 +224,32 @@ class Encoder(torch.nn.Module):
             ]
 
 
-        # Tokenize and token_ids the query and the context
-        query_input_ids = self.tokenizer.encode(query,
-                                                   add_special_tokens=False,
-                                                   max_length=self.text_length)
-
-        context_input_ids = self.tokenizer.encode(flatten_context(context),
-                                                     add_special_tokens=False,
-                                                     max_length=self.text_length)
+        return token_ids(query, context, self.tokenizer, text_length=self.text_length)
 
-        # Add padding if there are fewer than text_length tokens,
-        if len(context_input_ids) < self.text_length:
-            context_input_ids += [self.tokenizer.pad_token_id
-                                  for _ in
-                                  range(self.text_length - len(context_input_ids))]
-
-        return query_input_ids, context_input_ids
+def token_ids(query, context, tokenizer, text_length=512):
+    """
+    Token IDs of a query and a context, like Encoder.token_ids(), but without
+    an Encoder object (e.g., for preprocessing in worker processes; see featurize.py).
+    :param query: str, a question
+    :param context: setences, paragraphs, paragraph titles
+    :type context: list[list[str,list[str]]]
+    :param tokenizer: a BertTokenizer
+    :param text_length: maximum number of tokens; the context is padded to this length
+    :return: list[int], list[int] -- query token IDs, context token IDs
+    """
+    # Tokenize and token_ids the query and the context
+    query_input_ids = tokenizer.encode(query,
+                                       add_special_tokens=False,
+                                       max_length=text_length)
+
+    context_input_ids = tokenizer.encode(flatten_context(context),
+                                         add_special_tokens=False,
+                                         max_length=text_length)
+
+    # Add padding if there are fewer than text_length tokens,
+    if len(context_input_ids) < text_length:
+        context_input_ids += [tokenizer.pad_token_id
+                              for _ in
+                              range(text_length - len(context_input_ids))]
+
+    return query_input_ids, context_input_ids
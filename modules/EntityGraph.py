@@ -12,6 +12,7 @@ from flair.models import SequenceTagger
 import numpy as np
 
 from pprint import pprint
+from utils import profile
 
 class EntityGraph():
     """
@@ -36,11 +37,14 @@ class EntityGraph():
     Additionals:
     The graph object is initialized with a BertTokenizer object.
     The object stores the context in structured form ans as token list.
-    The binary matrix for tok2ent is created upon initialization.
+    The binary matrix for tok2ent and the adjacency matrix (or, for sparse
+    graphs, the edge list) for graph attention are created upon initialization.
     A call to the object with one or more IDs will return a sub-graph.
     """
 
-    def __init__(self, context=None, context_length=512, tagger=None, max_nodes=40):
+    tokenizer = None # shared by all graphs (loaded once, and not pickled with the graphs)
+
+    def __init__(self, context=None, context_length=512, tagger=None, max_nodes=40, sparse=False, profiler=None):
         """
         Initialize a graph object with a 'context'.
         A context is a list of paragraphs and each paragraph is a 2-element list
@@ -53,6 +57,9 @@ class EntityGraph():
         :param tagger: a flair.SequenceTagger object; defaults to this.
         :type tagger: str
         :type max_nodes: int
+        :param sparse: if True, only an edge list is made for graph attention
+                       (no adjacency matrix); use this for large graphs
+        :param profiler: a utils.Profiler for timing NER, graph construction and token alignment (optional)
         """
         if context:
             self.context = context
@@ -71,7 +78,8 @@ class EntityGraph():
 
         #print(f"in EntityGraph.init(): context: {self.context}") #CLEANUP
 
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', unk_token='[unk]')
+        if EntityGraph.tokenizer is None:
+            EntityGraph.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', unk_token='[unk]')
         self.tokens = self.tokenizer.tokenize(self.flatten_context())
         # Add padding if there are fewer than text_length tokens,
         if len(self.tokens) < context_length:
@@ -84,11 +92,50 @@ class EntityGraph():
         self.graph = {}
         self.discarded_nodes = {}
 
-        self._find_nodes(tagger)
-        self._connect_nodes()
-        #self._add_entity_spans() #CLEANUP because it's probably never used and just causes an error
-        self.prune(max_nodes) # requires entity links
-        self.M = self.entity_matrix(add_token_mapping_to_graph=True) # a tensor
+        with profile(profiler, "ner"):
+            self._find_nodes(tagger)
+        with profile(profiler, "graph"):
+            self._connect_nodes()
+            #self._add_entity_spans() #CLEANUP because it's probably never used and just causes an error
+            self.prune(max_nodes) # requires entity links
+        with profile(profiler, "alignment"):
+            self.M = self.entity_matrix(add_token_mapping_to_graph=True) # a tensor
+            self.edges, self.edge_types = self.edge_list() # tensors
+            self.A = None if sparse else self.adjacency_matrix() # a tensor
+
+    @classmethod
+    def from_features(cls, context, tokens, entity_map, n_nodes, edges, sparse=False):
+        """
+        Re-build a graph from precomputed features (see featurize.py) without NER.
+        Nodes are numbered 0..n_nodes-1 like the columns of M; mentions and
+        addresses are not stored (they are left empty in the nodes).
+        :param context: the context (only the paragraph titles are needed for predictions)
+        :param tokens: list[str] -- the context's tokens (padded to the context length)
+        :param entity_map: Tensor[int] of shape (K, 2) -- (token, node) pairs; the non-zero entries of M
+        :param n_nodes: number of nodes
+        :param edges: Tensor[int] of shape (#links, 3) -- (source, target, relation type) of each link
+        :param sparse: if True, no adjacency matrix is made (see __init__())
+        :return: an EntityGraph object
+        """
+        graph = cls.__new__(cls)
+        graph.context = context
+        graph.tokens = tokens
+        graph.discarded_nodes = {}
+        graph.graph = {n: {"address": None, "links": [], "mention": "", "token_ids": []}
+                       for n in range(n_nodes)}
+
+        entity_map = entity_map.long()
+        edges = edges.long()
+        for token, node in entity_map.tolist():
+            graph.graph[node]["token_ids"].append(token)
+        for source, target, rel_type in edges.tolist():
+            graph.graph[source]["links"].append((target, rel_type))
+
+        graph.M = torch.zeros((len(tokens), n_nodes))
+        graph.M[entity_map[:, 0], entity_map[:, 1]] = 1
+        graph.edges, graph.edge_types = edges[:, :2].T.contiguous(), edges[:, 2].contiguous()
+        graph.A = None if sparse else graph.adjacency_matrix()
+        return graph
 
     def __repr__(self):
         result = f""
@@ -335,8 +382,8 @@ class EntityGraph():
             """ create binary matrix from the mapping """
             M = np.zeros((len(self.tokens), len(mapping)), dtype="float32")
             for n_i, (node,tokens) in enumerate(mapping.items()):
-                for t_i, token in enumerate(tokens):
-                    M[t_i][n_i] = 1
+                for token in tokens:
+                    M[token][n_i] = 1
 
             return torch.from_numpy(M)
 
@@ -345,6 +392,72 @@ class EntityGraph():
             self.graph = {}
             return None
 
+    def adjacency_matrix(self, typed=False):
+        """
+        Create the adjacency matrix of the graph. Rows and columns are ordered
+        like the columns of M (by node ID); links to pruned nodes are left out.
+        :param typed: if True, make one matrix per relation type
+        :return: torch.Tensor of shape (#entities, #entities) -- A[i][j] = 1 if node i links to node j
+                 or, if typed, of shape (3, #entities, #entities) -- A[r][i][j] = 1 for a link of type r
+        """
+        index = {id: n for n, id in enumerate(sorted(self.graph))}
+        A = np.zeros((3, len(index), len(index)), dtype="float32")
+        for id, node in self.graph.items():
+            for link, rel_type in node['links']:
+                if link in index:
+                    A[rel_type][index[id]][index[link]] = 1
+        return torch.from_numpy(A) if typed else torch.from_numpy(A.max(axis=0))
+
+    def tensors(self, max_nodes=None):
+        """
+        Everything that DFGN.forward_tensors() needs from the graph, on the device of M.
+        :param max_nodes: if given, pad the tensors to this number of nodes (e.g., for fixed input shapes)
+        :return bin_M: torch.Tensor of shape (#tokens, N) -- the matrix M
+        :return adjacency: torch.Tensor of shape (N, N) -- the adjacency matrix A (relation types are
+                           not distinguished, since the fusion block's graph attention doesn't use them)
+        :return node_mask: torch.Tensor[bool] of shape (N) -- False for padding nodes
+        """
+        n_nodes = self.M.shape[1]
+        N = max(n_nodes, max_nodes) if max_nodes else n_nodes
+        device = self.M.device
+        A = self.A if self.A is not None else self.adjacency_matrix().to(device) # sparse graphs have no A
+        node_mask = torch.arange(N, device=device) < n_nodes
+        if N == n_nodes: # no padding needed
+            return self.M, A, node_mask
+
+        bin_M = torch.zeros((self.M.shape[0], N), device=device)
+        bin_M[:, :n_nodes] = self.M
+        adjacency = torch.zeros((N, N), device=device)
+        adjacency[:n_nodes, :n_nodes] = A
+
+        return bin_M, adjacency, node_mask
+
+    def edge_list(self):
+        """
+        Create the edge list of the graph. Nodes are numbered like the columns
+        of M (by node ID); links to pruned nodes are left out.
+        :return: torch.Tensor of shape (2, #links) -- (source, target) node numbers of each link
+        :return: torch.Tensor of shape (#links) -- relation type of each link
+        """
+        index = {id: n for n, id in enumerate(sorted(self.graph))}
+        edges = [(index[id], index[link], rel_type)
+                 for id, node in self.graph.items()
+                 for link, rel_type in node['links'] if link in index]
+        edges = torch.tensor(edges, dtype=torch.long).reshape(-1, 3)
+        return edges[:, :2].T.contiguous(), edges[:, 2].contiguous()
+
+    def to(self, device):
+        """
+        Move the graph's tensors (M, A and the edge list) to a device.
+        :param device: torch.device object
+        :return: the graph itself
+        """
+        self.M = self.M.to(device)
+        self.A = self.A.to(device) if self.A is not None else None
+        self.edges = self.edges.to(device)
+        self.edge_types = self.edge_types.to(device)
+        return self
+
     def flatten_context(self, siyana_wants_a_oneliner=False):
         """
         return the context as a single string.
@@ -412,4 +525,40 @@ class EntityGraph():
         number of average connections per node (bidirectional links count only once)
         :return: average degree of the whole graph
         """
-        return len(self.relation_triplets())/len(self.graph)
\ No newline at end of file
+        return len(self.relation_triplets())/len(self.graph)
+
+def pad_graphs(graphs):
+    """
+    Stack the tensors of several graphs for batch processing (see
+    FusionBlock.forward_batch()). Matrices are padded with zeros to the largest
+    number of tokens and nodes in the batch (which is at most the 'max_nodes'
+    that the graphs were pruned to).
+    :param graphs: list[EntityGraph] -- with their tensors on the same device
+    :return bin_M: Tensor of shape (batch, M, N)
+    :return adjacency: Tensor of shape (batch, N, N)
+    :return node_mask: Tensor[bool] of shape (batch, N) -- False for padding nodes
+    """
+    n_tokens = max([g.M.shape[0] for g in graphs])
+    n_nodes = max([g.M.shape[1] for g in graphs])
+    device = graphs[0].M.device
+
+    bin_M = torch.zeros((len(graphs), n_tokens, n_nodes), device=device)
+    adjacency = torch.zeros((len(graphs), n_nodes, n_nodes), device=device)
+    node_mask = torch.zeros((len(graphs), n_nodes), dtype=torch.bool, device=device)
+    for i, g in enumerate(graphs):
+        m, n = g.M.shape
+        bin_M[i, :m, :n] = g.M
+        adjacency[i, :n, :n] = g.A
+        node_mask[i, :n] = True
+
+    return bin_M, adjacency, node_mask
+
+def size_buckets(graphs, bucket_size):
+    """
+    Group graphs of similar sizes in order to limit padding in batches.
+    :param graphs: list[EntityGraph]
+    :param bucket_size: maximum number of graphs per bucket
+    :return: list[list[int]] -- indices of the graphs in each bucket
+    """
+    by_size = sorted(range(len(graphs)), key=lambda i: len(graphs[i].graph))
+    return [by_size[i:i+bucket_size] for i in range(0, len(by_size), bucket_size)]
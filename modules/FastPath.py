@@ -0,0 +1,199 @@
+"""
+This module implements an optional compiled inference path for the
+FusionBlock and the Predictor (used by DFGN.forward_batch()).
+"""
+
+import itertools
+import torch
+import torch.nn as nn
+
+
+class FusionPredictor(nn.Module):
+    """
+    FusionBlock and Predictor of a DFGN with tensor inputs only and
+    a fixed number of fusion block passes. This is what gets compiled.
+    Padding tokens are processed like all other tokens, so that shapes
+    only depend on the (bucketed) input shapes. The pooling indices
+    (FusionBlock.pooling_operator()) are inputs, since computing them
+    needs nonzero(), which would break the compiled graph.
+    """
+
+    def __init__(self, fusionblock, predictor, passes=1):
+        """
+        :param fusionblock: a FusionBlock object (shared, not copied)
+        :param predictor: a Predictor object (shared, not copied)
+        :param passes: number of passes through the fusion block
+        """
+        super(FusionPredictor, self).__init__()
+        self.fusionblock = fusionblock
+        self.predictor = predictor
+        self.passes = passes
+
+    def forward(self, context_embs, query_embs, query_mask, bin_M, adjacency, node_mask, lengths,
+                mean_matrix, token_index, entity_index):
+        """
+        :param context_embs: (B, M, d2) context embeddings as obtained from Encoder
+        :param query_embs: (B, L, d2) query embeddings as obtained from Encoder
+        :param query_mask: (B, L) False for padding tokens of the queries
+        :param bin_M: (B, M, N) binary matrices that map tokens to entities
+        :param adjacency: (B, N, N) adjacency matrices of the entity graphs
+        :param node_mask: (B, N) False for padding nodes
+        :param lengths: (B) number of real tokens of each context
+        :param mean_matrix: (B, N, M) see FusionBlock.pooling_operator()
+        :param token_index: (B*M) see FusionBlock.pooling_operator() (padded with n_pairs=B*M)
+        :param entity_index: (B*M) see FusionBlock.pooling_operator() (padded with n_pairs=B*M)
+        :return: outputs as produced by Predictor.forward_batch()
+        """
+        Ct = self.fusionblock.forward_batch(context_embs, query_embs, bin_M, adjacency, node_mask,
+                                            query_mask=query_mask,
+                                            passes=self.passes,
+                                            pooling=(mean_matrix, token_index, entity_index))
+        return self.predictor.forward_batch(Ct, lengths, skip_padding=False)
+
+
+class FastPath():
+    """
+    Compiled inference for FusionBlock and Predictor, either with torch.compile
+    ('compile') or with TorchScript tracing ('script'). Inputs are padded to a
+    small set of shape buckets (batch size, number of nodes, context and query
+    length), so that compiled graphs are re-used instead of re-compiled; there
+    is one compiled model per bucket shape.
+    Inputs that are larger than the largest bucket (or whose tokens belong to more
+    than one entity on average), and everything after a failed compilation, are
+    processed by the eager (non-compiled) model.
+    """
+
+    def __init__(self, dfgn, passes=1, mode='compile',
+                 batch_buckets=(1, 2, 4, 8, 16),
+                 node_buckets=(10, 20, 40),
+                 context_buckets=(256, 512),
+                 query_buckets=(32, 64)):
+        """
+        :param dfgn: a trained DFGN
+        :param passes: number of fusion block passes
+        :param mode: 'compile' (torch.compile) or 'script' (torch.jit.trace, one trace per shape bucket)
+        :param batch_buckets: batch sizes that inputs are padded to
+        :param node_buckets: numbers of graph nodes that inputs are padded to
+        :param context_buckets: context lengths that inputs are padded to
+        :param query_buckets: query lengths that inputs are padded to
+        """
+        if mode not in ['compile', 'script']:
+            raise ValueError(f"Unknown mode for FastPath: {mode} (use 'compile' or 'script').")
+
+        self.mode = mode
+        self.eager = FusionPredictor(dfgn.fusionblock, dfgn.predictor, passes=passes).eval()
+        self.buckets = [sorted(batch_buckets), sorted(node_buckets), sorted(context_buckets), sorted(query_buckets)]
+
+        self.compiled = {}  # {(B, N, M, L): compiled FusionPredictor} for mode 'compile'
+        self.traces = {}  # {(B, N, M, L): traced FusionPredictor} for mode 'script'
+        self.failed = False  # after a failed compilation, only the eager model is used
+
+    def __call__(self, context_embs, query_embs, query_mask, bin_M, adjacency, node_mask, lengths):
+        """
+        Run the compiled model on padded inputs (see FusionPredictor.forward()) and
+        remove the padding from the outputs again.
+        :return: outputs as produced by Predictor.forward_batch()
+        """
+        B, M, N = bin_M.shape
+        L = query_embs.shape[1]
+        shape = self.bucket_shape(B, N, M, L)
+        inputs = (context_embs, query_embs, query_mask, bin_M, adjacency, node_mask, lengths)
+
+        with torch.no_grad():
+            if shape is None or self.failed or int(bin_M.sum()) > shape[0] * shape[2]:
+                return self.eager(*inputs, *self.eager.fusionblock.pooling_operator(bin_M))
+            try:
+                padded = self.pad(shape, *inputs)
+                pooling = self.eager.fusionblock.pooling_operator(padded[3], n_pairs=shape[0] * shape[2]) # B*M
+                outputs = self.run_compiled(shape, *padded, *pooling)
+            except Exception as e:
+                print(f"Compiled inference failed ({e}); continuing in eager mode.")
+                self.failed = True
+                return self.eager(*inputs, *self.eager.fusionblock.pooling_operator(bin_M))
+
+        sups, starts, ends, types = outputs
+        return sups[:B, :M], starts[:B, :M], ends[:B, :M], types[:B]
+
+    def bucket_shape(self, B, N, M, L):
+        """
+        :return: (B, N, M, L) rounded up to the next buckets, or None if a value exceeds its largest bucket
+        """
+        shape = []
+        for value, buckets in zip([B, N, M, L], self.buckets):
+            bucket = [b for b in buckets if b >= value]
+            if not bucket:
+                return None
+            shape.append(bucket[0])
+        return tuple(shape)
+
+    def pad(self, shape, context_embs, query_embs, query_mask, bin_M, adjacency, node_mask, lengths):
+        """
+        Pad the inputs with zeros to the bucket shape (B, N, M, L).
+        Padding data points get one (zero) query token so that they don't produce NaN values.
+        """
+        B, N, M, L = shape
+        b, m, n = bin_M.shape
+        l = query_embs.shape[1]
+        d2 = context_embs.shape[-1]
+
+        padded = [context_embs.new_zeros((B, M, d2)),
+                  query_embs.new_zeros((B, L, d2)),
+                  query_mask.new_zeros((B, L)),
+                  bin_M.new_zeros((B, M, N)),
+                  adjacency.new_zeros((B, N, N)),
+                  node_mask.new_zeros((B, N)),
+                  lengths.new_zeros((B,))]
+        padded[0][:b, :m] = context_embs
+        padded[1][:b, :l] = query_embs
+        padded[2][:b, :l] = query_mask
+        padded[2][b:, 0] = True
+        padded[3][:b, :m, :n] = bin_M
+        padded[4][:b, :n, :n] = adjacency
+        padded[5][:b, :n] = node_mask
+        padded[6][:b] = lengths
+        return padded
+
+    def run_compiled(self, shape, *inputs):
+        """ run the compiled model for inputs of a bucket shape """
+        if self.mode == 'compile':
+            if shape not in self.compiled:
+                self.compiled[shape] = torch.compile(self.eager, dynamic=False)
+            with self.recompile_limit():
+                return self.compiled[shape](*inputs)
+        if shape not in self.traces:
+            self.traces[shape] = torch.jit.trace(self.eager, tuple(inputs), check_trace=False)
+        return self.traces[shape](*inputs)
+
+    def recompile_limit(self):
+        """
+        The compiled models of all buckets share the code of FusionPredictor.forward(), and
+        torch._dynamo stops compiling new shapes of a function after a limit (8 by default),
+        running it eagerly instead. This raises the limit to the number of bucket shapes.
+        :return: context manager
+        """
+        import torch._dynamo # only needed (and available) with torch.compile
+        config = torch._dynamo.config
+        name = "recompile_limit" if hasattr(config, "recompile_limit") else "cache_size_limit" # renamed in torch 2.6
+        n_shapes = len(list(itertools.product(*self.buckets)))
+        return config.patch(**{name: max(getattr(config, name), n_shapes)})
+
+    def warmup(self, emb_size, device=torch.device('cpu')):
+        """
+        Compile the model for all bucket shapes (with random inputs), so that
+        no compilation happens during inference.
+        :param emb_size: d2 (the DFGN's emb_size)
+        :param device: torch device object on which the DFGN is
+        """
+        for B, N, M, L in itertools.product(*self.buckets):
+            context_embs = torch.randn((B, M, emb_size), device=device)
+            query_embs = torch.randn((B, L, emb_size), device=device)
+            query_mask = torch.ones((B, L), dtype=torch.bool, device=device)
+            bin_M = torch.zeros((B, M, N), device=device)
+            bin_M[:, torch.arange(N, device=device) % M, torch.arange(N, device=device)] = 1
+            adjacency = (torch.rand((B, N, N), device=device) < 0.1).float()
+            node_mask = torch.ones((B, N), dtype=torch.bool, device=device)
+            lengths = torch.full((B,), M, dtype=torch.long, device=device)
+
+            self(context_embs, query_embs, query_mask, bin_M, adjacency, node_mask, lengths)
+            if self.failed:
+                break
@@ -1,7 +1,7 @@
 """
 This implements the Fusion block from the paper (Section 3.4)
 """
-from math import sqrt, exp
+from math import sqrt
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -40,7 +40,7 @@ class FusionBlock(nn.Module):
 		self.g2d_layer = nn.LSTM(2*self.d2, self.d2)
 
 
-	def forward(self, context_emb, query_emb, graph, passes=1):
+	def forward(self, context_emb, query_emb, graph, passes=1, tolerance=None):
 		"""
 		Forward function of the FusionBlock.
 		#TODO update docstring
@@ -53,16 +53,36 @@ class FusionBlock(nn.Module):
 
 		:param context_emb: (M, d2) a context embedding as obtained from Encoder
 		:param query_emb: (L, d2) a query embedding as obtained from Encoder
-		:param graph: an entity graph as obtained from EntityGraph
+		:param graph: an entity graph as obtained from EntityGraph; sparse graphs
+					  (without adjacency matrix) use graph_attention_sparse()
 		:param passes:  number of passes through the FusionBlock,
 						default is 1, experiments in the paper use 2
+		:param tolerance: if given, stop early (after fewer than 'passes' passes) as soon as
+						  the entity mask and entity embeddings change less than this
+						  from one pass to the next (see pass_change()); the number of
+						  passes is kept in self.last_passes
 		:return Ct: updated context embedding (M, d2)
 		"""
 
+		pooling = self.pooling_operator(graph.M) # the same for all passes
+		previous = None # (mask, entity embeddings) of the previous pass
+		self.last_passes = passes
+
 		for p in range(passes):
-			entity_embs = self.tok2ent(context_emb, graph.M) # (N, 2d2)
-			entity_embs = entity_embs.unsqueeze(2) # (N, 2d2, 1)
-			updated_entity_embs = self.graph_attention(entity_embs, query_emb, graph) # (N, d2)
+			entity_embs = self.tok2ent(context_emb, graph.M, pooling=pooling) # (N, 2d2)
+			if graph.A is None:
+				updated_entity_embs, mask = self.graph_attention_sparse(entity_embs, query_emb, graph.edges,
+																		 return_mask=True) # (N, d2), (N, 1)
+			else:
+				updated_entity_embs, mask = self.graph_attention(entity_embs, query_emb, graph.A,
+																  return_mask=True) # (N, d2), (N, 1)
+
+			# converged: the rest of this pass would hardly change the context embeddings
+			if tolerance is not None and previous is not None and \
+					float(self.pass_change(mask, updated_entity_embs, *previous)) < tolerance:
+				self.last_passes = p
+				break
+			previous = (mask, updated_entity_embs)
 
 			# the second one is updated; that's why it's the other way round as in the DFGN paper
 			query_emb = self.bidaf(updated_entity_embs, query_emb) # (N, d2) formula 9
@@ -72,131 +92,278 @@ class FusionBlock(nn.Module):
 
 		return Ct
 
+	def forward_batch(self, context_embs, query_embs, bin_M, adjacency, node_mask,
+					  query_mask=None, context_mask=None, passes=1, tolerance=None, pooling=None):
+		"""
+		Like forward(), but for a batch of data points whose tensors are padded
+		(see EntityGraph.pad_graphs() and utils.pad_with_mask()).
+
+		:param context_embs: (B, M, d2) context embeddings as obtained from Encoder
+		:param query_embs: (B, L, d2) query embeddings as obtained from Encoder
+		:param bin_M: (B, M, N) binary matrices that map tokens to entities
+		:param adjacency: (B, N, N) adjacency matrices of the entity graphs
+		:param node_mask: (B, N) False for padding nodes
+		:param query_mask: (B, L) False for padding tokens of the queries (default: no padding)
+		:param context_mask: (B, M) False for padding tokens of the contexts; these are
+							 skipped by graph2doc (default: all tokens are processed)
+		:param passes: (maximum) number of passes through the FusionBlock
+		:param tolerance: see forward(); data points that converged keep their context
+						  embeddings, the others continue. The numbers of passes are
+						  kept in self.last_passes (Tensor of shape (B))
+		:param pooling: the output of pooling_operator(bin_M), if it was computed before
+						(e.g., outside of a compiled graph, since it has data-dependent shapes)
+		:return Ct: updated context embeddings (B, M, d2); padding positions are meaningless
+		"""
+		pooling = pooling if pooling is not None else self.pooling_operator(bin_M) # the same for all passes
+		previous = None # (mask, entity embeddings) of the previous pass
+		active = torch.ones(context_embs.shape[0], dtype=torch.bool, device=context_embs.device) # (B)
+		self.last_passes = torch.zeros(context_embs.shape[0], dtype=torch.long, device=context_embs.device)
+
+		for p in range(passes):
+			entity_embs = self.tok2ent(context_embs, bin_M, pooling=pooling) # (B, N, 2d2)
+			updated_entity_embs, mask = self.graph_attention(entity_embs, query_embs, adjacency,
+															 query_mask=query_mask,
+															 return_mask=True) # (B, N, d2), (B, N, 1)
+
+			if tolerance is not None and previous is not None:
+				active = active & (self.pass_change(mask, updated_entity_embs, *previous, node_mask=node_mask)
+								   >= tolerance)
+				if not bool(active.any()):
+					break
+			previous = (mask, updated_entity_embs)
+			self.last_passes += active.long()
+
+			# the second one is updated; that's why it's the other way round as in the DFGN paper
+			updated_query_embs = self.bidaf(updated_entity_embs, query_embs, batch_processing=True,
+											x_mask=node_mask, y_mask=query_mask) # (B, L, d2) formula 9
+
+			Ct = self.graph2doc(updated_entity_embs, bin_M, context_embs, context_mask=context_mask) # (B, M, d2)
+
+			# update the embeddings for the next pass (only for data points that didn't converge yet)
+			if p == 0:
+				query_embs, context_embs = updated_query_embs, Ct
+			else:
+				query_embs = torch.where(active.view(-1, 1, 1), updated_query_embs, query_embs)
+				context_embs = torch.where(active.view(-1, 1, 1), Ct, context_embs)
+
+		return context_embs
 
-	def tok2ent(self, context_emb, bin_M):
+	@staticmethod
+	def pass_change(mask, entity_embs, previous_mask, previous_entity_embs, node_mask=None):
+		"""
+		Measure how much a pass through the fusion block changed the entity mask
+		(formula 3) and the updated entity embeddings (formula 8), compared to
+		the previous pass. Works with and without a leading batch dimension.
+
+		:param mask: (N, 1) entity mask of this pass
+		:param entity_embs: (N, d2) updated entity embeddings of this pass
+		:param previous_mask: (N, 1) entity mask of the previous pass
+		:param previous_entity_embs: (N, d2) updated entity embeddings of the previous pass
+		:param node_mask: (N) False for padding nodes (these are not taken into account)
+		:return: Tensor (one value per data point) -- the larger of the maximum absolute change
+				 of the mask and the relative change of the entity embeddings (Frobenius norm)
+		"""
+		mask_change = (mask - previous_mask).abs().squeeze(-1) # (N)
+		if node_mask is not None:
+			mask_change = mask_change * node_mask
+		mask_change = mask_change.max(dim=-1)[0]
+
+		# padding nodes have embeddings of 0 and don't change the norms
+		emb_change = torch.norm(entity_embs - previous_entity_embs, dim=(-2, -1)) / \
+					 torch.norm(previous_entity_embs, dim=(-2, -1)).clamp(min=1e-8)
+
+		return torch.max(mask_change, emb_change)
+
+
+	@staticmethod
+	def pooling_operator(bin_M, n_pairs=None):
+		"""
+		Precompute what tok2ent() needs from the binary matrix: a mean pooling
+		matrix (each entity's row is normalized by its number of tokens) and
+		index lists of all token-entity pairs for max pooling.
+		Works with and without a leading batch dimension.
+
+		:param bin_M: (M, N) a binary matrix as described that maps tokens to entities
+						(produced by EntityGraph)
+		:param n_pairs: if given, pad the index lists to this length (for static shapes);
+						padding pairs go to an extra entity after the last one, which tok2ent() drops
+		:return mean_matrix: (N, M) mean pooling matrix
+		:return token_index: (K) token of each token-entity pair, counting through the tokens of the whole batch
+		:return entity_index: (K) entity of each token-entity pair, counting through the entities of the whole batch
+		"""
+		batch_M = bin_M if bin_M.dim() == 3 else bin_M.unsqueeze(0) # (B, M, N)
+		B, M, N = batch_M.shape
+
+		n_tokens = batch_M.sum(dim=1, keepdim=True).clamp(min=1) # (B, 1, N)
+		mean_matrix = (batch_M / n_tokens).transpose(1, 2) # (B, N, M)
+
+		batch_index, token_index, entity_index = (batch_M > 0).nonzero(as_tuple=True) # (K), (K), (K)
+		token_index = batch_index * M + token_index
+		entity_index = batch_index * N + entity_index
+
+		if n_pairs is not None:
+			if len(token_index) > n_pairs:
+				raise ValueError(f"{len(token_index)} token-entity pairs don't fit into n_pairs={n_pairs}.")
+			padding = n_pairs - len(token_index)
+			token_index = torch.cat((token_index, token_index.new_zeros(padding)))
+			entity_index = torch.cat((entity_index, entity_index.new_full((padding,), B * N)))
+
+		return mean_matrix.reshape(*bin_M.shape[:-2], N, M), token_index, entity_index
+
+	def tok2ent(self, context_emb, bin_M, pooling=None):
 		"""
 		Document to Graph Flow from the paper (section 3.4, paragraph 2)
 
 		Obtain the embedding of the entities from the context embeddings.
-		Both mean-pooling and max-pooling are applied.
+		Both mean-pooling and max-pooling are applied (over each entity's tokens).
+		All inputs can have a leading batch dimension.
 
 		:param context_emb: (M, d2) context embedding as obtained from Encoder
 		:param bin_M:   (M, N) a binary matrix as described that maps tokens to entities
 						(produced by EntityGraph)
+		:param pooling: the output of pooling_operator(bin_M), if it was computed before
 
 		:return entity_emb: (N, 2d2) entity embeddings obtained from context embeddings
 		"""
-		M = context_emb.shape[0]
-		N = bin_M.shape[1]
+		mean_matrix, token_index, entity_index = pooling if pooling is not None else self.pooling_operator(bin_M)
+		d2 = context_emb.shape[-1]
 
-		entity_emb = context_emb.unsqueeze(1).expand(-1, N, -1)  # (M, N, d2)
-		bin_M_prime = bin_M.unsqueeze(2)  # (M, N, 1)
-		entity_emb = entity_emb * bin_M_prime  # (M, N, d2) * (M, N 1) = (M, N, d2)
-		entity_emb = entity_emb.permute(1, 2, 0)  # (M, N, d2) -> (N, d2, M)
+		mean_pooling = torch.matmul(mean_matrix, context_emb) # (N, M) x (M, d2) -> (N, d2)
 
-		# For the next lines: (N, d2, M) -> (N, d2, 1) -> (N, d2)
-		mean_pooling = F.avg_pool1d(entity_emb, kernel_size=M).squeeze(-1)
-		max_pooling = F.max_pool1d(entity_emb, kernel_size=M).squeeze(-1)
+		# maximum over the tokens of each entity; entities without tokens get 0
+		tokens = context_emb.reshape(-1, d2)[token_index] # (K, d2)
+		max_pooling = context_emb.new_full((mean_pooling.numel() // d2 + 1, d2), torch.finfo(context_emb.dtype).min)
+		max_pooling = max_pooling.scatter_reduce(0, entity_index.unsqueeze(-1).expand(-1, d2), tokens, reduce="amax")
+		max_pooling = max_pooling[:-1] # the last row collects padding pairs (see pooling_operator())
+		has_tokens = (mean_matrix.sum(dim=-1) > 0).reshape(-1, 1) # (N, 1)
+		max_pooling = torch.where(has_tokens, max_pooling, torch.zeros_like(max_pooling))
+		max_pooling = max_pooling.reshape(mean_pooling.shape) # (N, d2)
 
 		entity_emb = torch.cat((mean_pooling, max_pooling), dim=-1)  # (N, 2d2)
 
 		return entity_emb # (N, 2d2)
 
-	def graph_attention(self, entity_embs, query_emb, graph):
+	def graph_attention(self, entity_embs, query_emb, adjacency, query_mask=None, return_mask=False):
 		"""
 		This implements Dynamic Graph Attention (section 3.4, paragraph 3).
 		Each node of the entity graph propagates information
 		to its neighbors in order to produce updated entity
 		embeddings.
+		All inputs can have a leading batch dimension; padding nodes
+		have no neighbors and get embeddings of 0.
 
-		:param entity_embs: (N, 2d2, 1) entity embeddings as obtained from
-							tok2ent() and unsqueezed in their last dimension
+		:param entity_embs: (N, 2d2) entity embeddings as obtained from tok2ent()
 		:param query_emb: (L, d2) a query embedding as obtained from Encoder
-		:param graph: an entity graph as obtained from EntityGraph
+		:param adjacency: (N, N) adjacency matrix of the entity graph (EntityGraph.A)
+		:param query_mask: (L) False for padding tokens of the query
+		:param return_mask: if True, also return the entity mask (formula 3)
 
 		:return: E_t: (N, d2) updated entity embeddings 
+		:return: mask: (N, 1) entity mask (only if return_mask is True)
 		"""
-		#TODO avoid for-loops, but first make the method run.
-		#TODO avoid torch.Tensor where possible.
-		#TODO change all this to comply with batches! But before, think about the structure of this whole module.
-		N = entity_embs.shape[0] # number of entities, taken from  (N, 2d2, 1)
-		assert N == len(graph.graph) # CLEANUP? # N should be equal to the number of graph nodes
-		
-		# formula 1 # (L, d2) --> (1, L, d2) --> (1, d2, L) --> (1, d2, 1)
-		q_emb = F.avg_pool1d(query_emb.unsqueeze(0).permute(0, 2, 1),
-							 kernel_size=query_emb.shape[0])
-		q_emb = q_emb.permute(0, 2, 1).squeeze(0)  # (1, 1, d2) --> (1, d2)
+		if query_mask is None:
+			q_emb = query_emb.mean(dim=-2, keepdim=True) # (L, d2) --> (1, d2) # formula 1
+		else:
+			query_mask = query_mask.to(query_emb.dtype).unsqueeze(-1) # (L, 1)
+			q_emb = (query_emb * query_mask).sum(dim=-2, keepdim=True) / query_mask.sum(dim=-2, keepdim=True)
 
-		# N * ( (1, d2) x (d2, 2d2) x (2d2, 1) ) --> (N, 1, 1) # formula 2
-		gammas = torch.tensor([torch.chain_matmul(q_emb, self.V, e)/self.droot for e in entity_embs]) #TODO avoid for-loop and torch.tensor()
-		mask = torch.sigmoid(gammas)  # (N, 1, 1) # formula 3
-		E = torch.stack([m*e for m,e in zip(mask, entity_embs.T)])  # (N, 1, 2d2) # formula 4
-		E = E.squeeze(1).T  # (N, 2d2) --> (2d2, N) #TODO do we really need to squeeze?
+		# (N, 2d2) x (2d2, d2) x (d2, 1) --> (N, 1) # formula 2
+		gammas = torch.matmul(torch.matmul(entity_embs, self.V.T), q_emb.transpose(-1, -2)) / self.droot
+		mask = torch.sigmoid(gammas)  # (N, 1) # formula 3
+		E = mask * entity_embs  # (N, 2d2) # formula 4
 
 
 		""" disseminate information across the dynamic sub-graph """
-		betas = torch.zeros(N, N)
-		alphas = torch.zeros(N, N) # scores of how much information flows from i to the j
+		# (N, 2d2) x (2d2, d2) + (1, d2) --> (N, d2) # formula 5
+		hidden = torch.matmul(E, self.U.T) + self.b.T
 
-		# N times [(d2, 2d2) * (2d2, 1)] --> (N, d2, 1)  # formula 5
-		hidden = torch.stack([torch.matmul(self.U,e) + self.b for e in E]) # TODO avoid the for-loop
+		# W.T x [h_i; h_j] = W_1.T x h_i + W_2.T x h_j --> (N, 1) + (1, N) --> (N, N) # formula 6
+		betas = F.leaky_relu(torch.matmul(hidden, self.W[:self.d2]) +
+							 torch.matmul(hidden, self.W[self.d2:]).transpose(-1, -2))
 
-		for i, h_i in enumerate(hidden): # h_i.shape = (d2, 1) #TODO try to avoid these for-loops
+		# softmax over the neighbors j of each node i # formula 7
+		# (nodes without neighbors get alphas of 0)
+		neighbors = adjacency > 0
+		betas = betas.masked_fill(~neighbors, torch.finfo(betas.dtype).min)
+		alphas = F.softmax(betas, dim=-1) * neighbors  # (N, N) scores of how much information flows from i to j
 
-			for j, rel_type in graph.graph[i]["links"]: # only for neighbor nodes
-				pair = torch.cat((h_i, hidden[j])) # (2d2, 1)
-				betas[i][j] = F.leaky_relu(torch.matmul(self.W.T, pair)) # formula 6
 
-			# avoid overflow errors for too big values
-			exes = [] #TODO how to handle overflows? With nan values?
-			for j in range(N):
-				try:
-					exes.append(exp(betas[i][j])) # if the node has no links, this appends a 1
-				except OverflowError:
-					exes.append(float('inf'))
-			sumex = sum(exes) # if the node has no links, this will be N
+		""" compute total information received per node """
+		# sum over the neighbors j of alpha_ji * h_j: (N, N).T x (N, d2) --> (N, d2)
+		E_t = F.relu(torch.matmul(alphas.transpose(-1, -2), hidden)) # formula 8
 
-			for j in range(N): # compute scores for all node combinations
-				try:
-					alphas[i][j] =  exp(betas[i][j]) / sumex # formula 7
-				except OverflowError:
-					alphas[i][j] = float('inf')/sumex
+		return (E_t, mask) if return_mask else E_t # (N, d2)
 
-		""" compute total information received per node """
-		ents_with_new_information = []
+	def graph_attention_sparse(self, entity_embs, query_emb, edges, return_mask=False):
+		"""
+		Same as graph_attention(), but with an edge list instead of an adjacency
+		matrix: attention scores are only computed for the E links of the graph
+		(gathered from the node's hidden states) and messages are scattered to
+		their target nodes. Memory is linear in N + E instead of quadratic in N.
 
-		for i in range(N):
-			# non-connected nodes have an information flow of 0.
-			# j(scalar * (d2, 1)) --> sum --> (d2, 1) --> loop --> N*(d2, 1)
-			ents_with_new_information.append(sum([alphas[j][i] * hidden[j]
-											      for j, rel_type in graph.graph[i]["links"]]
-												  if graph.graph[i]["links"]
-												  else [torch.zeros((self.d2, 1), device=self.device)]
-												  ))
+		:param entity_embs: (N, 2d2) entity embeddings as obtained from tok2ent()
+		:param query_emb: (L, d2) a query embedding as obtained from Encoder
+		:param edges: (2, E) source and target node numbers of the links (EntityGraph.edges)
+		:param return_mask: if True, also return the entity mask (formula 3)
+
+		:return: E_t: (N, d2) updated entity embeddings
+		:return: mask: (N, 1) entity mask (only if return_mask is True)
+		"""
+		N = entity_embs.shape[0]
+		source, target = edges[0], edges[1] # (E), (E)
+
+		q_emb = query_emb.mean(dim=0, keepdim=True) # (L, d2) --> (1, d2) # formula 1
+		gammas = torch.matmul(torch.matmul(entity_embs, self.V.T), q_emb.T) / self.droot # (N, 1) # formula 2
+		mask = torch.sigmoid(gammas)  # (N, 1) # formula 3
+		E = mask * entity_embs  # (N, 2d2) # formula 4
+
+		hidden = torch.matmul(E, self.U.T) + self.b.T # (N, d2) # formula 5
 
-		# N*(d2, 1) --> (N, d2, 1) --> relu --> (N, d2, 1)
-		E_t = F.relu(torch.stack(ents_with_new_information)) # formula 8
+		# beta_ij for each link i -> j: (E) # formula 6
+		betas = F.leaky_relu(torch.matmul(hidden, self.W[:self.d2]).squeeze(-1)[source] +
+							 torch.matmul(hidden, self.W[self.d2:]).squeeze(-1)[target])
 
-		return E_t.squeeze(dim=-1) # (N, d2)
+		# softmax over the neighbors j of each node i, i.e., over the links with the same source # formula 7
+		max_betas = betas.new_full((N,), torch.finfo(betas.dtype).min)
+		max_betas = max_betas.scatter_reduce(0, source, betas, reduce="amax") # (N)
+		exes = torch.exp(betas - max_betas[source]) # (E)
+		sums = betas.new_zeros(N).index_add(0, source, exes) # (N)
+		alphas = exes / sums[source] # (E)
 
-	def graph2doc(self, entity_embs, bin_M, context_emb):
+		# node j receives alpha_ij * h_i from each neighbor i # formula 8
+		messages = alphas.unsqueeze(-1) * hidden[source] # (E, d2)
+		E_t = F.relu(hidden.new_zeros((N, self.d2)).index_add(0, target, messages))
+
+		return (E_t, mask) if return_mask else E_t # (N, d2)
+
+	def graph2doc(self, entity_embs, bin_M, context_emb, context_mask=None):
 		"""
 		This implements Graph to Document Flow (section 3.4, last paragraph).
 
 		Given the updated entity embeddings, using the same binary matrix
 		as in tok2ent, produce the updated context embeddings.
 
+		All inputs can have a leading batch dimension.
+
 		:param entity_embs: (N, d2) updated entity embeddings as obtained
 									from graph_attention
 		:param bin_M:   (M, N) a binary matrix as described that maps tokens to entities
 						(produced by EntityGraph)
 		:param context_emb: (M, d2) a context embedding as obtained from Encoder
+		:param context_mask: (M) False for padding tokens; their outputs are 0
 		:return output: (M, d2) updated context embeddings
 		"""
 
-		# unsqueeze to represent the batch
-		emb_info = torch.matmul(bin_M, entity_embs).unsqueeze(0) # (M, N) x (N, d2) -> (M, d2) -> (1, M, d2)
-		input = torch.cat((context_emb.unsqueeze(0), emb_info), dim=-1) # (1, M, 2d2)
-		output, hidden_states = self.g2d_layer(input) # (1, M, d2) # formula 10
+		emb_info = torch.matmul(bin_M, entity_embs) # (M, N) x (N, d2) -> (M, d2)
+		input = torch.cat((context_emb, emb_info), dim=-1) # (M, 2d2)
+
+		# the LSTM sees each token as a sequence of length 1 (as a 'batch' of M tokens)
+		if context_mask is None:
+			output, hidden_states = self.g2d_layer(input.reshape(1, -1, 2*self.d2)) # (1, M, d2) # formula 10
+			return output.reshape(*input.shape[:-1], self.d2)
 
-		return output.squeeze(0)
\ No newline at end of file
+		# only pass the real tokens through the LSTM
+		output, hidden_states = self.g2d_layer(input[context_mask].unsqueeze(0)) # (1, K, d2) # formula 10
+		result = output.new_zeros((*input.shape[:-1], self.d2)) # same dtype as the LSTM's output (e.g., with autocast)
+		result[context_mask] = output.squeeze(0)
+		return result
\ No newline at end of file
@@ -8,6 +8,7 @@ from transformers import BertTokenizer, BertModel, BertPreTrainedModel, BertConf
 from sklearn.utils import shuffle
 import os,sys,inspect
 import math
+from time import time
 from tqdm import tqdm
 import argparse
 
@@ -22,6 +23,8 @@ sys.path.insert(0, parent_dir)
 from utils import HotPotDataHandler
 from utils import ConfigReader
 from utils import Timer
+from utils import pack_sequences
+import utils
 
 # weights for training, because we have imbalanced data:
 # 80% of paragraphs are not important (= class 0) and 20% are important (class 1)
@@ -30,7 +33,8 @@ from utils import Timer
 
 def make_training_data(data,
                        text_length=512,
-                       tokenizer=BertTokenizer.from_pretrained('bert-base-uncased')):
+                       tokenizer=BertTokenizer.from_pretrained('bert-base-uncased'),
+                       verbose=True):
     """
     Make a train tensor for each datapoint.
 
@@ -45,6 +49,7 @@ def make_training_data(data,
                         the paragraph is shorter then text_length
                         default is 0
     :param tokenizer: default: BertTokenizer(bert-base-uncased)
+    :param verbose: show a progress bar (default: True)
 
     :return: a train tensor with two columns:
                 1. token_ids as returned by the tokenizer for
@@ -57,7 +62,7 @@ def make_training_data(data,
     neg_max = 2 # maximum number of useless paragraphs to be used per question
     labels = []
     datapoints = []
-    for point in tqdm(data):
+    for point in (tqdm(data) if verbose else data):
         neg_counter = 0
         for para in point[3]:
             is_useful_para = para[0] in point[1] # Label is 1: if paragraph title is in supporting facts, otherwise 0
@@ -89,6 +94,131 @@ def make_training_data(data,
 
     return train_tensor
 
+class ParagraphSelectorNet(BertPreTrainedModel):
+    """
+    A neural network for the paragraph selector.
+    """
+    def __init__(self, config):#, input_size=768, output_size=1):
+        """
+        Initialization of the encoder model and a linear layer
+
+        :param config: config as required by BertPreTrainedModel
+        """
+        super(ParagraphSelectorNet, self).__init__(config)
+        self.bert = BertModel(config)#('bert-base-uncased',
+                                                       #output_hidden_states=True,
+                                                       #output_attentions=True) if not encoder_model else encoder_model
+        self.linear = torch.nn.Linear(config.hidden_size, 1)
+        # lightweight classifiers for early exits; keys are layer numbers (counting from 1)
+        self.exit_heads = torch.nn.ModuleDict({str(l): torch.nn.Linear(config.hidden_size, 1)
+                                               for l in getattr(config, "exit_layers", [])
+                                               if l < config.num_hidden_layers})
+        self.init_weights()
+
+    def forward(self, token_ids, attention_mask=None, position_ids=None, cls_positions=None,
+                all_exits=False, exit_layer=None, exit_threshold=None):
+        """
+        Forward function of the ParagraphSelectorNet.
+        Takes in token_ids corresponding to a query+paragraph
+        and returns a relevance score (between 0 and 1) for
+        the query and paragraph.
+
+        :param token_ids: token_ids as returned by the tokenizer;
+                          the text that is passed to the tokenizer
+                          is constructed by [CLS] + query + [SEP] + paragraph + [SEP]
+        :param attention_mask: passed on to BERT (e.g., block-diagonal for packed sequences)
+        :param position_ids: passed on to BERT (e.g., restarting for each packed sequence)
+        :param cls_positions: for packed sequences: (pack indices, offsets) of each [CLS] token;
+                              if not given, the first token of each sequence is used
+        :param all_exits: if True, return a list of scores: one per exit layer, and the final one
+        :param exit_layer: stop at this exit layer and return its score
+        :param exit_threshold: stop at the first exit layer at which all scores are
+                               at least this confident (max(score, 1-score))
+        """
+        if all_exits or exit_layer or exit_threshold:
+            return self.forward_exits(token_ids, attention_mask, position_ids, cls_positions,
+                                      all_exits=all_exits,
+                                      exit_layer=exit_layer,
+                                      exit_threshold=exit_threshold)
+
+        # [-2] is all_hidden_states
+        # [-1] is the last hidden state (list of sentences)
+        # [:,0,:] - we want for all the sentence (:),
+        # only the first token (0) (this is the [CLS token]), 
+        # all its dimensions (:) (768 with bert-base-uncased)
+
+        #with torch.no_grad(): #TODO de-activate this?
+        #embedding = self.bert(token_ids)[-2][-1][:, 0, :] #TODO maybe, this throws errors. in this case, look at Stalin's version below
+
+        outputs = self.bert(token_ids, attention_mask=attention_mask, position_ids=position_ids)
+        embedding = self.cls_embedding(outputs[0], cls_positions)
+
+        output = self.linear(embedding)
+        output = torch.sigmoid(output)
+        return output
+
+    def forward_exits(self, token_ids, attention_mask=None, position_ids=None, cls_positions=None,
+                      all_exits=False, exit_layer=None, exit_threshold=None):
+        """
+        Run BERT layer by layer and compute scores at the exit layers.
+        Layers after the exit are not computed.
+        The layer at which the computation stopped is kept in self.last_exit_layer.
+        For the parameters, see forward().
+        :return: score (like forward()) or list of scores if all_exits is True
+        """
+        n_layers = len(self.bert.encoder.layer)
+        if exit_layer and exit_layer != n_layers and str(exit_layer) not in self.exit_heads:
+            raise ValueError(f"There is no classifier at layer {exit_layer}; "
+                             f"exit layers are {sorted(int(l) for l in self.exit_heads)} and {n_layers}.")
+
+        scores = []
+        for layer_number, hidden_state in self.layer_states(token_ids, attention_mask, position_ids):
+            if layer_number == n_layers:
+                head = self.linear
+            elif str(layer_number) in self.exit_heads:
+                head = self.exit_heads[str(layer_number)]
+            else:
+                continue
+            score = torch.sigmoid(head(self.cls_embedding(hidden_state, cls_positions)))
+            scores.append(score)
+
+            if layer_number == exit_layer:
+                break
+            if exit_threshold and bool((torch.max(score, 1 - score) >= exit_threshold).all()):
+                break
+
+        self.last_exit_layer = layer_number
+        return scores if all_exits else scores[-1]
+
+    def layer_states(self, token_ids, attention_mask=None, position_ids=None):
+        """
+        Lazily compute BERT's hidden states, one layer at a time.
+        :return: generator of (layer number, hidden state of shape (batch, seq_len, hidden_size))
+        """
+        if attention_mask is None:
+            attention_mask = torch.ones_like(token_ids)
+        # additive mask, as BertModel computes it
+        extended_mask = self.bert.get_extended_attention_mask(attention_mask,
+                                                              token_ids.shape,
+                                                              token_ids.device)
+        hidden_state = self.bert.embeddings(input_ids=token_ids, position_ids=position_ids)
+        for i, layer in enumerate(self.bert.encoder.layer):
+            hidden_state = layer(hidden_state, extended_mask)[0]
+            yield i + 1, hidden_state
+
+    @staticmethod
+    def cls_embedding(hidden_state, cls_positions=None):
+        """
+        Select the embeddings of the [CLS] tokens
+        :param hidden_state: Tensor of shape (batch, seq_len, hidden_size)
+        :param cls_positions: see forward()
+        :return: Tensor of shape (num_sequences, hidden_size)
+        """
+        if cls_positions is None:
+            return hidden_state[:, 0, :]
+        return hidden_state[cls_positions[0], cls_positions[1], :]
+
+
 class ParagraphSelector():
     """
     This class implements all that is necessary for training
@@ -102,7 +232,11 @@ class ParagraphSelector():
     def __init__(self,
                  model_path,
                  tokenizer=None,
-                 encoder_model=None):
+                 encoder_model=None,
+                 num_layers=None,
+                 exit_layers=None,
+                 early_exit_threshold=None,
+                 net=None):
         """
         #TODO update the docstring
         Initialization function for the ParagraphSelector class
@@ -111,68 +245,52 @@ class ParagraphSelector():
                            necessary if we want to load a pretrained
                            model)
         :param tokenizer: a tokenizer, default is BertTokenizer.from_pretrained('bert-base-uncased')
-        :param encoder_model: an encoder model, default is BertModel.from_pretrained('bert-base-uncased')
+        :param encoder_model: an encoder model, default is BertModel.from_pretrained('bert-base-uncased');
+                              if given, it replaces the net's BERT, so that the selector shares
+                              its weights with whoever else uses encoder_model
+        :param num_layers: only use the first num_layers BERT layers (default: all of them)
+        :param exit_layers: list[int] -- BERT layers (counting from 1) that get an additional
+                            classifier for early exits; models that were saved with exit
+                            layers keep them
+        :param early_exit_threshold: if given, stop at the first exit layer at which the
+                                     classifier's confidence (max(score, 1-score)) reaches
+                                     this value; otherwise, always use all layers
+        :param net: an existing ParagraphSelectorNet (e.g., the one inside a DFGN that
+                    shares its BERT with the selector); model_path is ignored in this case
         """
         self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased') if not tokenizer else tokenizer
+        self.early_exit_threshold = early_exit_threshold
+        self.exit_layer = None  # set this to always exit at a certain layer (see benchmark_exits())
+        self.exit_layers_used = []  # logs the exit layers when exiting early
+
+        if net is not None:
+            self.net = net
+            self.config = net.config
+            return
 
-        class ParagraphSelectorNet(BertPreTrainedModel):
-            """
-            A neural network for the paragraph selector.
-            """
-            def __init__(self, config):#, input_size=768, output_size=1):
-                """
-                Initialization of the encoder model and a linear layer
-
-                :param config: config as required by BertPreTrainedModel
-                """
-                super(ParagraphSelectorNet, self).__init__(config)
-                self.bert = BertModel(config)#('bert-base-uncased',
-                                                               #output_hidden_states=True,
-                                                               #output_attentions=True) if not encoder_model else encoder_model
-                self.linear = torch.nn.Linear(config.hidden_size, 1)
-                self.init_weights()
-
-            def forward(self, token_ids):
-                """
-                Forward function of the ParagraphSelectorNet.
-                Takes in token_ids corresponding to a query+paragraph
-                and returns a relevance score (between 0 and 1) for
-                the query and paragraph.
-
-                :param token_ids: token_ids as returned by the tokenizer;
-                                  the text that is passed to the tokenizer
-                                  is constructed by [CLS] + query + [SEP] + paragraph + [SEP]
-                """
-
-                # [-2] is all_hidden_states
-                # [-1] is the last hidden state (list of sentences)
-                # [:,0,:] - we want for all the sentence (:),
-                # only the first token (0) (this is the [CLS token]), 
-                # all its dimensions (:) (768 with bert-base-uncased)
-
-                #with torch.no_grad(): #TODO de-activate this?
-                #embedding = self.bert(token_ids)[-2][-1][:, 0, :] #TODO maybe, this throws errors. in this case, look at Stalin's version below
-
-                outputs = self.bert(token_ids)
-                embedding = outputs[0][:, 0, :]
-
-                output = self.linear(embedding)
-                output = torch.sigmoid(output)
-                return output
-        
         # initialise a paragraph selector net and try to load
         self.config = BertConfig.from_pretrained(model_path)  # , cache_dir=args.cache_dir if args.cache_dir else None,)
+        if num_layers: # BERT only gets the first num_layers layers; the others are not loaded
+            self.config.num_hidden_layers = min(num_layers, self.config.num_hidden_layers)
+        if exit_layers:
+            self.config.exit_layers = sorted(exit_layers)
         self.net = ParagraphSelectorNet.from_pretrained(model_path,
                                                         from_tf=bool(".ckpt" in model_path),
                                                         config=self.config)  # , cache_dir=args.cache_dir if args.cache_dir else None,)
+        if encoder_model is not None: # share the backbone
+            self.net.bert = encoder_model
 
 
     def train(self, train_data, dev_data, model_save_path,
-              epochs=10, batch_size=1, learning_rate=0.0001, eval_interval=None, try_gpu=True):
+              epochs=10, batch_size=1, learning_rate=0.0001, eval_interval=None, try_gpu=True,
+              exits_only=False, checkpoint_dir=None, checkpoint_interval=None,
+              keep_last_checkpoints=2, keep_best_checkpoints=1, resume=False, profiler=None):
         """
         Train a ParagraphSelectorNet on a training dataset.
         Binary Cross Entopy is used as the loss function.
         Adam is used as the optimizer.
+        If the net has exit layers, their classifiers are trained jointly
+        with the final one (the losses of all classifiers are summed up).
 
         :param train_data: a tensor as returned by the make_training_data() function;
                            it has two columns:
@@ -186,6 +304,20 @@ class ParagraphSelector():
         :param batch_size: batch size for the training, default is 1
         :param learning_rate: learning rate for the optimizer,
                               default is 0.0001
+        :param exits_only: if True, only train the exit layers' classifiers
+                           (e.g., to add early exits to a trained model)
+        :param checkpoint_dir: directory for checkpoints (default: 'checkpoints' in model_save_path); they are
+                               saved after each evaluation and every checkpoint_interval batches (see utils.CheckpointManager)
+        :param checkpoint_interval: save a checkpoint every checkpoint_interval batches (None = only at evaluations)
+        :param keep_last_checkpoints: number of most recent checkpoints that are kept
+        :param keep_best_checkpoints: number of checkpoints with the best dev scores that are kept
+        :param resume: True to continue from the latest checkpoint in checkpoint_dir, or the path of a checkpoint
+        :param profiler: a utils.Profiler for timing the training stages (optional)
+
+        The model is saved to model_save_path at the end of training, with the weights of the best evaluation.
+        If the process is part of a data-parallel run (see utils.init_distributed()),
+        each process trains on its own share of train_data and the gradients are
+        averaged over all processes; only rank 0 evaluates and saves the model.
 
         :return losses: a list of losses
         :return dev_scores: a list of tuples (evaluation step, p, r, f1, acc.)
@@ -193,7 +325,12 @@ class ParagraphSelector():
         # Use Binary Cross Entropy as a loss function instead of MSE
         # There are papers on why MSE is bad for classification
         criterion = torch.nn.BCELoss()
-        optimizer = torch.optim.Adam(self.net.parameters(), lr=learning_rate)
+        if exits_only:
+            for param in self.net.parameters():
+                param.requires_grad = False
+            for param in self.net.exit_heads.parameters():
+                param.requires_grad = True
+        optimizer = torch.optim.Adam([p for p in self.net.parameters() if p.requires_grad], lr=learning_rate)
 
         losses = []
         dev_scores = []
@@ -209,21 +346,52 @@ class ParagraphSelector():
         if cuda_is_available:
             self.net = self.net.to(device)
 
+        rank, world_size = utils.distributed_rank(), utils.distributed_world_size()
+        utils.broadcast_parameters(self.net) # all processes start with the same weights
+
         print("Training...")
 
         # (120, 250) --> batching --> (30, 4, 250)
-        train_data = torch.utils.data.DataLoader(dataset = train_data, batch_size = batch_size, shuffle=True)
+        # the order of the data only depends on shuffle_seed and the epoch, so that training can be resumed
+        shuffle_seed = int(torch.randint(2**31, (1,)))
+        generator = torch.Generator()
+        sampler = torch.utils.data.distributed.DistributedSampler(train_data, shuffle=True) if world_size > 1 \
+                  else torch.utils.data.RandomSampler(train_data, generator=generator)
+        sampler = utils.ResumableSampler(sampler)
+        train_data = torch.utils.data.DataLoader(dataset = train_data, batch_size = batch_size, sampler=sampler)
 
         c = 0  # counter over taining examples
         high_score = 0
         eval_interval = eval_interval if eval_interval else float('inf')
         batched_interval = round(eval_interval/batch_size) # number of batches needed to reach eval_interval
-        a_model_was_saved_at_some_point = False
 
-        for epoch in range(epochs):
+        # checkpoints are saved by rank 0, but all processes resume from them
+        checkpoints = utils.CheckpointManager(checkpoint_dir if checkpoint_dir else
+                                              os.path.join(model_save_path, "checkpoints"),
+                                              keep_last=keep_last_checkpoints,
+                                              keep_best=keep_best_checkpoints)
+        start_epoch, skipped_batches = 0, 0 # position in the training data
+        resume_path = resume if isinstance(resume, str) else (checkpoints.latest() if resume else None)
+        if resume_path:
+            print(f"Resuming training from {resume_path}...")
+            state = checkpoints.load(resume_path, map_location=device)
+            self.net.load_state_dict(state["model"])
+            optimizer.load_state_dict(state["optimizer"])
+            utils.set_rng_states(state["rng"])
+            shuffle_seed, c, high_score = state["shuffle_seed"], state["step"], state["high_score"]
+            start_epoch, skipped_batches = state["position"]
+            losses, dev_scores = state["losses"], state["dev_scores"]
+
+        for epoch in range(start_epoch, epochs):
             print('Epoch %d/%d' % (epoch + 1, epochs))
-
-            for step, batch in enumerate(tqdm(train_data, desc="Iteration")):
+            skipped = skipped_batches if epoch == start_epoch else 0 # batches that were trained on before resuming
+            sampler.skip = skipped * batch_size
+            generator.manual_seed(shuffle_seed + epoch) # a different shuffle in each epoch
+            if world_size > 1:
+                sampler.sampler.set_epoch(epoch)
+
+            batches = profiler.iterate(train_data, "data_loading") if profiler is not None else train_data
+            for step, batch in enumerate(tqdm(batches, total=len(train_data), desc="Iteration")):
                 batch = [t.to(device) if t is not None else None for t in batch]
                 inputs, labels = batch
                 #weight_tensor = torch.Tensor([WEIGHTS[int(label)] for label in labels]).to(device) #CLEANUP?
@@ -232,36 +400,71 @@ class ParagraphSelector():
 
                 optimizer.zero_grad()
 
-                outputs = self.net(inputs).squeeze(1) #TODO why squeeze(1)?
-                loss = criterion(outputs, labels)
-                loss.backward(retain_graph=True)
-                losses.append(loss.item())
+                with utils.profile(profiler, "forward"):
+                    if self.net.exit_heads:
+                        outputs = self.net(inputs, all_exits=True) # one output per exit layer, plus the final one
+                        if exits_only:
+                            outputs = outputs[:-1]
+                        loss = sum([criterion(o.squeeze(1), labels) for o in outputs])
+                    else:
+                        outputs = self.net(inputs).squeeze(1) #TODO why squeeze(1)?
+                        loss = criterion(outputs, labels)
+                with utils.profile(profiler, "backward"):
+                    loss.backward(retain_graph=True)
+                with utils.profile(profiler, "all_reduce"):
+                    utils.all_reduce_gradients(self.net, average=True)
+                    losses.append(utils.all_reduce_tensor(loss.detach().clone()).item() / world_size)
+
+                with utils.profile(profiler, "optimizer"):
+                    optimizer.step()
+                if profiler is not None:
+                    profiler.count("paragraphs", labels.shape[0])
 
                 c +=1
+                measure = None
                 # Evaluate on validation set after some iterations
-                if c % batched_interval == 0:
-                    p, r, f1, accuracy, _, _, _ = self.evaluate(dev_data, try_gpu=try_gpu)
+                if c % batched_interval == 0 and rank != 0:
+                    utils.barrier() # wait for rank 0's evaluation
+                elif c % batched_interval == 0:
+                    with utils.profile(profiler, "evaluation"):
+                        p, r, f1, accuracy, _, _, _ = self.evaluate(dev_data, try_gpu=try_gpu)
+                    self.net.train() # evaluate() switches to eval mode
                     dev_scores.append((c/batched_interval, p, r, f1, accuracy))
 
                     measure = f1
                     if measure > high_score:
                         print(f"Better eval found with score {round(measure ,3)} (+{round(measure-high_score, 3)})")
                         high_score = measure
-                        self.net.save_pretrained(model_save_path)
-                        a_model_was_saved_at_some_point = True
                     else:
                         print(f"No improvement yet...")
-
-
-
-                optimizer.step()
-
-        if not a_model_was_saved_at_some_point: # make sure that there is a model file
+                    utils.barrier()
+
+                # checkpoints after evaluations (with their score) and every checkpoint_interval batches
+                if rank == 0 and (c % batched_interval == 0 or (checkpoint_interval and c % checkpoint_interval == 0)):
+                    end_of_epoch = step + 1 == len(train_data)
+                    with utils.profile(profiler, "checkpoint"): # copying the state; it is written in the background
+                        checkpoints.save(c,
+                                         {"model": self.net.state_dict(),
+                                          "optimizer": optimizer.state_dict(),
+                                          "rng": utils.rng_states(),
+                                          "shuffle_seed": shuffle_seed,
+                                          "step": c,
+                                          "position": (epoch + 1, 0) if end_of_epoch else (epoch, skipped + step + 1),
+                                          "high_score": high_score,
+                                          "losses": losses,
+                                          "dev_scores": dev_scores},
+                                         score=measure)
+
+        if rank == 0:
+            if checkpoints.best(): # the weights of the best evaluation
+                self.net.load_state_dict(checkpoints.load(checkpoints.best(), map_location=device)["model"])
             self.net.save_pretrained(model_save_path)
+        checkpoints.wait()
+        utils.barrier()
 
         return losses, dev_scores
     
-    def evaluate(self, data, threshold=0.1, text_length=512, try_gpu=True):
+    def evaluate(self, data, threshold=0.1, text_length=512, try_gpu=True, profiler=None):
         """
         Evaluate a trained model on a dataset.
         True labels on the evaluation datapoints are made in this function as well.
@@ -286,6 +489,7 @@ class ParagraphSelector():
                             and trimmed if it is more, default is 512
         :param try_gpu: boolean specifying whether to use GPU for
                         computation if GPU is available; default is True
+        :param profiler: a utils.Profiler for timing the selection of each point (optional)
 
         :return precision: precision for the model
         :return recall: recall for the model
@@ -315,11 +519,15 @@ class ParagraphSelector():
         self.net = self.net.to(device)
 
         for point in tqdm(data, desc="eval points"):
-            context, c_indices = self.make_context(point, #point[2] are the paragraphs, point[1] is the query
-                                                   threshold=threshold,
-                                                   text_length=text_length,
-                                                   device=device,
-                                                   numerated=True) # returns original paragraph numbers
+            with utils.profile(profiler, "selection"):
+                context, c_indices = self.make_context(point, #point[2] are the paragraphs, point[1] is the query
+                                                       threshold=threshold,
+                                                       text_length=text_length,
+                                                       device=device,
+                                                       numerated=True) # returns original paragraph numbers
+            if profiler is not None:
+                profiler.count("questions")
+                profiler.count("selected_paragraphs", len(c_indices))
             para_true = []
             para_pred = []
             for i, para in enumerate(point[3]): # iterate over all 10 paragraphs
@@ -340,6 +548,43 @@ class ParagraphSelector():
         
         return precision, recall, f1, acc, ids, all_true, all_pred
     
+    def benchmark_exits(self, data, threshold=0.1, text_length=512, try_gpu=True, exit_thresholds=()):
+        """
+        Evaluate the model once per exit layer (always exiting at that layer)
+        and once per early exit threshold, and take the time per data point.
+        This maps exit layers to scores and latencies in order to choose
+        operating points.
+
+        :param data: list of datapoints (see evaluate())
+        :param threshold: relevance threshold for the paragraphs (see evaluate())
+        :param text_length: see evaluate()
+        :param try_gpu: see evaluate()
+        :param exit_thresholds: list[float] -- confidence thresholds for early exits
+        :return: list of tuples (mode, value, avg. exit layer, p, r, f1, acc., seconds per data point)
+                 where mode is either 'layer' (value = exit layer) or 'threshold' (value = confidence threshold)
+        """
+        n_layers = self.net.config.num_hidden_layers
+        settings = [("layer", l) for l in sorted(int(l) for l in self.net.exit_heads)] + [("layer", n_layers)] \
+                 + [("threshold", t) for t in exit_thresholds]
+        original_settings = (self.exit_layer, self.early_exit_threshold)
+
+        results = []
+        for mode, value in settings:
+            self.exit_layer = value if mode == "layer" else None
+            self.early_exit_threshold = value if mode == "threshold" else None
+            self.exit_layers_used = []
+
+            t0 = time()
+            p, r, f1, acc, _, _, _ = self.evaluate(data, threshold=threshold,
+                                                   text_length=text_length,
+                                                   try_gpu=try_gpu)
+            seconds = (time() - t0) / max(len(data), 1)
+            avg_layer = sum(self.exit_layers_used) / max(len(self.exit_layers_used), 1)
+            results.append((mode, value, avg_layer, p, r, f1, acc, seconds))
+
+        self.exit_layer, self.early_exit_threshold = original_settings
+        return results
+
     def predict(self, p, device=torch.device('cpu')):
         """
         Given the token_ids of a query+paragraph for a specific paragraph,
@@ -361,13 +606,46 @@ class ParagraphSelector():
         #self.net.eval() #CLEANUP?
 
         p = p.to(device)
-        score = self.net(p)
+        if self.exit_layer or self.early_exit_threshold:
+            score = self.net(p, exit_layer=self.exit_layer, exit_threshold=self.early_exit_threshold)
+            self.exit_layers_used.append(self.net.last_exit_layer)
+        else:
+            score = self.net(p)
         return score
+
+    def predict_packed(self, token_id_lists, device=torch.device('cpu'), window=512):
+        """
+        Like predict(), but for many query+paragraph sequences at once.
+        The sequences are packed into as few BERT windows as possible
+        (see utils.pack_sequences()), which saves the computation spent
+        on padding.
+
+        :param token_id_lists: list[list[int]] -- token_ids as returned by the tokenizer,
+                               without padding; each one is [CLS] + query + [SEP] + paragraph + [SEP]
+        :param device: device for processing; default is 'cpu'
+        :param window: length of a packed sequence; at most 512
+        :return: Tensor of shape (len(token_id_lists), 1) -- one score between 0 and 1 per sequence
+        """
+        sequences = [torch.tensor(t, device=device) for t in token_id_lists]
+        token_ids, attention_mask, position_ids, layout = pack_sequences(sequences,
+                                                                         window=min(window, 512),
+                                                                         pad_token_id=self.tokenizer.pad_token_id)
+        cls_positions = (torch.tensor([b for b, _, _ in layout], device=device),
+                         torch.tensor([offset for _, offset, _ in layout], device=device))
+        scores = self.net(token_ids,
+                          attention_mask=attention_mask,
+                          position_ids=position_ids,
+                          cls_positions=cls_positions,
+                          exit_layer=self.exit_layer,
+                          exit_threshold=self.early_exit_threshold)
+        if self.exit_layer or self.early_exit_threshold:
+            self.exit_layers_used.append(self.net.last_exit_layer)
+        return scores
     
     def make_context(self, datapoint, threshold=0.1,
                      context_length=512, text_length=512,
                      device=torch.device('cpu'),
-                     numerated=False):
+                     numerated=False, packed=False):
         """
         Given a datapoint from HotPotQA, build the context for it.
         The context consists of all paragraphs included in that
@@ -393,6 +671,8 @@ class ParagraphSelector():
                             The trimming happens by paragraph, so that all
                             paragraphs in the context are of equal length (text_length / num_paragraphs)
         :param device: device for processing; default is 'cpu'
+        :param packed: if True, all paragraphs are scored in packed sequences
+                       (see predict_packed()) instead of one padded sequence each
 
         :return context: the context for the datapoint
                 shape: [ [[p1_title], [p1_s1, p1_s2, ...]],
@@ -422,6 +702,7 @@ class ParagraphSelector():
         #print(f"\nin ParagraphSelector.make_context():") #CLEANUP
         #print(f"id: {datapoint[0]}") #CLEANUP
 
+        encoded_paragraphs = []  # list[ (list[int], list[list[int]], list[int]) ]
         for i, p in enumerate(datapoint[3]):
             header_token_ids = self.tokenizer.encode(p[0],
                                                    max_length=512, # to avoid warnings
@@ -437,17 +718,28 @@ class ParagraphSelector():
                       + [token for sent in sentence_token_ids for token in sent]
             token_ids[-1] = self.tokenizer.sep_token_id  # make sure that it ends with a SEP
 
-            # Add padding if there are fewer than text_length tokens,
-            if len(token_ids) < text_length:
-                token_ids += [self.tokenizer.pad_token_id for _ in range(text_length - len(token_ids))]
-            else: # else trim to text_length
+            # trim to text_length
+            if len(token_ids) > text_length:
                 token_ids = token_ids[:text_length]
                 token_ids[-1] = self.tokenizer.sep_token_id  # make sure that it still ends with a SEP
 
-            # do the actual prediction & decision
-            encoded_p = torch.tensor([token_ids])
-            #print(f"in ParagraphSelector.make_context: shape of encoded_p: {encoded_p.shape}") #CLEANUP
-            score = self.predict(encoded_p, device=device)
+            encoded_paragraphs.append((header_token_ids, sentence_token_ids, token_ids))
+
+        # do the actual prediction
+        if packed:
+            scores = self.predict_packed([token_ids for _, _, token_ids in encoded_paragraphs],
+                                         device=device)
+        else:
+            scores = []
+            for _, _, token_ids in encoded_paragraphs:
+                # Add padding if there are fewer than text_length tokens,
+                token_ids = token_ids + [self.tokenizer.pad_token_id for _ in range(text_length - len(token_ids))]
+                encoded_p = torch.tensor([token_ids])
+                #print(f"in ParagraphSelector.make_context: shape of encoded_p: {encoded_p.shape}") #CLEANUP
+                scores.append(self.predict(encoded_p, device=device))
+
+        # decide which paragraphs make it into the context
+        for i, ((header_token_ids, sentence_token_ids, _), score) in enumerate(zip(encoded_paragraphs, scores)):
             if score > threshold:
                 # list[list[int], list[list[int]]]
                 # no [CLS] or [SEP] here
@@ -73,4 +73,110 @@ class Predictor(nn.Module):
                  end_scores.squeeze(-1), \
                  type_scores) #TODO? .squeeze(-1) ?
 
-        return result  # ( (M), (M), (M), (1,3) )
\ No newline at end of file
+        return result  # ( (M), (M), (M), (1,3) )
+
+    def forward_batch(self, context_embs, lengths, skip_padding=True):
+        """
+        Like forward(), but for a batch of padded context embeddings.
+        The LSTMs see each token as a sequence of length 1 (like in forward()),
+        so only the real tokens of all contexts are gathered and passed through them,
+        and their outputs are the same as in forward(). Padding tokens get start and
+        end scores of 0, supporting fact scores of 0, and don't count for the answer type.
+
+        :param context_embs: (B, M, d2) context embeddings as produced by FusionBlock.forward_batch()
+        :param lengths: list[int] or Tensor of shape (B) -- number of real (non-padding) tokens of each context
+        :param skip_padding: if False, padding tokens go through the LSTMs as well (the results are
+                             the same; this keeps all shapes fixed, e.g. for compiled models)
+        :return result: a 4-tuple ( (B, M, 2), (B, M), (B, M), (B, 3) ), containing the
+                        supporting fact, start, end and answer type scores of each context
+        """
+        B, M, d2 = context_embs.shape
+        lengths = torch.as_tensor(lengths, device=context_embs.device) # (B)
+        mask = torch.arange(M, device=context_embs.device).unsqueeze(0) < lengths.unsqueeze(1) # (B, M)
+        if not skip_padding:
+            mask = torch.ones_like(mask)
+        batch_index = mask.nonzero(as_tuple=True)[0] # (K) data point of each token that is processed
+
+        Ct = context_embs[mask].unsqueeze(0) # (1, K, d2)
+
+        o_sup, hidden_o_sup = self.f0(Ct)
+        o_start, hidden_o_start = self.f1(torch.cat((Ct, o_sup), dim=-1))
+        o_end, hidden_o_end = self.f2(torch.cat((Ct, o_sup, o_start), dim=-1))
+        o_type, hidden_o_type = self.f3(torch.cat((Ct, o_sup, o_end), dim=-1)) # all: (1, K, d2)
+
+        # the score tensors get the dtype of the layers' outputs (which can differ from the input's with autocast)
+        sups = self.linear_sup(o_sup).squeeze(0)
+        sup_scores = sups.new_zeros((B, M, 2))
+        sup_scores[mask] = sups
+
+        # padding tokens are left out of the softmax
+        starts = self.linear_start(o_start).view(-1)
+        start_scores = starts.new_full((B, M), torch.finfo(starts.dtype).min)
+        start_scores[mask] = starts
+        ends = self.linear_end(o_end).view(-1)
+        end_scores = ends.new_full((B, M), torch.finfo(ends.dtype).min)
+        end_scores[mask] = ends
+
+        if not skip_padding: # remove the padding tokens now
+            mask = torch.arange(M, device=context_embs.device).unsqueeze(0) < lengths.unsqueeze(1) # (B, M)
+            sup_scores = sup_scores * mask.unsqueeze(-1)
+            start_scores = start_scores.masked_fill(~mask, torch.finfo(start_scores.dtype).min)
+            end_scores = end_scores.masked_fill(~mask, torch.finfo(end_scores.dtype).min)
+            o_type = o_type * mask.view(1, -1, 1)
+
+        # mean pooling over each context's real tokens: (K, d2) -> (B, d2)
+        o_type = o_type.new_zeros((B, d2)).index_add(0, batch_index, o_type.squeeze(0))
+        o_type = o_type / lengths.clamp(min=1).unsqueeze(1).to(o_type.dtype)
+
+        return sup_scores, \
+               torch.softmax(start_scores, 1), \
+               torch.softmax(end_scores, 1), \
+               self.linear_type(o_type)  # ( (B, M, 2), (B, M), (B, M), (B, 3) )
+
+def decode_spans(start_scores, end_scores, max_answer_length=30, top_k=1):
+    """
+    Find the best answer spans (start <= end < start + max_answer_length) for a
+    batch of data points by scoring all valid (start, end) pairs at once.
+
+    :param start_scores: (B, M) start probabilities as returned by the Predictor
+    :param end_scores: (B, M) end probabilities as returned by the Predictor
+    :param max_answer_length: maximum number of tokens of an answer
+    :param top_k: number of spans per data point
+    :return starts: (B, k) start positions of the best spans (best first)
+    :return ends: (B, k) end positions of the best spans
+    :return scores: (B, k) scores (start probability * end probability) of the best spans
+    """
+    B, M = start_scores.shape
+    span_scores = start_scores.unsqueeze(2) * end_scores.unsqueeze(1) # (B, M, M): [b, start, end]
+
+    # upper triangular band: end >= start and end - start < max_answer_length
+    ones = torch.ones((M, M), dtype=torch.bool, device=start_scores.device)
+    valid = torch.triu(ones) & ~torch.triu(ones, diagonal=max_answer_length)
+    span_scores = span_scores.masked_fill(~valid, -1) # probabilities are >= 0
+
+    scores, indices = span_scores.view(B, -1).topk(min(top_k, M * M), dim=1) # (B, k)
+    return indices // M, indices % M, scores
+
+def supporting_sentences(sup_scores, sentence_lengths):
+    """
+    Decide for each sentence whether it is a supporting fact: a sentence is
+    supporting if the majority of its tokens is classified as supporting.
+    Sentences (or their parts) beyond the end of the context are not counted.
+
+    :param sup_scores: (M, 2) supporting fact scores as returned by the Predictor
+    :param sentence_lengths: list[int] -- number of tokens of each sentence, in order
+    :return: Tensor[bool] of shape (#sentences) -- True for supporting sentences
+    """
+    M = sup_scores.shape[0]
+    device = sup_scores.device
+    n_sentences = len(sentence_lengths)
+
+    # sentence number of each token (precomputed boundaries, cut to M tokens)
+    sentence_index = torch.repeat_interleave(torch.arange(n_sentences, device=device),
+                                             torch.tensor(sentence_lengths, dtype=torch.long, device=device))[:M]
+    is_supporting = (sup_scores[:sentence_index.shape[0]].argmax(dim=-1) == 1).float() # (tokens)
+
+    votes = torch.zeros(n_sentences, device=device).index_add(0, sentence_index, is_supporting)
+    n_tokens = torch.zeros(n_sentences, device=device).index_add(0, sentence_index, torch.ones_like(is_supporting))
+
+    return votes > 0.5 * n_tokens.clamp(min=1) # (#sentences)
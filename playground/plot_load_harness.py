@@ -0,0 +1,35 @@
+"""
+This script plots end-to-end latency percentiles against throughput for the
+runs of a load test (the .load.csv written by benchmarks/load_harness.py).
+Runs with the same pipeline settings make one line per percentile.
+"""
+
+import csv
+import matplotlib.pyplot as plt
+
+project_dir = "/home/simon/Desktop/LCT_Saarbrücken/Courses/AQA/project_AQA/"
+outputs_dir = "models/outputs/"
+filepath = project_dir + outputs_dir + "DFGN_final.load.csv"
+settings = ["text_length", "fb_passes", "ps_threshold", "batch_size"]
+
+
+with open(filepath, "r") as f:
+    runs = list(csv.DictReader(f))
+
+lines = {} # {settings: [(throughput, p50, p95, p99)]}
+for run in runs:
+    key = ", ".join([f"{s}={run[s]}" for s in settings])
+    lines.setdefault(key, []).append([float(run[c]) for c in ["throughput_qps", "latency_p50_ms",
+                                                               "latency_p95_ms", "latency_p99_ms"]])
+
+for key, points in lines.items():
+    throughput, p50, p95, p99 = list(zip(*sorted(points)))
+    line = plt.plot(throughput, p50, marker="o", label=key + " (p50)")
+    plt.plot(throughput, p99, marker="x", linestyle="--", color=line[0].get_color(), label=key + " (p99)")
+plt.legend(fontsize="small")
+plt.xlabel('throughput (questions per second)')
+plt.ylabel('latency (ms)')
+plt.show()
+#print("Saving plot as", filename, "...")
+#plt.savefig(filename)
+#plt.close()
@@ -5,25 +5,38 @@ This is supposed to do the whole job!
 
 import os, sys, argparse
 import pickle  # mainly for training data
+import random
+import itertools
 import torch
 import json
 from tqdm import tqdm
 from sklearn.model_selection import train_test_split
 from transformers import BertTokenizer
 
-import hotpot_evaluate_v1 as official_eval_script
 import flair  # for NER in the EntityGraph
 from modules import ParagraphSelector, EntityGraph, Encoder, FusionBlock, Predictor
 import utils
+import featurize
 
 
 class DFGN(torch.nn.Module):  # TODO extract this to a separate module
     # TODO? implement loading of a previously trained DFGN model (for final evaluation!) ?
     def __init__(self, text_length, emb_size, device=torch.device('cpu'),
-                 fb_dropout=0.5, predictor_dropout=0.3):
+                 fb_dropout=0.5, predictor_dropout=0.3, encoder_model=None, encoder_layers=None,
+                 selector_net=None):
         # TODO docstring
+        # selector_net: a ParagraphSelectorNet whose BERT is shared with the Encoder;
+        #               it becomes part of the DFGN (and is saved together with it)
         super(DFGN, self).__init__()  # TODO pass the device to the Encoder and the Predictor as well?
-        self.encoder = Encoder.Encoder(text_length=text_length)
+        if selector_net is not None:
+            if encoder_layers:
+                raise ValueError("encoder_layers can't be used with a shared BERT (selector_net); "
+                                 "set the selector's number of layers instead")
+            self.selector = selector_net
+            encoder_model = selector_net.bert
+        self.encoder = Encoder.Encoder(text_length=text_length,
+                                       encoder_model=encoder_model,
+                                       num_layers=encoder_layers)
         self.fusionblock = FusionBlock.FusionBlock(emb_size, device=device, dropout=fb_dropout)  # TODO sort out init
         self.predictor = Predictor.Predictor(text_length, emb_size, dropout=predictor_dropout)  # TODO sort out init
 
@@ -38,6 +51,9 @@ class DFGN(torch.nn.Module):  # TODO extract this to a separate module
         :return: outputs as produced by the Predictor's forward function
         """
 
+        if graph.A is not None:
+            return self.forward_tensors(query_ids, context_ids, *graph.tensors(), fb_passes=fb_passes)
+
         # forward through encoder
         q_emb = self.encoder(context_ids, query_ids)
         c_emb = self.encoder(query_ids, context_ids)
@@ -50,6 +66,357 @@ class DFGN(torch.nn.Module):  # TODO extract this to a separate module
 
         return outputs
 
+    def forward_tensors(self, query_ids, context_ids, bin_M, adjacency, node_mask, fb_passes=1):
+        """
+        Like forward(), but all inputs are tensors (no EntityGraph object), so
+        that the DFGN can be traced and exported (see export_dfgn.py).
+        EntityGraph.tensors() makes the graph inputs.
+
+        :param query_ids: (L) Tensor[int] -- token IDs from Encoder.tokenizer
+        :param context_ids: (M) Tensor[int] -- token IDs from Encoder.tokenizer
+        :param bin_M: (M, N) binary matrix that maps tokens to entities
+        :param adjacency: (N, N) adjacency matrix of the entity graph; relation types are not used
+                          (the fusion block's graph attention doesn't distinguish between them)
+        :param node_mask: (N) Tensor[bool] -- False for padding nodes
+        :param fb_passes: number of passes through the fusion block
+        :return: outputs as produced by the Predictor's forward function
+        """
+        q_emb = self.encoder(context_ids, query_ids) # (L, d2)
+        c_emb = self.encoder(query_ids, context_ids) # (M, d2)
+
+        Ct = self.fusionblock.forward_batch(c_emb.unsqueeze(0), q_emb.unsqueeze(0),
+                                            bin_M.unsqueeze(0), adjacency.unsqueeze(0), node_mask.unsqueeze(0),
+                                            passes=fb_passes).squeeze(0) # (M, d2)
+
+        return self.predictor(Ct)  # ( (M), (M), (M), (1, 3) )
+
+    def forward_batch(self, query_ids_list, context_ids_list, graphs, fb_passes, packed=False, window=512,
+                      bucket_size=None, fb_tolerance=None, fast_path=None, profiler=None):
+        """
+        Do forward passes for multiple data points. With 'packed', all queries
+        and contexts of the batch are encoded in as few BERT calls as possible
+        (see Encoder.forward_packed()). The fusion block processes the data points
+        in buckets of similarly-sized graphs (see FusionBlock.forward_batch()).
+
+        :param query_ids_list: list[Tensor[int]] -- token IDs from Encoder.tokenizer
+        :param context_ids_list: list[Tensor[int]] -- token IDs from Encoder.tokenizer
+        :param graphs: list[EntityGraph]
+        :param fb_passes: number of passes through the fusion block
+        :param packed: if True, pack the encoder's inputs into windows of 'window' tokens
+        :param window: length of a packed sequence; at most 512
+        :param bucket_size: maximum number of data points per fusion block batch (default: all of them)
+        :param fb_tolerance: if given, fb_passes is the maximum number of passes, and the fusion block stops
+                             early for data points that converged (see FusionBlock.forward()); the numbers
+                             of passes are kept in self.last_fb_passes
+        :param fast_path: a FastPath.FastPath object for compiled inference of fusion block and predictor
+                          (only used for dense graphs and without fb_tolerance)
+        :param profiler: a utils.Profiler for timing encoder, fusion block and predictor (optional);
+                         with fast_path, fusion block and predictor are timed together as 'fusion+predict'
+        :return: list of outputs as produced by the Predictor's forward function (one per data point)
+        """
+        # same argument order as in forward(): the query is encoded with BiDAF over the context and vice versa
+        with utils.profile(profiler, "encode"):
+            if packed:
+                embs = self.encoder.forward_packed(list(context_ids_list) + list(query_ids_list),
+                                                   list(query_ids_list) + list(context_ids_list),
+                                                   window=window)
+                q_embs, c_embs = embs[:len(graphs)], embs[len(graphs):]
+            else:
+                q_embs = [self.encoder(c, q) for q, c in zip(query_ids_list, context_ids_list)]
+                c_embs = [self.encoder(q, c) for q, c in zip(query_ids_list, context_ids_list)]
+
+        # number of real (non-padding) context tokens
+        lengths = [min(self.encoder.unpadded_length(c), c_emb.shape[0]) for c, c_emb in zip(context_ids_list, c_embs)]
+
+        self.last_fb_passes = [fb_passes for _ in graphs]
+        dense = not (graphs and graphs[0].A is None) # sparse graphs are processed one at a time
+        if dense and fast_path is not None and fb_tolerance is None: # fusion block and predictor in one compiled call
+            with utils.profile(profiler, "fusion+predict"):
+                outputs = [None for _ in graphs]
+                for bucket in EntityGraph.size_buckets(graphs, bucket_size if bucket_size else len(graphs)):
+                    query_embs, query_mask = utils.pad_with_mask([q_embs[i] for i in bucket])     # (B, L, d2)
+                    context_embs, _ = utils.pad_with_mask([c_embs[i] for i in bucket]) # (B, M, d2)
+                    bin_M, adjacency, node_mask = EntityGraph.pad_graphs([graphs[i] for i in bucket])
+                    bucket_lengths = torch.tensor([lengths[i] for i in bucket], device=context_embs.device)
+
+                    sups, starts, ends, types = fast_path(context_embs, query_embs, query_mask,
+                                                          bin_M, adjacency, node_mask, bucket_lengths)
+                    for j, i in enumerate(bucket):
+                        M = c_embs[i].shape[0]
+                        outputs[i] = (sups[j, :M], starts[j:j+1, :M], ends[j:j+1, :M], types[j:j+1])
+            return outputs
+
+        with utils.profile(profiler, "fusion"):
+            if not dense:
+                Cts = []
+                for i, (q_emb, c_emb, graph) in enumerate(zip(q_embs, c_embs, graphs)):
+                    Cts.append(self.fusionblock(c_emb, q_emb, graph, passes=fb_passes, tolerance=fb_tolerance))
+                    self.last_fb_passes[i] = self.fusionblock.last_passes
+            else:
+                Cts = [None for _ in graphs]
+                for bucket in EntityGraph.size_buckets(graphs, bucket_size if bucket_size else len(graphs)):
+                    query_embs, query_mask = utils.pad_with_mask([q_embs[i] for i in bucket])     # (B, L, d2)
+                    context_embs, _ = utils.pad_with_mask([c_embs[i] for i in bucket]) # (B, M, d2)
+                    context_mask = torch.arange(context_embs.shape[1], device=context_embs.device).unsqueeze(0) < \
+                                   torch.tensor([lengths[i] for i in bucket], device=context_embs.device).unsqueeze(1)
+                    bin_M, adjacency, node_mask = EntityGraph.pad_graphs([graphs[i] for i in bucket])
+
+                    Ct_batch = self.fusionblock.forward_batch(context_embs, query_embs, bin_M, adjacency, node_mask,
+                                                              query_mask=query_mask,
+                                                              context_mask=context_mask,
+                                                              passes=fb_passes,
+                                                              tolerance=fb_tolerance)  # (B, M, d2)
+                    for i, Ct, n_passes in zip(bucket, Ct_batch, self.fusionblock.last_passes.tolist()):
+                        Cts[i] = Ct[:c_embs[i].shape[0]]
+                        self.last_fb_passes[i] = n_passes
+
+        # the predictor only processes the real tokens of the whole batch
+        with utils.profile(profiler, "predict"):
+            context_embs, _ = utils.pad_with_mask(Cts) # (batch, M, d2)
+            sups, starts, ends, types = self.predictor.forward_batch(context_embs, lengths)
+
+        return [(sups[i, :Ct.shape[0]],           # (M, 2)
+                 starts[i:i+1, :Ct.shape[0]],     # (1, M)
+                 ends[i:i+1, :Ct.shape[0]],       # (1, M)
+                 types[i:i+1])                    # (1, 3)
+                for i, Ct in enumerate(Cts)]
+
+def prepare_batch(batch, para_selector, ner_tagger, encoder, tokenizer,
+                  ps_threshold=0.1, text_length=250, pack_sequences=False, max_nodes=40, sparse_graphs=False):
+    """
+    Turn a batch of raw points into the inputs and labels of a DFGN:
+    select paragraphs, build entity graphs, tokenize, and make labels.
+    Points for which the NER doesn't find any entities are left out.
+
+    :param batch: list of raw points as returned by HotPotDataHandler.data_for_paragraph_selector()
+    :param para_selector: a ParagraphSelector object
+    :param ner_tagger: NER tagger passed on to EntityGraph
+    :param encoder: an Encoder object (used for tokenization)
+    :param tokenizer: tokenizer used for making the labels
+    :param ps_threshold: threshold for the paragraph selector (relevance score between paragraph and query)
+    :param text_length: limit the context's number of tokens (used in ParagraphSelector and EntityGraph)
+    :param pack_sequences: if True, the paragraph selector scores paragraphs in packed sequences
+    :param max_nodes: maximum number of nodes per entity graph
+    :param sparse_graphs: if True, entity graphs only have edge lists (see FusionBlock.graph_attention_sparse())
+    :return ids: list[str] -- IDs of the usable points
+    :return q_ids_list: list[Tensor[int]] -- query token IDs
+    :return c_ids_list: list[Tensor[int]] -- context token IDs
+    :return graphs: list[EntityGraph]
+    :return labels: (Tensor, Tensor, Tensor, Tensor) -- supporting fact, start, end and type labels,
+                    of shapes (batch, M), (batch, 1), (batch, 1), (batch, 1)
+    :return n_useless: int -- number of points that were left out
+    """
+    ids = []
+    queries = []
+    contexts = []
+    graphs = []
+    points = []
+
+    ps_device = next(para_selector.net.parameters()).device
+    was_training = para_selector.net.training # a selector that shares its BERT with the DFGN is in train mode
+    para_selector.net.eval() # no dropout, so that contexts are the same as in evaluation
+    for point in batch:
+        # make a list[ list[str, list[str]] ] for each point in the batch
+        with torch.no_grad(): # the selection itself is not trained
+            context = para_selector.make_context(point,
+                                                 threshold=ps_threshold,
+                                                 context_length=text_length,
+                                                 device=ps_device,
+                                                 packed=pack_sequences)
+        graph = EntityGraph.EntityGraph(context,
+                                        context_length=text_length,
+                                        tagger=ner_tagger,
+                                        max_nodes=max_nodes,
+                                        sparse=sparse_graphs)
+        if graph.graph:
+            ids.append(point[0])
+            queries.append(point[2])
+            contexts.append(context)
+            graphs.append(graph)
+            points.append(point)
+        # else: if the NER in EntityGraph doesn't find entities, the datapoint is useless.
+    para_selector.net.train(was_training)
+
+    n_useless = len(batch) - len(ids)
+    if not ids:
+        return ids, [], [], [], None, n_useless
+
+    # turn the texts into tensors in order to put them on the GPU
+    qc_ids = [encoder.token_ids(q, c) for q, c in zip(queries, contexts)] # list[ (list[int], list[int]) ]
+    q_ids, c_ids = list(zip(*qc_ids)) # tuple(list[int]), tuple(list[int])
+    q_ids_list = [torch.tensor(q) for q in q_ids] # list[Tensor] #TODO? maybe put this into forward()?
+    c_ids_list = [torch.tensor(c) for c in c_ids] # list[Tensor]
+
+    """ MAKE TRAINING LABELS """
+    # TODO? change utils.make_labeled_data_for_predictor() to process batches of data?
+    labels = [utils.make_labeled_data_for_predictor(g,p,tokenizer) for g,p in zip(graphs, points)]  # list[(support, start, end, type)]
+    # list[(Tensor, Tensor, Tensor, Tensor)] -> (batch, M), (batch, 1), (batch, 1), (batch, 1)
+    labels = tuple(torch.stack(l) for l in zip(*labels))
+
+    return ids, q_ids_list, c_ids_list, graphs, labels, n_useless
+
+def loss_totals(labels_list, device=torch.device('cpu'), distributed=False):
+    """
+    Statistics of a whole (effective) batch that compute_losses() needs in order to
+    compute the batch's loss exactly when the batch is split into micro-batches
+    (for gradient accumulation). With 'distributed', the statistics are summed over
+    all processes, so that the batch consists of all processes' micro-batches.
+
+    :param labels_list: list of labels (as returned by prepare_batch()), one per micro-batch (can be empty)
+    :param device: torch device object on which the labels are
+    :param distributed: if True, sum the statistics over all processes (data-parallel training)
+    :return: dict{'sup_weights': (2) class weights for the supporting fact loss,
+                  'sup_norm': sum of the weights of all tokens' labels,
+                  'n_points': number of data points}
+    """
+    # [number of tokens, number of supporting fact tokens, number of data points]
+    counts = torch.tensor([[labels[0].numel(), int(labels[0].sum()), labels[3].shape[0]] for labels in labels_list],
+                          dtype=torch.float, device=device).view(-1, 3).sum(dim=0)
+    if distributed:
+        counts = utils.all_reduce_tensor(counts)
+    n_tokens, n_sup, n_points = counts.tolist()
+
+    weights = torch.ones(2, device=device)
+    weights[0] = n_sup / max(n_tokens, 1)
+    weights[1] -= weights[0] # assign the opposite weight
+
+    return {"sup_weights": weights,
+            "sup_norm": weights[0] * (n_tokens - n_sup) + weights[1] * n_sup,
+            "n_points": int(n_points)}
+
+def compute_losses(outputs, labels, coefs=(0.5, 0.5), totals=None):
+    """
+    Compute the DFGN's training loss (formula 15) and its components.
+    With totals, the losses of a micro-batch are normalized like in the whole
+    batch, so that the micro-batches' losses add up to the whole batch's loss.
+
+    :param outputs: list of outputs as produced by the Predictor's forward function (one per data point)
+    :param labels: (Tensor, Tensor, Tensor, Tensor) -- as returned by prepare_batch()
+    :param coefs: (float,float) coefficients for the supporting fact and type losses
+    :param totals: statistics of the whole batch as returned by loss_totals() (default: this batch's)
+    :return: overall loss, sup_loss, start_loss, end_loss, type_loss (all Tensors)
+    """
+    sup_labels, start_labels, end_labels, type_labels = labels
+    sups, starts, ends, types = list(zip(*outputs))
+
+    sups =   torch.stack(sups).float()    # (batch, M, 2)
+    starts = torch.stack(starts).float()  # (batch, 1, M)
+    ends =   torch.stack(ends).float()    # (batch, 1, M)
+    types =  torch.stack(types).float()   # (batch, 1, 3)
+
+    totals = totals if totals is not None else loss_totals([labels], device=sup_labels.device)
+    sup_label_batch = sup_labels.view(-1)
+
+    # weighted mean over all tokens of the whole batch (as in CrossEntropyLoss(weight=...))
+    sup_criterion = torch.nn.CrossEntropyLoss(weight=totals["sup_weights"], reduction='sum')
+    criterion = torch.nn.CrossEntropyLoss()  # for start and end (one position per point)
+
+    # use .view(-1,...) to put points together (this is like summing the points' losses)
+    sup_loss =   sup_criterion(sups.view(-1,2), sup_label_batch) / totals["sup_norm"] # (batch*M, 2), (batch*M)
+    start_loss = sum([criterion(starts[i], start_labels[i]) for i in range(start_labels.shape[0])])  # batch * ( (1, M, 1), (1) )
+    end_loss   = sum([criterion(ends[i], end_labels[i]) for i in range(end_labels.shape[0])])        # batch * ( (1, M, 1), (1) )
+    type_loss  =  torch.nn.CrossEntropyLoss(reduction='sum')(types.view(-1,3), type_labels.view(-1)) \
+                  / totals["n_points"]    # (batch, 1, 3), (batch, 1)
+
+    # This doesn't have the weak supervision BFS mask stuff from section 3.5 of the paper
+    # TODO? maybe start training with start/end loss only first, then train another model on all 4 losses?
+    loss = start_loss + end_loss + coefs[0]*sup_loss + coefs[1]*type_loss # formula 15
+
+    return loss, sup_loss, start_loss, end_loss, type_loss
+
+def selector_loss(selector_net, batch, tokenizer, text_length=250, device=torch.device('cpu')):
+    """
+    Loss of the paragraph selector on the paragraphs of a batch (used for multi-task
+    training when the selector shares its BERT with the DFGN's Encoder).
+    Like in ParagraphSelector.train(), the 2 relevant and 2 irrelevant paragraphs of each question are used.
+
+    :param selector_net: a ParagraphSelectorNet
+    :param batch: list of raw points as returned by HotPotDataHandler.data_for_paragraph_selector()
+    :param tokenizer: tokenizer for the selector's inputs
+    :param text_length: length of the selector's inputs (query + paragraph)
+    :param device: torch device object on which the selector is
+    :return: BCE loss (Tensor)
+    """
+    inputs, labels = ParagraphSelector.make_training_data(batch,
+                                                          text_length=text_length,
+                                                          tokenizer=tokenizer,
+                                                          verbose=False).tensors
+    scores = selector_net(inputs.to(device)).squeeze(1)
+    return torch.nn.BCELoss()(scores, labels.float().to(device))
+
+
+class DFGNDataset(torch.utils.data.Dataset):
+    """
+    Training points of the DFGN for a torch DataLoader. Points are preprocessed
+    when they are accessed (with prepare_batch(), or read from a feature store),
+    so that the DataLoader's worker processes do the preprocessing while the
+    model trains. Useless points (no entities) are filtered in collate_points().
+    """
+
+    def __init__(self, points, para_selector=None, ner_tagger=None, encoder=None, tokenizer=None,
+                 feature_store=None, ps_threshold=0.1, text_length=250, pack_sequences=False,
+                 max_nodes=40, sparse_graphs=False):
+        """
+        :param points: list of raw points, or list[int] -- point numbers in the feature store
+        :param feature_store: a featurize.FeatureStore object (then the other models are not needed)
+        For the other parameters, see prepare_batch().
+        """
+        self.points = points
+        self.para_selector = para_selector
+        self.ner_tagger = ner_tagger
+        self.encoder = encoder
+        self.tokenizer = tokenizer
+        self.feature_store = feature_store
+        self.ps_threshold = ps_threshold
+        self.text_length = text_length
+        self.pack_sequences = pack_sequences
+        self.max_nodes = max_nodes
+        self.sparse_graphs = sparse_graphs
+
+    def __len__(self):
+        return len(self.points)
+
+    def __getitem__(self, i):
+        """
+        :return: (prepared point, raw point) -- the return values of prepare_batch() for this point alone;
+                 the raw point is None if the point comes from a feature store
+        """
+        if self.feature_store is not None:
+            return self.feature_store.batch([self.points[i]], sparse_graphs=self.sparse_graphs), None
+        return prepare_batch([self.points[i]],
+                             self.para_selector,
+                             self.ner_tagger,
+                             self.encoder,
+                             self.tokenizer,
+                             ps_threshold=self.ps_threshold,
+                             text_length=self.text_length,
+                             pack_sequences=self.pack_sequences,
+                             max_nodes=self.max_nodes,
+                             sparse_graphs=self.sparse_graphs), self.points[i]
+
+def collate_points(items):
+    """
+    collate_fn for DFGNDataset: merge prepared points into one batch and leave out useless points.
+    :param items: list of (prepared point, raw point) as returned by DFGNDataset
+    :return: ids, q_ids_list, c_ids_list, graphs, labels, n_useless (like prepare_batch()),
+             and the batch's raw points (for the paragraph selector's loss; empty for a feature store)
+    """
+    ids, q_ids_list, c_ids_list, graphs, labels = [], [], [], [], []
+    n_useless = 0
+    for (p_ids, p_q_ids, p_c_ids, p_graphs, p_labels, p_useless), _ in items:
+        n_useless += p_useless
+        if p_ids:
+            ids += p_ids
+            q_ids_list += p_q_ids
+            c_ids_list += p_c_ids
+            graphs += p_graphs
+            labels.append(p_labels)
+
+    labels = tuple(torch.cat(l) for l in zip(*labels)) if labels else None
+    raw_points = [point for _, point in items if point is not None]
+    return ids, q_ids_list, c_ids_list, graphs, labels, n_useless, raw_points
+
+
 def train(net, train_data,
           dev_data_filepath, dev_preds_filepath, model_save_path,
           para_selector, # TODO sort these nicely
@@ -58,12 +425,18 @@ def train(net, train_data,
           text_length=250,
           fb_passes=1, coefs=(0.5, 0.5),
           epochs=3, batch_size=1, learning_rate=1e-4,
-          eval_interval=None, verbose_evaluation=False, timed=False):
+          eval_interval=None, verbose_evaluation=False, timed=False,
+          pack_sequences=False, selector_coef=1.0, fb_bucket_size=None,
+          max_nodes=40, sparse_graphs=False, feature_store=None,
+          num_workers=0, prefetch_factor=2, shuffle_seed=None,
+          accumulation_steps=1, mixed_precision=False,
+          checkpoint_dir=None, checkpoint_interval=None, keep_last_checkpoints=2, keep_best_checkpoints=1,
+          resume=False):
     """
     This is the main function used for training a DFGN network.
 
     :param net: DFGN object
-    :param train_data: training data (raw points), split into batches
+    :param train_data: training data (raw points); batches are made by a DataLoader (see DFGNDataset)
     :param dev_data_filepath: data for evaluation during training (raw points), split into batches
     :param dev_preds_filepath: data for the predictions
     :param model_save_path: where the trained model should be saved
@@ -80,9 +453,38 @@ def train(net, train_data,
     :param eval_interval: evaluate every eval_interval batches
     :param verbose_evaluation: if True, when predicting, question and predicted answer will be printed
     :param timed: if True, log times
-    :return: list[(real_batch_size, overall_loss, sup_loss, start_loss, end_loss, type_loss)], list[dict{metrics}], Timer
+    :param pack_sequences: if True, pack BERT inputs of the paragraph selector and the encoder into 512-token windows
+    :param selector_coef: if the net has a selector (shared BERT), its loss is weighted with this and added to formula 15
+    :param fb_bucket_size: maximum number of data points that the fusion block processes at once (default: the whole batch)
+    :param max_nodes: maximum number of nodes per entity graph
+    :param sparse_graphs: if True, the fusion block works on edge lists instead of adjacency matrices
+    :param feature_store: a featurize.FeatureStore object; if given, train_data contains point numbers
+                          in the store (instead of raw points), and the paragraph selector is not used for training
+    :param num_workers: number of DataLoader worker processes that preprocess the batches (0 = no workers);
+                        without a feature store, the workers need the paragraph selector on the CPU and use
+                        its weights from the beginning of each epoch
+    :param prefetch_factor: number of batches that each worker prepares in advance
+    :param shuffle_seed: if given, the training data are shuffled with seed shuffle_seed + epoch in each epoch
+    :param accumulation_steps: number of batches (of batch_size points) per optimizer step; their gradients
+                               are accumulated, and their losses add up to the loss of one large batch
+    :param mixed_precision: 'bf16' or 'fp16' for automatic mixed precision (fp16 only on GPUs; with loss scaling),
+                            False for fp32
+    :param checkpoint_dir: directory for checkpoints (default: 'checkpoints' next to model_save_path);
+                           a checkpoint is saved after each evaluation (with its score) and every checkpoint_interval
+                           optimizer steps, in the background (see utils.CheckpointManager)
+    :param checkpoint_interval: save a checkpoint every checkpoint_interval optimizer steps (None = only at evaluations)
+    :param keep_last_checkpoints: number of most recent checkpoints that are kept
+    :param keep_best_checkpoints: number of checkpoints with the best dev scores that are kept
+    :param resume: True to continue from the latest checkpoint in checkpoint_dir, or the path of a checkpoint
+                   (the data of the interrupted epoch are continued at the saved position)
+    The model is saved to model_save_path at the end of training, with the weights of the best evaluation.
+    In data-parallel training (see utils.init_distributed()), each process trains on its own shard of train_data;
+    losses, batch sizes and statistics are those of all processes, and only the first process (rank 0)
+    evaluates and saves the model (its dev scores are empty in the other processes).
+    :return: list[(real_batch_size, overall_loss, sup_loss, start_loss, end_loss, type_loss)], list[dict{metrics}],
+             utils.Profiler (with stages data_loading, forward, backward, all_reduce, optimizer, evaluation, checkpoint)
     """
-    timer = utils.Timer()
+    timer = utils.Profiler()
 
     tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
 
@@ -91,6 +493,14 @@ def train(net, train_data,
 
     optimizer = torch.optim.Adam(net.parameters(), lr=learning_rate)
 
+    # bf16 has the same range as fp32, so only fp16 needs loss scaling
+    amp_dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(mixed_precision) if mixed_precision else None
+    if amp_dtype == torch.float16 and training_device.type != 'cuda':
+        print("fp16 mixed precision is only supported on GPUs; continuing with bf16.")
+        amp_dtype = torch.bfloat16
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
+    accumulation_steps = accumulation_steps if accumulation_steps else 1
+
     losses = []
     real_batch_sizes = []  # some data points are not usable; this logs the real sizes
     graph_logging = [0, 0, 0]  # [total nodes, total connections, number of graphs]
@@ -101,172 +511,250 @@ def train(net, train_data,
     net.train()
     net = net.to(training_device)
 
+    # data-parallel training: all processes start with the same weights and sum their gradients
+    rank, world_size = utils.distributed_rank(), utils.distributed_world_size()
+    utils.broadcast_parameters(net)
+
+    if num_workers and feature_store is None and next(para_selector.net.parameters()).device.type == 'cuda':
+        print("DataLoader workers can't use a paragraph selector on the GPU; preprocessing without workers.")
+        num_workers = 0
+    if num_workers and feature_store is None and hasattr(net, "selector"):
+        # workers have a copy of the selector from the start of the epoch, which doesn't get the co-trained weights
+        print("DataLoader workers can't use a paragraph selector that is trained with the DFGN; preprocessing without workers.")
+        num_workers = 0
+
+    dataset = DFGNDataset(train_data,
+                          para_selector=para_selector,
+                          ner_tagger=ner_tagger,
+                          encoder=net.encoder,
+                          tokenizer=tokenizer,
+                          feature_store=feature_store,
+                          ps_threshold=ps_threshold,
+                          text_length=text_length,
+                          pack_sequences=pack_sequences,
+                          max_nodes=max_nodes,
+                          sparse_graphs=sparse_graphs)
+    generator = torch.Generator() # re-seeded in each epoch for deterministic shuffling
+    sampler = torch.utils.data.RandomSampler(dataset, generator=generator) if shuffle_seed is not None \
+              else torch.utils.data.SequentialSampler(dataset)
+    if world_size > 1: # each process gets its own shard of the training data (the shards have the same sizes)
+        sampler = torch.utils.data.distributed.DistributedSampler(dataset,
+                                                                  shuffle=shuffle_seed is not None,
+                                                                  seed=shuffle_seed if shuffle_seed else 0)
+    sampler = utils.ResumableSampler(sampler) # can start in the middle of an epoch
+    loader_options = {"num_workers": num_workers, "prefetch_factor": prefetch_factor} if num_workers else {}
+    train_loader = torch.utils.data.DataLoader(dataset,
+                                               batch_size=batch_size,
+                                               sampler=sampler,
+                                               collate_fn=collate_points,
+                                               **loader_options)
+
+    # the dev set is featurized once for all evaluations (only rank 0 evaluates)
+    eval_data = None
+    if rank == 0:
+        print("Featurizing the evaluation data...")
+        eval_data = EvaluationData(utils.HotPotDataHandler(dev_data_filepath).data_for_paragraph_selector(),
+                                   tokenizer, ner_tagger, net.encoder,
+                                   device=training_device,
+                                   text_length=text_length,
+                                   max_nodes=max_nodes,
+                                   sparse_graphs=sparse_graphs)
+
     timer("training_preparation")
 
     print("Training...")
 
     best_score = 0
     eval_interval = eval_interval if eval_interval else float('inf') # interval in batches
-    a_model_was_saved_at_some_point = False
 
-    for epoch in range(epochs):
+    # checkpoints are saved by rank 0, but all processes resume from them
+    checkpoints = utils.CheckpointManager(checkpoint_dir if checkpoint_dir else
+                                          os.path.join(os.path.dirname(model_save_path), "checkpoints"),
+                                          keep_last=keep_last_checkpoints,
+                                          keep_best=keep_best_checkpoints)
+    optimizer_steps = 0
+    start_epoch, skipped_batches, start_batch_counter = 0, 0, 0 # position in the training data
+    resume_path = resume if isinstance(resume, str) else (checkpoints.latest() if resume else None)
+    if resume_path:
+        print(f"Resuming training from {resume_path}...")
+        state = checkpoints.load(resume_path, map_location=training_device)
+        net.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        scaler.load_state_dict(state["scaler"])
+        utils.set_rng_states(state["rng"])
+        optimizer_steps = state["step"]
+        start_epoch, skipped_batches, start_batch_counter = state["position"]
+        losses, real_batch_sizes, dev_scores, best_score = state["losses"], state["real_batch_sizes"], \
+                                                           state["dev_scores"], state["best_score"]
+        if rank == 0: # the statistics in the checkpoint are those of all processes
+            graph_logging, point_usage = state["graph_logging"], state["point_usage"]
+
+    for epoch in range(start_epoch, epochs):
         # TODO take recurrent times for forward, evaluation saving etc.
         print('Epoch %d/%d' % (epoch + 1, epochs))
-        batch_counter = 0
-
-        for step, batch in enumerate(tqdm(train_data, desc="Iteration")):
+        batch_counter = start_batch_counter if epoch == start_epoch else 0
+        skipped = skipped_batches if epoch == start_epoch else 0 # batches that were trained on before resuming
+        sampler.skip = skipped * batch_size
+        if shuffle_seed is not None:
+            generator.manual_seed(shuffle_seed + epoch)
+        if world_size > 1:
+            sampler.sampler.set_epoch(epoch) # shuffles with seed + epoch
+
+        # the DataLoader prepares the batches (in its workers, if there are any; see DFGNDataset)
+        micro_batches = [] # usable micro-batches of the current optimizer step
+        for step, (ids, q_ids_list, c_ids_list, graphs, labels, n_useless, batch) in \
+                enumerate(tqdm(timer.iterate(train_loader, "data_loading"), total=len(train_loader), desc="Iteration")):
 
             """ DATA PROCESSING """
-            ids = []
-            queries = []
-            contexts = []
-            graphs = []
-
-            useless_datapoint_inds = []
-
-            for i, point in enumerate(batch):
-
-                # make a list[ list[str, list[str]] ] for each point in the batch
-                context = para_selector.make_context(point,
-                                                       threshold=ps_threshold,
-                                                       context_length=text_length)  # TODO add device and numerated arguments
-                graph = EntityGraph.EntityGraph(context,
-                                                  context_length=text_length,
-                                                  tagger=ner_tagger)
-                if graph.graph:
-                    ids.append(point[0])
-                    queries.append(point[2])
-                    contexts.append(context)
-                    graphs.append(graph)
-                    graph_logging = [a+b  # [total nodes, total connections, number of graphs]
-                                     for a,b in zip(graph_logging, [len(graph.graph),
-                                                                    len(graph.relation_triplets()),
-                                                                    1])]
-                    point_usage[0] += 1
-                else:  # if the NER in EntityGraph doesn't find entities, the datapoint is useless.
-                    useless_datapoint_inds.append(i)
-                    point_usage[1] += 1
-
-            batch = [point for point in batch if point[0] in ids] # update the batch to exclude useless data points
-
-            real_batch_sizes.append(batch_size - len(useless_datapoint_inds))  #TODO track the batch sizes!
+            for graph in graphs:
+                graph_logging = [a+b  # [total nodes, total connections, number of graphs]
+                                 for a,b in zip(graph_logging, [len(graph.graph),
+                                                                len(graph.relation_triplets()),
+                                                                1])]
+                timer.count("nodes", len(graph.graph))
+                timer.count("edges", graph.edges.shape[1])
+            point_usage = [point_usage[0] + len(ids), point_usage[1] + n_useless]
+            timer.count("points", len(ids))
+            timer.count("dropped_points", n_useless)
 
             # if our batch is completely useless, just continue with the next batch. :(
-            if len(useless_datapoint_inds) == batch_size:
+            if ids:
+                q_ids_list = [t.to(training_device) if t is not None else None for t in q_ids_list]
+                c_ids_list = [t.to(training_device) if t is not None else None for t in c_ids_list]
+                for g in graphs:
+                    g.to(training_device) # moves M and A
+                labels = [l.to(training_device) for l in labels]
+                micro_batches.append((q_ids_list, c_ids_list, graphs, labels, batch))
+
+            # accumulate gradients over accumulation_steps micro-batches (the last step can have fewer)
+            if (step + 1) % accumulation_steps != 0 and step + 1 < len(train_loader):
                 continue
 
-            # turn the texts into tensors in order to put them on the GPU
-            qc_ids = [net.encoder.token_ids(q, c) for q, c in zip(queries, contexts)] # list[ (list[int], list[int]) ]
-            q_ids, c_ids = list(zip(*qc_ids)) # tuple(list[int]), tuple(list[int])
-            q_ids_list = [torch.tensor(q) for q in q_ids] # list[Tensor] #TODO? maybe put this into forward()?
-            c_ids_list = [torch.tensor(c) for c in c_ids] # list[Tensor]
-
-            """ MAKE TRAINING LABELS """
-            # replace the paragraphs in raw_point with their shortened versions (obtained from PS)
-            for (i, p), c in zip(enumerate(batch), contexts):
-                batch[i][3] = c
-
-            # TODO? change utils.make_labeled_data_for_predictor() to process batches of data?
-            labels = [utils.make_labeled_data_for_predictor(g,p,tokenizer) for g,p in zip(graphs, batch)]  # list[(support, start, end, type)]
-            # list[(Tensor, Tensor, Tensor, Tensor)] -> tuple(Tensor), tuple(Tensor), tuple(Tensor), tuple(Tensor)
-            sup_labels, start_labels, end_labels, type_labels = list(zip(*labels))
-            # print(f"in train_dfgn.train(): shapes of labels:\n{len(sup_labels)}, {len(start_labels)}, {len(end_labels)}, {len(type_labels)}") #CLEANUP
-
-            q_ids_list = [t.to(training_device) if t is not None else None for t in q_ids_list]
-            c_ids_list = [t.to(training_device) if t is not None else None for t in c_ids_list]
-            for i, g in enumerate(graphs):
-                graphs[i].M = g.M.to(training_device) # work with enumerate to actually mutate the graph objects
-
-            sup_labels = torch.stack(sup_labels).to(training_device)      # (batch, M)
-            start_labels = torch.stack(start_labels).to(training_device)  # (batch, 1)
-            end_labels = torch.stack(end_labels).to(training_device)      # (batch, 1)
-            type_labels = torch.stack(type_labels).to(training_device)    # (batch)
+            # the losses of the micro-batches are normalized like those of the whole batch (see compute_losses());
+            # with several processes, the batch consists of the micro-batches of all processes
+            totals = loss_totals([labels for _, _, _, labels, _ in micro_batches],
+                                 device=training_device, distributed=world_size > 1)
+            if totals["n_points"] == 0: # the same in all processes
+                micro_batches = []
+                continue
+            n_raw_points = sum([len(batch) for _, _, _, _, batch in micro_batches])
+            n_raw_points = int(utils.all_reduce_tensor(torch.tensor(float(n_raw_points), device=training_device)))
 
             """ FORWARD PASSES """
             optimizer.zero_grad()
-
-            sups, starts, ends, types = [], [], [], []
-            for query, context, graph in zip(q_ids_list, c_ids_list, graphs):  # 'graph' is not a tensor -> for-loop instead of batch processing
-
-                o_sup, o_start, o_end, o_type = net(query, context, graph, fb_passes=fb_passes)  # (M, 2), (M), (M), (1, 3)
-                sups.append(o_sup)
-                starts.append(o_start)
-                ends.append(o_end)
-                types.append(o_type)
-
-            sups =   torch.stack(sups)    # (batch, M, 2)
-            starts = torch.stack(starts)  # (batch, 1, M)
-            ends =   torch.stack(ends)    # (batch, 1, M)
-            types =  torch.stack(types)   # (batch, 1, 3)
-
-            """ LOSSES & BACKPROP """
-            weights = torch.ones(2, device=training_device) #TODO maybe extract this to a tiny function?
-            sup_label_batch = sup_labels.view(-1)
-            weights[0] = sum(sup_label_batch)/float(sup_label_batch.shape[0])
-            weights[1] -= weights[0] # assign the opposite weight
-
-            sup_criterion = torch.nn.CrossEntropyLoss(weight=weights)
-            criterion = torch.nn.CrossEntropyLoss()  # for prediction of answer type
-
-            # use .view(-1,...) to put points together (this is like summing the points' losses)
-            sup_loss =   sup_criterion(sups.view(-1,2), sup_label_batch) # (batch*M, 2), (batch*M)
-            start_loss = sum([criterion(starts[i], start_labels[i]) for i in range(start_labels.shape[0])])  # batch * ( (1, M, 1), (1) )
-            end_loss   = sum([criterion(ends[i], end_labels[i]) for i in range(end_labels.shape[0])])        # batch * ( (1, M, 1), (1) )
-            type_loss  =  criterion(types.view(-1,3),  type_labels.view(-1))    # (batch, 1, 3), (batch, 1)
-
-            # This doesn't have the weak supervision BFS mask stuff from section 3.5 of the paper
-            # TODO? maybe start training with start/end loss only first, then train another model on all 4 losses?
-            loss = start_loss + end_loss + coefs[0]*sup_loss + coefs[1]*type_loss # formula 15
-
-            loss.backward(retain_graph=True)
-            losses.append( (loss.item(),
-                            sup_loss.item(),
-                            start_loss.item(),
-                            end_loss.item(),
-                            type_loss.item()))  # for logging purposes
+            step_losses = [0.0, 0.0, 0.0, 0.0, 0.0]
+            for q_ids_list, c_ids_list, graphs, labels, batch in micro_batches:
+                with timer.span("forward"), \
+                     torch.autocast(device_type=training_device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                    outputs = net.forward_batch(q_ids_list, c_ids_list, graphs,
+                                                fb_passes=fb_passes, packed=pack_sequences,
+                                                bucket_size=fb_bucket_size)  # batch * ( (M, 2), (M), (M), (1, 3) )
+
+                    """ LOSSES & BACKPROP """
+                    micro_losses = compute_losses(outputs, labels, coefs=coefs, totals=totals)
+                    loss = micro_losses[0]
+                    if hasattr(net, "selector") and selector_coef and feature_store is None: # multi-task training of the shared BERT
+                        loss = loss + selector_coef * len(batch) / n_raw_points * \
+                                      selector_loss(net.selector, batch, tokenizer,
+                                                    text_length=text_length,
+                                                    device=training_device)
+
+                with timer.span("backward"):
+                    scaler.scale(loss).backward()
+                step_losses = [total + l.item() for total, l in zip(step_losses, (loss,) + micro_losses[1:])]
+
+            with timer.span("all_reduce"):
+                utils.all_reduce_gradients(net) # sums, like the losses of the micro-batches
+                step_losses = utils.all_reduce_tensor(torch.tensor(step_losses, device=training_device)).tolist()
+            real_batch_sizes.append(totals["n_points"])
+            losses.append(tuple(step_losses))  # (overall, sup, start, end, type) for logging purposes
+            micro_batches = []
+
+            with timer.span("optimizer"):
+                scaler.step(optimizer)
+                scaler.update()
+            optimizer_steps += 1
 
             batch_counter += 1
-            # Evaluate on validation set after some iterations
-            if batch_counter % eval_interval == 0:
+            score = None
+            # Evaluate on validation set after some iterations (only the first process evaluates)
+            if batch_counter % eval_interval == 0 and rank == 0:
 
                 # this calls the official evaluation script (altered to return metrics)
-                metrics = evaluate(net, #TODO make this prettier
-                                   tokenizer, ner_tagger,
-                                   training_device, dev_data_filepath, dev_preds_filepath,
-                                   fb_passes = fb_passes,
-                                   text_length = text_length,
-                                   verbose=verbose_evaluation)
+                with timer.span("evaluation"):
+                    metrics = evaluate(net, #TODO make this prettier
+                                       tokenizer, ner_tagger,
+                                       training_device, dev_data_filepath, dev_preds_filepath,
+                                       fb_passes = fb_passes,
+                                       text_length = text_length,
+                                       verbose=verbose_evaluation,
+                                       pack_sequences=pack_sequences,
+                                       max_nodes=max_nodes,
+                                       sparse_graphs=sparse_graphs,
+                                       eval_data=eval_data,
+                                       batch_size=batch_size)
                 score = metrics["joint_f1"]
                 dev_scores.append(metrics) # appends the whole dict of metrics
                 if score >= best_score:
                     print(f"Better eval found with accuracy {round(score, 3)} (+{round(score - best_score, 3)})")
                     best_score = score
-
-                    torch.save(net, model_save_path) #TODO make sure that this works (maybe, should we save each of the 3 parts indvidually?)
-                    a_model_was_saved_at_some_point = True
                 else:
                     print(f"No improvement yet...")
                 timer(f"training_evaluation_{batch_counter/eval_interval}")
-
-            optimizer.step()
+            if batch_counter % eval_interval == 0:
+                utils.barrier() # the other processes wait for the evaluation
+
+            # checkpoints after evaluations (with their score) and every checkpoint_interval steps
+            if batch_counter % eval_interval == 0 or (checkpoint_interval and optimizer_steps % checkpoint_interval == 0):
+                statistics = utils.all_reduce_tensor(torch.tensor(graph_logging + point_usage, dtype=torch.float,
+                                                                  device=training_device)).tolist()
+                if rank == 0:
+                    end_of_epoch = step + 1 == len(train_loader)
+                    with timer.span("checkpoint"): # copying the state; it is written in the background
+                        checkpoints.save(optimizer_steps,
+                                         {"model": net.state_dict(),
+                                          "optimizer": optimizer.state_dict(),
+                                          "scaler": scaler.state_dict(),
+                                          "rng": utils.rng_states(),
+                                          "step": optimizer_steps,
+                                          "position": (epoch + 1, 0, 0) if end_of_epoch else
+                                                      (epoch, skipped + step + 1, batch_counter),
+                                          "losses": losses,
+                                          "real_batch_sizes": real_batch_sizes,
+                                          "dev_scores": dev_scores,
+                                          "best_score": best_score,
+                                          "graph_logging": [int(x) for x in statistics[:3]],
+                                          "point_usage": [int(x) for x in statistics[3:]]},
+                                         score=score)
         timer(f"training_epoch_{epoch}")
 
     #========= END OF TRAINING =============#
-    metrics = evaluate(net,  # TODO make this prettier
-                       tokenizer, ner_tagger,
-                       training_device, dev_data_filepath, dev_preds_filepath,
-                       fb_passes=fb_passes,
-                       text_length=text_length,
-                       verbose=verbose_evaluation)
-    score = metrics["joint_f1"]
-    dev_scores.append(metrics)  # appends the whole dict of metrics
-    if score >= best_score:
-        torch.save(net,
-                   model_save_path)
-
-    if not a_model_was_saved_at_some_point:  # make sure that there is a model file
+    # statistics of all processes' data
+    graph_logging = [int(x) for x in utils.all_reduce_tensor(torch.tensor(graph_logging, dtype=torch.float, device=training_device)).tolist()]
+    point_usage = [int(x) for x in utils.all_reduce_tensor(torch.tensor(point_usage, dtype=torch.float, device=training_device)).tolist()]
+
+    if rank == 0:
+        metrics = evaluate(net,  # TODO make this prettier
+                           tokenizer, ner_tagger,
+                           training_device, dev_data_filepath, dev_preds_filepath,
+                           fb_passes=fb_passes,
+                           text_length=text_length,
+                           verbose=verbose_evaluation,
+                           pack_sequences=pack_sequences,
+                           max_nodes=max_nodes,
+                           sparse_graphs=sparse_graphs,
+                           eval_data=eval_data,
+                           batch_size=batch_size)
+        score = metrics["joint_f1"]
+        dev_scores.append(metrics)  # appends the whole dict of metrics
+        if score < best_score and checkpoints.best(): # an earlier evaluation was better
+            print(f"loading the best weights from {checkpoints.best()}...")
+            net.load_state_dict(checkpoints.load(checkpoints.best(), map_location=training_device)["model"])
+
         print(f"saving model to {model_save_path}...")
         torch.save(net, model_save_path)
+    checkpoints.wait()
+    utils.barrier()
 
     losses_with_batchsizes = [(b, t[0], t[1], t[2], t[3], t[4]) for b,t in zip(real_batch_sizes, losses)]
 
@@ -276,7 +764,7 @@ def train(net, train_data,
         return losses_with_batchsizes, dev_scores, graph_logging, point_usage
 
 
-def predict(net, query, context, graph, tokenizer, sentence_lengths, fb_passes=1):
+def predict(net, query, context, graph, tokenizer, sentence_lengths, fb_passes=1, packed=False):
     """
     Predict answer and supporting facts given a trained DFGN network,
     and the query, context and graph of a point.
@@ -287,51 +775,152 @@ def predict(net, query, context, graph, tokenizer, sentence_lengths, fb_passes=1
     :param context: a tokenized context, Tensor[int] -- token IDs from Encoder.tokenizer
     :param graph: an EntityGraph object
     :param tokenizer: tokenizer used for decoding
-    :param sentence_lengths:
+    :param sentence_lengths: list[list[int]] -- number of tokens per sentence (the title counts as sentence), per paragraph
     :param fb_passes: number of passes through the fusion block
+    :param packed: if True, pack the encoder's inputs (see DFGN.forward_batch())
     :return: answer - str, sup_fact_pairs [[str, int]]
     """
+    answer, sup_fact_pairs, _ = predict_batch(net, [query], [context], [graph], tokenizer, [sentence_lengths],
+                                              fb_passes=fb_passes, packed=packed)[0]
+    return answer, sup_fact_pairs
 
-    # (M,2), (1,M), (1,M), (1,3)
-    o_sup, o_start, o_end, o_type = net(query, context, graph, fb_passes=fb_passes)
+def predict_batch(net, queries, contexts, graphs, tokenizer, sentence_lengths_batch,
+                  fb_passes=1, packed=False, max_answer_length=30, top_k=1, fb_tolerance=None,
+                  fast_path=None, profiler=None):
+    """
+    Predict answers and supporting facts for several points at once (see predict()).
+    Answer spans are decoded with Predictor.decode_spans(), supporting facts
+    with Predictor.supporting_sentences().
+
+    :param net: a trained DFGN network
+    :param queries: list[Tensor[int]] -- tokenized queries
+    :param contexts: list[Tensor[int]] -- tokenized contexts
+    :param graphs: list[EntityGraph]
+    :param tokenizer: tokenizer used for decoding
+    :param sentence_lengths_batch: list[list[list[int]]] -- sentence lengths (see predict()) for each point
+    :param fb_passes: number of passes through the fusion block
+    :param packed: if True, pack the encoder's inputs (see DFGN.forward_batch())
+    :param max_answer_length: maximum number of tokens of an answer span
+    :param top_k: number of answer spans per point
+    :param fb_tolerance: if given, fb_passes is the maximum number of fusion block passes (see DFGN.forward_batch());
+                         the numbers of passes are in net.last_fb_passes afterwards
+    :param fast_path: a FastPath.FastPath object for compiled inference (see DFGN.forward_batch())
+    :param profiler: a utils.Profiler for timing the forward passes' stages and the decoding (optional)
+    :return: list[(str, list[[str, int]], list[(str, float)])] -- answer, supporting facts
+             and the top_k answer spans with their scores, for each point
+    """
+    # batch * ( (M,2), (1,M), (1,M), (1,3) )
+    outputs = net.forward_batch(queries, contexts, graphs, fb_passes=fb_passes, packed=packed,
+                                fb_tolerance=fb_tolerance, fast_path=fast_path, profiler=profiler)
+    with utils.profile(profiler, "decode"):
+        return decode_outputs(outputs, graphs, tokenizer, sentence_lengths_batch,
+                              max_answer_length=max_answer_length, top_k=top_k)
+
+def decode_outputs(outputs, graphs, tokenizer, sentence_lengths_batch, max_answer_length=30, top_k=1):
+    """
+    Turn the DFGN's outputs into answers and supporting facts (see predict_batch()).
+    :param outputs: list of outputs as returned by DFGN.forward_batch()
+    :return: list[(str, list[[str, int]], list[(str, float)])] -- like predict_batch()
+    """
+    o_sups, o_starts, o_ends, o_types = list(zip(*outputs))
 
     # =========== GET ANSWERS
-    answer_start = o_start.argmax()  #TODO make sure that these tensors are all only containing one number!
-    answer_end = o_end.argmax()
-    answer_type = o_type.argmax()
-    if answer_type == 0:
-        answer = "yes"
-    elif answer_type == 1:
-        answer = "no"
-    elif answer_type == 2 and answer_end >= answer_start:
-        answer = tokenizer.decode(graph.tokens[answer_start: answer_end + 1])
-    else:
-        answer = "noanswer"
-
-    # =========== GET SUPPORTING FACTS
-    pos = 0
-    sup_fact_pairs = []
-    for para, s_lens in zip(context, sentence_lengths):
-        for j, s_len in enumerate(s_lens):
-            #score = round(sum(o_sup.argmax([pos: pos + s_len])) / s_len)
-            # take avg of token-wise scores and round to 0 or 1
-            try:
-                score = round(float(sum([x.argmax() for x in o_sup.T[pos: pos + s_len]]) / float(s_len)))
-            except ZeroDivisionError:
-                score = 0
-            if score == 1:
-                sup_fact_pairs.append([para[0], j])
-            pos += s_len
+    # all contexts have the same length (text_length), except if they had to be trimmed
+    o_starts = utils.pad_with_mask([o[0] for o in o_starts])[0] # (batch, M)
+    o_ends = utils.pad_with_mask([o[0] for o in o_ends])[0]     # (batch, M)
+    starts, ends, scores = Predictor.decode_spans(o_starts, o_ends,
+                                                  max_answer_length=max_answer_length,
+                                                  top_k=top_k) # (batch, k)
+    answer_types = torch.cat(o_types).argmax(dim=-1) # (batch)
+
+    results = []
+    for i, graph in enumerate(graphs):
+        spans = [(tokenizer.convert_tokens_to_string(graph.tokens[s: e + 1]), float(score))
+                 for s, e, score in zip(starts[i].tolist(), ends[i].tolist(), scores[i].tolist())
+                 if score >= 0]
+
+        if answer_types[i] == 0:
+            answer = "yes"
+        elif answer_types[i] == 1:
+            answer = "no"
+        elif spans:
+            answer = spans[0][0]
+        else:
+            answer = "noanswer"
+
+        # =========== GET SUPPORTING FACTS
+        # sentence 0 of each paragraph is its title
+        s_lens = [l for p in sentence_lengths_batch[i] for l in p]
+        is_supporting = Predictor.supporting_sentences(o_sups[i], s_lens).tolist()
+        sentence_numbers = [(para[0], j - 1)
+                            for para, p_lens in zip(graph.context, sentence_lengths_batch[i])
+                            for j in range(len(p_lens))]
+        sup_fact_pairs = [[title, j] for (title, j), sup in zip(sentence_numbers, is_supporting)
+                          if sup and j >= 0]
+
+        results.append((answer, sup_fact_pairs, spans))
+
+    return results
+
+
+class EvaluationData():
+    """
+    Points for evaluation, featurized for the DFGN: entity graphs (NER included),
+    token IDs (already on the device) and sentence lengths, together with the
+    gold answers and supporting facts. The data for evaluation during training
+    are featurized once, so that each evaluation only needs the forward passes
+    and the scoring (see evaluate()).
+    """
 
-    return answer, sup_fact_pairs
+    def __init__(self, points, tokenizer, ner_tagger, encoder,
+                 device=torch.device('cpu'), text_length=250, max_nodes=40, sparse_graphs=False):
+        """
+        :param points: raw points (see HotPotDataHandler.data_for_paragraph_selector()), with selected paragraphs
+        :param tokenizer: tokenizer used for encoding
+        :param ner_tagger: Named Entity Recognition tagger
+        :param encoder: the DFGN's Encoder (for the token IDs)
+        :param device: torch device object on which the evaluation is done
+        :param text_length: max text length for the context
+        :param max_nodes: maximum number of nodes per entity graph
+        :param sparse_graphs: if True, the fusion block works on edge lists instead of adjacency matrices
+        """
+        self.ids, self.queries, self.q_ids, self.c_ids, self.graphs, self.s_lens = [], [], [], [], [], []
+        self.gold = [] # [(answer, supporting facts)] of the points above
+        self.useless = [] # [(question_id, answer, supporting facts)] of points without entities
+
+        for point in points:
+            graph = EntityGraph.EntityGraph(point[3],
+                                            context_length=text_length,
+                                            tagger=ner_tagger,
+                                            max_nodes=max_nodes,
+                                            sparse=sparse_graphs)
+            if not graph.graph: # if the NER in EntityGraph doesn't find entities, the datapoint is useless.
+                self.useless.append((point[0], point[4], point[1]))
+                continue
+
+            q_ids, c_ids = encoder.token_ids(point[2], point[3])
+            self.ids.append(point[0])
+            self.queries.append(point[2])
+            self.q_ids.append(torch.tensor(q_ids).to(device))
+            self.c_ids.append(torch.tensor(c_ids).to(device))
+            self.graphs.append(graph.to(device))
+            self.s_lens.append(utils.sentence_lengths(point[3], tokenizer)) # required for prediction in the right format
+            self.gold.append((point[4], point[1]))
 
+    def __len__(self):
+        return len(self.ids)
 
 def evaluate(net,
              tokenizer, ner_tagger,
              device, eval_data_filepath, eval_preds_filepath,
-             fb_passes = 1, text_length = 250, verbose=False):
+             fb_passes = 1, text_length = 250, verbose=False, pack_sequences=False,
+             max_nodes=40, sparse_graphs=False, eval_data=None, batch_size=16):
     """
-    This function is used to evaluating a DFGN network
+    This function is used to evaluating a DFGN network.
+    Without eval_data, the points in eval_data_filepath are featurized and predicted
+    in chunks of batch_size points, so that memory doesn't depend on their number.
+    Predictions are written to eval_preds_filepath + '.jsonl' and scored on the fly
+    (see utils.StreamingEvaluation), and merged into eval_preds_filepath at the end.
 
     :param net: a trained DFGN network
     :param tokenizer: tokenizer use for encoding
@@ -342,67 +931,53 @@ def evaluate(net,
     :param fb_passes: number of passes through the fusion block
     :param text_length: max text length for the context
     :param verbose: if True, when predicting, question and predicted answer will be printed
-    :return: metrics as returned by the HotPotQA official evaluation script (hotpot_evaluate_v1)
+    :param pack_sequences: if True, pack the encoder's inputs into 512-token windows
+    :param max_nodes: maximum number of nodes per entity graph
+    :param sparse_graphs: if True, the fusion block works on edge lists instead of adjacency matrices
+    :param eval_data: an EvaluationData object with the points of eval_data_filepath (featurized beforehand)
+    :param batch_size: number of points per forward pass
+    :return: metrics like those of the HotPotQA official evaluation script (hotpot_evaluate_v1)
     """
 
     """ PREPADE DATA FOR PREDICTION """
-    dh = utils.HotPotDataHandler(eval_data_filepath)
-    dev_data = dh.data_for_paragraph_selector()
-
-    point_ids = [point[0] for point in dev_data] # needed to handle useless datapoints
-    queries = [point[2] for point in dev_data]
-    contexts = [point[3] for point in dev_data]
-
-    graphs = [EntityGraph.EntityGraph(c,
-                                      context_length=text_length,
-                                      tagger=ner_tagger)
-              for c in contexts]
-
-    # if the NER in EntityGraph doesn't find entities, the datapoint is useless.
-    useless_datapoint_inds = [i for i, g in enumerate(graphs) if not g.graph]
-    queries = [q for i, q in enumerate(queries) if i not in useless_datapoint_inds]
-    contexts = [c for i, c in enumerate(contexts) if i not in useless_datapoint_inds]
-    graphs = [g for i, g in enumerate(graphs) if i not in useless_datapoint_inds]
-
-    # required for prediction in the right format
-    s_lens_batch = [utils.sentence_lengths(c, tokenizer) for c in contexts]
-
-    # turn the texts into tensors in order to put them on the GPU
-    qc_ids = [net.encoder.token_ids(q, c) for q, c in zip(queries, contexts)]  # list[ (list[int], list[int]) ]
-    q_ids, c_ids = list(zip(*qc_ids))  # tuple(list[int]), tuple(list[int])
-    q_ids_list = [torch.tensor(q).to(device) for q in q_ids]  # list[Tensor]
-    c_ids_list = [torch.tensor(c).to(device) for c in c_ids]  # list[Tensor]
-
-    for i,g in enumerate(graphs):
-        graphs[i].M = g.M.to(device)  # work with enumerate to actually mutate the graph objects
+    if eval_data is not None:
+        chunks = [eval_data]
+    else:
+        points = utils.HotPotDataHandler(eval_data_filepath).points() # read one point at a time
+        batches = iter(lambda: list(itertools.islice(points, batch_size)), []) # lists of up to batch_size points
+        chunks = (EvaluationData(batch, tokenizer, ner_tagger, net.encoder,
+                                 device=device,
+                                 text_length=text_length,
+                                 max_nodes=max_nodes,
+                                 sparse_graphs=sparse_graphs)
+                  for batch in batches) # featurized one by one
 
     """ FORWARD PASSES """
-    answers = {}  # {question_id: str} (either "yes", "no" or a string containing the answer)
-    sp = {}  # {question_id: list[list[paragraph_title, sent_num]]} (supporting sentences)
-
-    # return useless datapoints unanswered
-    for i in useless_datapoint_inds:
-        answers[point_ids[i]] = "noanswer"
-        sp[point_ids[i]] = []
-
-    for i, (query, context, graph, s_lens) in enumerate(zip(q_ids_list, c_ids_list, graphs, s_lens_batch)):
-
-        if verbose: print(queries[i])
-
-        answer, sup_fact_pairs = predict(net, query, context, graph, tokenizer,
-                                         s_lens, fb_passes=fb_passes) #TODO sort these parameters
-
-        answers[dev_data[i][0]] = answer  # {question_id: str}
-        sp[dev_data[i][0]] = sup_fact_pairs # {question_id: list[list[paragraph_title, sent_num]]}
-
-        if verbose: print(answer)
-
-    with open(eval_preds_filepath, 'w') as f:
-        json.dump( {"answer":answers, "sp":sp} , f)
+    sink = utils.StreamingEvaluation(eval_preds_filepath + ".jsonl")
+    was_training = net.training
+    net.eval()
+    with torch.no_grad():
+        for chunk in chunks:
+            # return useless datapoints unanswered
+            for point_id, gold_answer, gold_sp in chunk.useless:
+                sink.add(point_id, "noanswer", [], gold_answer, gold_sp)
+
+            for b in range(0, len(chunk), batch_size):
+                batch = slice(b, b + batch_size)
+                results = predict_batch(net, chunk.q_ids[batch], chunk.c_ids[batch], chunk.graphs[batch],
+                                        tokenizer, chunk.s_lens[batch], fb_passes=fb_passes, packed=pack_sequences)
+
+                for point_id, query, (answer, sup_fact_pairs, _), (gold_answer, gold_sp) \
+                        in zip(chunk.ids[batch], chunk.queries[batch], results, chunk.gold[batch]):
+                    sink.add(point_id, answer, sup_fact_pairs, gold_answer, gold_sp)
+                    if verbose: print(query, "\n", answer)
+    net.train(was_training)
 
 
     """ EVALUATION """
-    return official_eval_script.eval(eval_preds_filepath, eval_data_filepath) #TODO return aything else than the metrics?
+    metrics = sink.merge(eval_preds_filepath) # predictions in the official format
+    print(metrics)
+    return metrics #TODO return aything else than the metrics?
 
 
 
@@ -422,12 +997,17 @@ if __name__ == '__main__':
     #TODO make sure that the config contains all required parameters
     cfg = utils.ConfigReader(args.config_file)
 
+    # data-parallel training if the script was started with torchrun (see utils.init_distributed())
+    rank, world_size = utils.init_distributed(cfg("distributed_backend") if cfg("distributed_backend") else "gloo")
+
     #TODO change path assignment to fit with the program
     model_abs_path = cfg('model_abs_dir') + args.model_name + "/"
     model_filepath = model_abs_path + args.model_name
     losses_abs_path = model_abs_path + "losses" # contains (batch_size, overall_loss, sup_l., start_l., end_l., type_l.)
     traintime_abs_path = model_abs_path + "times"
     devscores_abs_path = model_abs_path + "devscores"
+    profile_abs_path = model_abs_path + "profile.json"
+    trace_abs_path = model_abs_path + "trace.json"
 
     eval_data_dump_dir = cfg("eval_data_dump_dir")
     eval_data_dump_filepath =  eval_data_dump_dir + "gold"
@@ -444,7 +1024,7 @@ if __name__ == '__main__':
             sys.exit()
     # make sure that the output directories exist
     for path in [model_abs_path, eval_data_dump_dir, cfg("ps_model_abs_path")]:
-        if not os.path.exists(path):
+        if not os.path.exists(path) and rank == 0:
             print(f"newly creating {path}")
             os.makedirs(path)
 
@@ -456,57 +1036,80 @@ if __name__ == '__main__':
     # previously pickled) and split off some data for evaluation during training.
     # The HotPotQA dev set is reserved for evaluation and thus not used here.
 
-    # try to load pickled data, and in case it doesn't work, read the whole HotPotQA dataset
-    try:
-        with open(cfg("pickled_train_data"), "rb") as f:
-            train_data_raw = pickle.load(f)
-            training_dataset_size = cfg("training_dataset_size") if cfg("training_dataset_size") else len(train_data_raw)
-        with open(cfg("pickled_dev_data"), "rb") as f:
-            dev_data_raw = pickle.load(f)
-            # restrict loaded dev data to the required percentage
-            dev_data_raw = dev_data_raw[:cfg('percent_for_eval_during_training') * training_dataset_size]
-
-    except: #TODO why does it always go to this exception instead of loading the pickled data?
-        print(f"Reading data from {cfg('data_abs_path')}...") # the whole HotPotQA training set
+    feature_store = None
+    if cfg("train_feature_store"): # preprocessed with featurize.py
+        print(f"Reading featurized training data from {cfg('train_feature_store')}...")
+        feature_store = featurize.FeatureStore(cfg("train_feature_store"))
+        if feature_store.config.get("text_length") != cfg("text_length"):
+            print(f"WARNING: the feature store was made with text_length {feature_store.config.get('text_length')}")
+        training_dataset_size = cfg("training_dataset_size") if cfg("training_dataset_size") else len(feature_store)
+        point_numbers = list(range(len(feature_store))) # numbers of the points in the store
+        random.Random(cfg('shuffle_seed')).shuffle(point_numbers)
+        point_numbers = point_numbers[:training_dataset_size]
+
+        # like with raw data, some of the points are held out for evaluation during training; their raw
+        # points (for the gold answers and for featurization with the selector in training) are read from
+        # data_abs_path, which the store should have been made from
+        n_dev_points = int(cfg('percent_for_eval_during_training') * training_dataset_size)
+        dev_numbers, train_data_raw = point_numbers[:n_dev_points], point_numbers[n_dev_points:]
+        print(f"Reading data from {cfg('data_abs_path')}...")
         dh = utils.HotPotDataHandler(cfg("data_abs_path"))
-        raw_data = dh.data_for_paragraph_selector() # get raw points
-        training_dataset_size = cfg("training_dataset_size") if cfg("training_dataset_size") else len(raw_data)
-
-        print("Splitting data...") # split into what we need DURING training
-        train_data_raw, dev_data_raw = train_test_split(raw_data[:training_dataset_size],  # restricts the number of training+dev examples
-                                                        test_size=cfg('percent_for_eval_during_training'),
-                                                        random_state=cfg('shuffle_seed'),
-                                                        shuffle=True)
-
-        #print(f"in train_dfgn.main(): len(dev_data_raw): {len(dev_data_raw)}") #CLEANUP
-        #print(dev_data_raw)
-        #train_data = ParagraphSelector.make_training_data(train_data_raw, text_length=cfg("text_length")) #CLEANUP
-        #train_data = shuffle(train_data, random_state=cfg('data_shuffle_seed')) #CLEANUP?
-        try:
-            with open(cfg("pickled_train_data"), "wb") as f:
-                pickle.dump(train_data_raw, f)
-        except:
-            print("tried to pickle the training data for later re-use, but no valid path was given.")
-
+        dev_data_raw = dh.points_with_ids([feature_store.ids[i] for i in dev_numbers]) if dev_numbers else []
+        if len(dev_data_raw) < len(dev_numbers):
+            print(f"WARNING: only {len(dev_data_raw)} of {len(dev_numbers)} held-out points were found in {cfg('data_abs_path')}")
+    else:
+        # try to load pickled data, and in case it doesn't work, read the whole HotPotQA dataset
         try:
-            with open(cfg("pickled_dev_data"), "wb") as f:
-                pickle.dump(dev_data_raw, f)
-        except:
-            print("tried to pickle the development data for later re-use, but no valid path was given.")
-
-
-
-    # group training data into batches
-    bs = cfg("batch_size")
-    N = len(train_data_raw)
-    train_data_raw = [train_data_raw[i : i+bs] for i in range(0, N, bs)]
-
+            with open(cfg("pickled_train_data"), "rb") as f:
+                train_data_raw = pickle.load(f)
+                training_dataset_size = cfg("training_dataset_size") if cfg("training_dataset_size") else len(train_data_raw)
+            with open(cfg("pickled_dev_data"), "rb") as f:
+                dev_data_raw = pickle.load(f)
+                # restrict loaded dev data to the required percentage
+                dev_data_raw = dev_data_raw[:cfg('percent_for_eval_during_training') * training_dataset_size]
+
+        except: #TODO why does it always go to this exception instead of loading the pickled data?
+            print(f"Reading data from {cfg('data_abs_path')}...") # the HotPotQA training set (up to training_dataset_size points)
+            dh = utils.HotPotDataHandler(cfg("data_abs_path"), limit=cfg("training_dataset_size"))
+
+            print("Splitting data...") # split into what we need DURING training
+            if cfg("split_method"): # 'hash' or 'reservoir'; split while reading (see HotPotDataHandler.split())
+                train_data_raw, dev_data_raw = dh.split(cfg('percent_for_eval_during_training'),
+                                                        method=cfg("split_method"),
+                                                        seed=cfg('shuffle_seed'))
+            else:
+                train_data_raw, dev_data_raw = train_test_split(dh.data_for_paragraph_selector(), # get raw points
+                                                                test_size=cfg('percent_for_eval_during_training'),
+                                                                random_state=cfg('shuffle_seed'),
+                                                                shuffle=True)
+
+            #print(f"in train_dfgn.main(): len(dev_data_raw): {len(dev_data_raw)}") #CLEANUP
+            #print(dev_data_raw)
+            #train_data = ParagraphSelector.make_training_data(train_data_raw, text_length=cfg("text_length")) #CLEANUP
+            #train_data = shuffle(train_data, random_state=cfg('data_shuffle_seed')) #CLEANUP?
+            if rank == 0: # all processes have the same split (same shuffle_seed)
+                try:
+                    with open(cfg("pickled_train_data"), "wb") as f:
+                        pickle.dump(train_data_raw, f)
+                except:
+                    print("tried to pickle the training data for later re-use, but no valid path was given.")
+
+                try:
+                    with open(cfg("pickled_dev_data"), "wb") as f:
+                        pickle.dump(dev_data_raw, f)
+                except:
+                    print("tried to pickle the development data for later re-use, but no valid path was given.")
+
+
+
+    # batches are made by the DataLoader in train()
     take_time("data preparation")
 
 
     training_device = torch.device('cpu')
     if cfg("try_training_on_gpu") and torch.cuda.is_available():
-        torch.cuda.set_device(cfg("gpu_number"))
+        # with several processes on one machine, each process uses its own GPU
+        torch.cuda.set_device(int(os.environ["LOCAL_RANK"]) if world_size > 1 else cfg("gpu_number"))
         training_device = torch.device('cuda')
     tagger_device = torch.device('cuda') if cfg("use_gpu_for_ner") else torch.device('cpu')
 
@@ -514,22 +1117,27 @@ if __name__ == '__main__':
     # ========== DFGN START
 
     para_selector = ParagraphSelector.ParagraphSelector(cfg("ps_model_abs_path"))
-
-    dh.make_eval_data(para_selector,
-                      dev_data_raw,
-                      eval_data_dump_filepath,
-                      cfg)
+    para_selector.net = para_selector.net.to(training_device)
+
+    if rank == 0: # only rank 0 evaluates during training
+        dh.make_eval_data(para_selector,
+                          dev_data_raw,
+                          eval_data_dump_filepath,
+                          cfg)
+    utils.barrier()
     take_time("eval_data preparation")
 
     dfgn = DFGN(text_length=cfg("text_length"),
                 emb_size=cfg("emb_size"),
                 device=training_device,
                 fb_dropout=cfg("fb_dropout"),
-                predictor_dropout=cfg("predictor_dropout"))
+                predictor_dropout=cfg("predictor_dropout"),
+                encoder_layers=cfg("encoder_layers"),
+                selector_net=para_selector.net if cfg("share_bert_backbone") else None)
 
     losses, dev_scores, graph_logging, point_usage, train_times = train(
         dfgn, #TODO watch out with the parameter sorting!
-        train_data_raw, # in batches
+        train_data_raw, # batched in train()
         eval_data_dump_filepath, # for reading processed dev_data_raw
         eval_preds_dump_filepath, # for dumping predictions during evaluation
         model_filepath, # where the dfgn model will be saved
@@ -545,12 +1153,31 @@ if __name__ == '__main__':
         learning_rate=cfg("learning_rate"),
         eval_interval=cfg("eval_interval"),
         verbose_evaluation=cfg("verbose_evaluation"),
-        timed=True)
+        timed=True,
+        pack_sequences=cfg("pack_sequences"),
+        selector_coef=cfg("lambda_ps"),
+        fb_bucket_size=cfg("fb_bucket_size"),
+        max_nodes=cfg("max_nodes") if cfg("max_nodes") else 40,
+        sparse_graphs=cfg("sparse_graphs"),
+        feature_store=feature_store,
+        num_workers=cfg("num_workers") if cfg("num_workers") else 0,
+        prefetch_factor=cfg("prefetch_factor") if cfg("prefetch_factor") else 2,
+        shuffle_seed=cfg("shuffle_seed"),
+        accumulation_steps=cfg("accumulation_steps") if cfg("accumulation_steps") else 1,
+        mixed_precision=cfg("mixed_precision"),
+        checkpoint_dir=model_abs_path + "checkpoints/",
+        checkpoint_interval=cfg("checkpoint_interval"),
+        keep_last_checkpoints=cfg("keep_last_checkpoints") if cfg("keep_last_checkpoints") else 2,
+        keep_best_checkpoints=cfg("keep_best_checkpoints") if cfg("keep_best_checkpoints") else 1,
+        resume=cfg("resume_from_checkpoint"))
 
     take_time("training")
 
 
     # ========== LOGGING
+    if rank != 0: # all processes have the same losses and statistics
+        sys.exit(0)
+
     print(f"Saving losses in {losses_abs_path}...")
     with open(losses_abs_path, "w") as f:
         f.write("batch_size\toverall_loss\tsup_loss\tstart_loss\tend_loss\ttype_loss\n")
@@ -582,5 +1209,10 @@ if __name__ == '__main__':
         f.write("used/unused points:   " + str(point_usage[0]) + " / " + str(point_usage[1]) + "\n")
         f.write("Ratio of used points: " + str(point_usage[0] / float(sum(point_usage))) + "\n")
 
+    # stage statistics (latency percentiles, counters) and a trace for chrome://tracing
+    print(f"Saving the training profile in {profile_abs_path} and {trace_abs_path}...")
+    train_times.to_json(profile_abs_path)
+    train_times.to_chrome_trace(trace_abs_path)
+
     print("\nTimes taken:\n", take_time)
     print("done.")
\ No newline at end of file
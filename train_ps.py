@@ -2,9 +2,10 @@
 This script performs training of ParagraphSelector models.
 """
 
-from utils import Timer
+from utils import Profiler
 from utils import HotPotDataHandler
 from utils import ConfigReader
+import utils
 
 from modules import ParagraphSelector
 
@@ -14,12 +15,13 @@ import os
 from sklearn.utils import shuffle
 from sklearn.model_selection import train_test_split
 import pickle
+import torch
 
 
 if __name__ == '__main__':
 
     #=========== PARAMETER INPUT
-    take_time = Timer()
+    take_time = Profiler()
 
     parser = argparse.ArgumentParser()
     parser.add_argument('config_file', metavar='config', type=str,
@@ -30,11 +32,17 @@ if __name__ == '__main__':
 
     cfg = ConfigReader(args.config_file)
 
+    # data-parallel training if the script was started with torchrun (see utils.init_distributed())
+    rank, world_size = utils.init_distributed(cfg("distributed_backend") if cfg("distributed_backend") else "gloo")
+    if world_size > 1 and cfg("try_gpu") and torch.cuda.is_available():
+        torch.cuda.set_device(int(os.environ["LOCAL_RANK"])) # one GPU per process
+
     model_abs_path = cfg('model_abs_dir') + args.model_name + "/"
     #model_abs_path += '.pt' if not args.model_name.endswith('.pt') else ''
     losses_abs_path = model_abs_path + args.model_name + ".losses"
     devscores_abs_path = model_abs_path + args.model_name + ".devscores"
     traintime_abs_path = model_abs_path + args.model_name + ".times"
+    profile_abs_path = model_abs_path + args.model_name + ".profile"
 
     # check all relevant file paths and directories before starting training
     for path in [cfg("data_abs_path"), cfg("dev_data_abs_path")]:
@@ -45,7 +53,7 @@ if __name__ == '__main__':
             print(e)
             sys.exit()
     for path in [model_abs_path]:
-        if not os.path.exists(path):
+        if not os.path.exists(path) and rank == 0:
             print(f"newly creating {path}")
             os.makedirs(path)
 
@@ -68,19 +76,21 @@ if __name__ == '__main__':
             dev_data_raw = dev_data_raw[:int(cfg('percent_for_eval_during_training') * training_dataset_size)]
 
     except:  # TODO why does it always go to this exception instead of loading the pickled data?
-        print(f"Reading data from {cfg('data_abs_path')}...")  # the whole HotPotQA training set
-        dh = HotPotDataHandler(cfg("data_abs_path"))
-        data_raw = dh.data_for_paragraph_selector()  # get raw points
-        training_dataset_size = cfg("training_dataset_size") if cfg("training_dataset_size") else len(data_raw)
+        print(f"Reading data from {cfg('data_abs_path')}...")  # the HotPotQA training set (up to training_dataset_size points)
+        dh = HotPotDataHandler(cfg("data_abs_path"), limit=cfg("training_dataset_size"))
 
         print("Splitting data...")  # split into what we need DURING training
-        train_data_raw, dev_data_raw = train_test_split(data_raw[:training_dataset_size],
-                                                        # restricts the number of training+dev examples
-                                                        test_size=cfg('percent_for_eval_during_training'),
-                                                        random_state=cfg('shuffle_seed'),
-                                                        shuffle=True)
-
-        if cfg("pickled_train_data") and cfg("pickled_dev_data"):
+        if cfg("split_method"):  # 'hash' or 'reservoir'; split while reading (see HotPotDataHandler.split())
+            train_data_raw, dev_data_raw = dh.split(cfg('percent_for_eval_during_training'),
+                                                    method=cfg("split_method"),
+                                                    seed=cfg('shuffle_seed'))
+        else:
+            train_data_raw, dev_data_raw = train_test_split(dh.data_for_paragraph_selector(),  # get raw points
+                                                            test_size=cfg('percent_for_eval_during_training'),
+                                                            random_state=cfg('shuffle_seed'),
+                                                            shuffle=True)
+
+        if cfg("pickled_train_data") and cfg("pickled_dev_data") and rank == 0:
             print(f"Pickling train/dev data for later re-use.")
             print(f"Destinations: \n"
                   f"   {cfg('pickled_train_data')}\n"
@@ -104,7 +114,9 @@ if __name__ == '__main__':
 
     #========== TRAINING
     print("Initialising ParagraphSelector...")
-    ps = ParagraphSelector.ParagraphSelector(cfg("bert_model_path"))
+    ps = ParagraphSelector.ParagraphSelector(cfg("bert_model_path"),
+                                             num_layers=cfg("selector_layers"),
+                                             exit_layers=cfg("exit_layers"))
 
     print(f"training for {cfg('epochs')} epochs...")
     losses, dev_scores = ps.train(train_data, # pre-processed data as tensors
@@ -114,10 +126,19 @@ if __name__ == '__main__':
                           batch_size=cfg("batch_size"),
                           learning_rate=cfg("learning_rate"),
                           eval_interval=cfg("eval_interval"),
-                          try_gpu=cfg("try_gpu"))
+                          try_gpu=cfg("try_gpu"),
+                          exits_only=bool(cfg("train_exits_only")),
+                          checkpoint_interval=cfg("checkpoint_interval"),
+                          keep_last_checkpoints=cfg("keep_last_checkpoints") if cfg("keep_last_checkpoints") else 2,
+                          keep_best_checkpoints=cfg("keep_best_checkpoints") if cfg("keep_best_checkpoints") else 1,
+                          resume=cfg("resume_from_checkpoint"),
+                          profiler=take_time)
     take_time(f"training")
 
     #========== LOGGING
+    if rank != 0: # all processes have the same losses
+        sys.exit(0)
+
     print(f"Saving losses in {losses_abs_path}...")
     with open(losses_abs_path, "w") as f:
         f.write("\n".join([str(l) for l in losses]))
@@ -138,4 +159,9 @@ if __name__ == '__main__':
         take_time.total()
         f.write("\n\nTimes taken:\n" + str(take_time))
 
+    # stage timings (per span: count, total, mean and percentiles) and a trace for chrome://tracing
+    print(f"Saving the training profile in {profile_abs_path}.json and {profile_abs_path}.trace.json...")
+    take_time.to_json(profile_abs_path + ".json")
+    take_time.to_chrome_trace(profile_abs_path + ".trace.json")
+
     print("\nTimes taken:\n", take_time)
\ No newline at end of file
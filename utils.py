@@ -9,14 +9,21 @@ import os
 import sys
 import re
 import json
+import random
+import hashlib
+import itertools
+import threading
+import contextlib
 from tqdm import tqdm
 from time import time
+from datetime import timedelta
 from torch import nn
 import torch
 from torch import functional as F
 from torch.nn import functional as nnF
 import string
 import difflib
+import hotpot_evaluate_v1 as official_eval_script
 
 from pprint import pprint
 
@@ -301,23 +308,289 @@ class Timer():
         return span
 
 
+class Profiler(Timer):
+    """
+    A Timer that also profiles recurring, nested stages. Use it like a Timer, and
+    time stages with spans, e.g.:
+        with profiler.span('prediction'):
+            with profiler.span('encode'): ...
+            with profiler.span('fusion'): ...
+    Spans are named by their path ('prediction/encode'); each occurrence is recorded,
+    so that the summary has percentiles (p50/p95/p99) per stage. Counters count
+    things like nodes, tokens or dropped points. The results can be exported as
+    JSON (summary) and in the Chrome trace format (chrome://tracing, Perfetto).
+    """
+    def __init__(self, max_trace_events=10**6, synchronize=False):
+        """
+        :param max_trace_events: maximum number of events kept for the trace (to limit memory)
+        :param synchronize: if True, spans wait for the GPU to finish their work (exact GPU times, but slower)
+        """
+        super(Profiler, self).__init__()
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.stack = []     # names of the currently open spans
+        self.samples = {}   # {span path: list[float]} -- seconds of each occurrence
+        self.counters = {}  # {name: number}
+        self.events = []    # Chrome trace events
+        self.max_trace_events = max_trace_events
+
+    def __call__(self, periodname):
+        start = self.t0
+        span = super(Profiler, self).__call__(periodname)
+        self._trace(periodname, start, span)
+        return span
+
+    def again(self, periodname):
+        start = self.t0
+        span = super(Profiler, self).again(periodname)
+        self._trace(periodname, start, span)
+        return span
+
+    def __repr__(self, *args):
+        lines = [super(Profiler, self).__repr__(*args)]
+        summary = self.summary()
+        if summary["spans"]:
+            lines.append("\nstage: total seconds / count / mean, p50, p95, p99 (ms)")
+            for path, stats in summary["spans"].items():
+                lines.append(f"{path}: {round(stats['total'], 3)} / {stats['count']} / " +
+                             ", ".join([str(round(1000 * stats[k], 2)) for k in ["mean", "p50", "p95", "p99"]]))
+        if summary["counters"]:
+            lines.append("\ncounters: total (per second)")
+            for name, stats in summary["counters"].items():
+                lines.append(f"{name}: {stats['total']} ({round(stats['per_second'], 2)})")
+        return "\n".join(lines)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+        Time a (possibly nested) stage.
+        :param name: name of the stage; the span's path also contains the names of the enclosing spans
+        """
+        self.stack.append(name)
+        path = "/".join(self.stack)
+        start = time()
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            self.stack.pop()
+            self.record(path, time() - start, start=start)
+
+    def record(self, path, seconds, start=None):
+        """
+        Record one occurrence of a stage (e.g., the per-question share of a batch).
+        :param path: name of the stage
+        :param seconds: time taken
+        :param start: start time (time.time()) for the trace; the occurrence is not traced without it
+        """
+        self.samples.setdefault(path, []).append(seconds)
+        if start is not None:
+            self._trace(path, start, seconds)
+
+    def count(self, name, value=1):
+        """
+        Add to a counter.
+        :param name: name of the counter (e.g., 'nodes')
+        :param value: number to add
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def iterate(self, iterable, name="data_loading"):
+        """
+        Iterate over an iterable (e.g., a DataLoader) and record the time spent waiting for each item.
+        :param iterable: any iterable
+        :param name: name of the stage
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, time() - start, start=start)
+            yield item
+
+    def _trace(self, name, start, seconds):
+        """ add a complete event ('X') to the trace """
+        if len(self.events) < self.max_trace_events:
+            self.events.append({"name": name.split("/")[-1], "cat": name, "ph": "X",
+                                "ts": int(1e6 * (start - self.T0)), "dur": int(1e6 * seconds),
+                                "pid": os.getpid(), "tid": threading.get_ident()})
+
+    @staticmethod
+    def percentile(values, q):
+        """ :return: the q-th percentile (0-100) of sorted values (nearest rank) """
+        return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))] if values else 0.0
+
+    def summary(self):
+        """
+        :return: dict with the Timer's times ('times'), statistics of all spans ('spans': count, total,
+                 mean, p50, p95, p99 in seconds) and counters ('counters': total and per second)
+        """
+        elapsed = max(time() - self.T0, 1e-9)
+        spans = {}
+        for path, values in self.samples.items():
+            values = sorted(values)
+            spans[path] = {"count": len(values),
+                           "total": sum(values),
+                           "mean": sum(values) / len(values),
+                           "p50": self.percentile(values, 50),
+                           "p95": self.percentile(values, 95),
+                           "p99": self.percentile(values, 99)}
+        counters = {name: {"total": value, "per_second": value / elapsed} for name, value in self.counters.items()}
+        return {"times": {k: self.times[k] for k in self.steps}, "spans": spans, "counters": counters}
+
+    def to_json(self, filepath):
+        """ write summary() to a JSON file """
+        with open(filepath, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def to_chrome_trace(self, filepath):
+        """ write all traced stages to a JSON file in the Chrome trace format """
+        with open(filepath, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+def profile(profiler, name):
+    """
+    :param profiler: a Profiler, or None
+    :param name: name of the stage
+    :return: profiler.span(name), or a context that does nothing if there is no profiler
+    """
+    return profiler.span(name) if profiler is not None else contextlib.nullcontext()
+
+
+def iter_json_array(filepath, chunk_size=2**20):
+    """
+    Parse a file that contains one JSON array (like the HotPotQA files) element
+    by element, reading chunk_size characters at a time. Only the element that is
+    being parsed and the rest of the current chunk are held in memory.
+    :param filepath: path to the JSON file
+    :param chunk_size: number of characters read at once
+    :return: generator of the array's elements (dicts, for HotPotQA)
+    """
+    decoder = json.JSONDecoder()
+    separators = re.compile(r"[\s,]*") # whitespace and commas between elements
+    with open(filepath, "r", encoding="utf-8") as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{filepath} does not contain a JSON array")
+        pos, eof = 1, False
+        while True:
+            pos = separators.match(buffer, pos).end()
+            if pos == len(buffer) or not eof and len(buffer) - pos < chunk_size // 2:
+                if pos == len(buffer) and eof:
+                    raise ValueError(f"unexpected end of {filepath}")
+                more = f.read(chunk_size)
+                eof = not more
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                end = len(buffer) # incomplete element; read more
+            if end >= len(buffer) and not eof: # the element may continue in the next chunk
+                more = f.read(chunk_size)
+                eof = not more
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            yield element
+            pos = end
+
+
 class HotPotDataHandler():
     """
     This class provides an interface to the HotPotQA dataset.
     It loads data and extracts the required information.
+    The file is read as a stream (see iter_json_array()), so that only the
+    points that are actually used are held in memory, and reading stops after
+    'limit' points.
     """
 
-    def __init__(self, filename="./data/hotpot_train_v1.1.json"):
+    def __init__(self, filename="./data/hotpot_train_v1.1.json", limit=None):
+        """
+        :param filename: path to a HotPotQA file
+        :param limit: only use the first 'limit' points of the file (default: all of them)
+        """
         self.filename = os.path.abspath(filename)
-        with open(self.filename, "r") as f:
-            self.data = json.load(f)
+        self.limit = limit
+        self._data = None
+
+    @property
+    def data(self):
+        """
+        All points (up to the limit) as they are in the file. This parses the
+        file once and keeps everything in memory; use records() or points()
+        to go through the data one point at a time.
+        :return: list[dict]
+        """
+        if self._data is None:
+            self._data = list(self.records())
+        return self._data
 
     def __repr__(self):
-        header = str(len(self.data))+" items in data; keys:\n"
-        content = "\n".join([str(k) for k in self.data[0].keys()]).rstrip()
+        first = next(self.records(limit=1), {})
+        header = f"HotPotQA data in {self.filename}" + (f" (first {self.limit} items)" if self.limit else "") + "; keys:\n"
+        content = "\n".join([str(k) for k in first.keys()]).rstrip()
         return header+content
 
-    def data_for_paragraph_selector(self): #TODO maybe, if you're bored and there is another lockdown, rename this.
+    def records(self, limit=None):
+        """
+        :param limit: maximum number of points (default: the handler's limit)
+        :return: generator of the points as they are in the file (dicts)
+        """
+        limit = limit if limit is not None else self.limit
+        source = self._data if self._data is not None else iter_json_array(self.filename)
+        return itertools.islice(source, limit if limit else None) # no limit for None, 0 or False
+
+    @staticmethod
+    def raw_point(point):
+        """
+        Make a "raw_point" (see data_for_paragraph_selector()) from a point of the HotPotQA data.
+        :param point: dict, as in the HotPotQA file
+        :return: list[ str, dict{str: list[int]}, str, list[str, list[str]], str ]
+        """
+        supp_facts_detailed = {}
+        for fact in point["supporting_facts"]:
+            if supp_facts_detailed.get(fact[0]):
+                supp_facts_detailed[fact[0]].append(fact[1])
+            else:
+                supp_facts_detailed[fact[0]] = [fact[1]]
+        return [point["_id"],
+                supp_facts_detailed, # we used to use supp_facts here
+                point["question"],
+                point["context"],
+                point["answer"]]
+
+    def points(self, limit=None):
+        """
+        Like data_for_paragraph_selector(), but one raw point at a time.
+        :param limit: maximum number of points (default: the handler's limit)
+        :return: generator of raw points
+        """
+        return (self.raw_point(point) for point in self.records(limit=limit))
+
+    def points_with_ids(self, ids):
+        """
+        Read the raw points with the given IDs (e.g., those of a feature store's points);
+        reading stops as soon as all of them are found.
+        :param ids: collection of question IDs
+        :return: list of raw points, in the order of the file
+        """
+        ids = set(ids)
+        points = []
+        for point in self.records():
+            if point['_id'] in ids:
+                points.append(self.raw_point(point))
+                if len(points) == len(ids):
+                    break
+        return points
+
+    def data_for_paragraph_selector(self, limit=None): #TODO maybe, if you're bored and there is another lockdown, rename this.
         """
         This method makes what is called "raw_point" in other parts of the project.
 
@@ -333,26 +606,57 @@ class HotPotDataHandler():
         - answer: str
         - supp_facts_detailed: dict{str: [int]}
 
+        :param limit: maximum number of points (default: the handler's limit); the rest of the file is not read
         :return: list(tuple( str, list[str], str, list[str,list[str]], str ))
         """
-        result = []
-        for point in self.data:
-            # supp_facts = set([fact[0] for fact in point["supporting_facts"]])
+        return list(self.points(limit=limit))
 
-            supp_facts_detailed = {}
-            for fact in point["supporting_facts"]:
-                if supp_facts_detailed.get(fact[0]):
-                    supp_facts_detailed[fact[0]].append(fact[1])
+    def split(self, test_size, limit=None, method="hash", seed=42):
+        """
+        Split the raw points into training and test points while reading them.
+        - 'hash': a point is a test point if the hash of its ID (and the seed) falls
+          into the first test_size of the hash range. This needs no information
+          about the other points, and a point stays on its side of the split when
+          the limit changes.
+        - 'reservoir': exactly test_size * limit test points, sampled uniformly with
+          reservoir sampling; the others are training points.
+        :param test_size: share of test points (float) or, for 'reservoir', also a number of points (int)
+        :param limit: maximum number of points (default: the handler's limit)
+        :param method: 'hash' or 'reservoir'
+        :param seed: for the hash function or the random number generator
+        :return: list, list -- raw training points, raw test points
+        """
+        limit = limit if limit is not None else self.limit
+        train, test = [], []
+
+        if method == "hash":
+            for point in self.points(limit=limit):
+                digest = hashlib.md5(f"{seed}/{point[0]}".encode("utf-8")).digest()
+                if int.from_bytes(digest[:8], "big") / 2**64 < test_size:
+                    test.append(point)
                 else:
-                    supp_facts_detailed[fact[0]] = [fact[1]]
-            result.append([
-                           point["_id"],
-                           supp_facts_detailed, # we used to use supp_facts here
-                           point["question"],
-                           point["context"],
-                           point["answer"]
-                         ])
-        return result
+                    train.append(point)
+
+        elif method == "reservoir":
+            if type(test_size) == int:
+                k = test_size
+            elif limit:
+                k = int(round(test_size * limit))
+            else:
+                raise ValueError("reservoir sampling needs a limit or an absolute test_size; use method 'hash'")
+            rng = random.Random(seed)
+            for i, point in enumerate(self.points(limit=limit)):
+                if len(test) < k:
+                    test.append(point)
+                    continue
+                j = rng.randint(0, i)
+                if j < k: # the new point replaces a test point, which becomes a training point
+                    point, test[j] = test[j], point
+                train.append(point)
+        else:
+            raise ValueError(f"unknown split method: {method} (use 'hash' or 'reservoir')")
+
+        return train, test
 
     def make_eval_data(self, para_selector, dev_data, destination, cfg):
         """
@@ -362,17 +666,25 @@ class HotPotDataHandler():
         :param para_selector: a Paragraph Selector object
         :param dev_data: a list of raw_points
         :param destination: the file where eval data should be dumped
-        :param cfg: a ConfigReader object (necessary to get ps_threshold and text_length for Paragraph Selector)
+        :param cfg: a ConfigReader object (necessary to get ps_threshold, text_length and pack_sequences for Paragraph Selector)
         """
-        id_to_list_index = {point['_id']: i for i, point in enumerate(self.data)}
+        # only keep the original points of dev_data (the file is read as a stream, until all of them are found)
+        dev_ids = set([point[0] for point in dev_data])
+        original_points = {}
+        for point in self.records():
+            if point['_id'] in dev_ids:
+                original_points[point['_id']] = point
+                if len(original_points) == len(dev_ids):
+                    break
 
         eval_data = []
         for point in tqdm(dev_data, desc="eval_data prep."):
             context = para_selector.make_context(point, # TODO sort out parameter passing via config (this should use the gpu if possible)
                                                  threshold=cfg("ps_threshold"),
-                                                 context_length=cfg("text_length"))
+                                                 context_length=cfg("text_length"),
+                                                 packed=bool(cfg("pack_sequences")))
             # get the datapoint from the original data with the same '_id' as the point we are looking at
-            original_point = self.data[id_to_list_index[point[0]]]
+            original_point = original_points[point[0]]
             original_point['context'] = context
 
             sup_facts_lc = {p_title.lower():s_idxs for p_title,s_idxs in point[1].items()} # dict{str:list[int]}
@@ -394,6 +706,102 @@ class HotPotDataHandler():
             json.dump(eval_data, f)
 
 
+class StreamingEvaluation():
+    """
+    Evaluation of predictions that arrive in chunks. Each prediction is written to
+    a JSONL file (one line per question) and scored right away with the functions
+    of the official evaluation script (hotpot_evaluate_v1), so that memory doesn't
+    grow with the number of questions. At the end, merge() writes the predictions
+    in the official format ({"answer": {...}, "sp": {...}}).
+    """
+
+    def __init__(self, jsonl_filepath):
+        """
+        :param jsonl_filepath: file for the predictions, one JSON object per line
+        """
+        self.jsonl_filepath = jsonl_filepath
+        self.file = open(jsonl_filepath, 'w', encoding='utf-8')
+        self.totals = {'em': 0, 'f1': 0, 'prec': 0, 'recall': 0,
+                       'sp_em': 0, 'sp_f1': 0, 'sp_prec': 0, 'sp_recall': 0,
+                       'joint_em': 0, 'joint_f1': 0, 'joint_prec': 0, 'joint_recall': 0}
+        self.n_points = 0
+
+    def add(self, point_id, answer, sp, gold_answer, gold_sp):
+        """
+        Write and score the prediction for one question.
+        :param point_id: question ID
+        :param answer: predicted answer (str)
+        :param sp: predicted supporting facts, list[[paragraph_title, sent_num]]
+        :param gold_answer: the correct answer (str)
+        :param gold_sp: the correct supporting facts, dict{paragraph_title: [sent_num]} (as in raw points)
+        """
+        self.file.write(json.dumps({"_id": point_id, "answer": answer, "sp": sp}) + "\n")
+        official_eval_script.update_point(self.totals, answer, sp, gold_answer,
+                                          [[title, j] for title, sents in gold_sp.items() for j in sents])
+        self.n_points += 1
+
+    def metrics(self):
+        """ :return: metrics like those of the official evaluation script, averaged over all questions so far """
+        return {k: v / max(self.n_points, 1) for k, v in self.totals.items()}
+
+    def merge(self, predictions_filepath):
+        """
+        Write all predictions to predictions_filepath in the official format
+        (reading the JSONL file line by line, once for the answers and once for the supporting facts).
+        :param predictions_filepath: file that can be passed to the official evaluation script
+        :return: the final metrics (see metrics())
+        """
+        self.file.close()
+        with open(predictions_filepath, 'w', encoding='utf-8') as out:
+            for key, opening in [("answer", '{"answer": {'), ("sp", '}, "sp": {')]:
+                out.write(opening)
+                with open(self.jsonl_filepath, 'r', encoding='utf-8') as f:
+                    for n, line in enumerate(f):
+                        prediction = json.loads(line)
+                        out.write((", " if n else "") + json.dumps(prediction["_id"]) + ": " + json.dumps(prediction[key]))
+            out.write("}}")
+        return self.metrics()
+
+FAST_TOKENIZERS = {} # {name: BertTokenizerFast} -- for token offsets (see tokenize_context())
+
+def tokenize_context(context, tokenizer):
+    """
+    Tokenize a context once (as a single string, like EntityGraph.flatten_context())
+    and find out which sentence each token belongs to, using the character offsets
+    of a fast tokenizer. The paragraph titles count as sentences (the first
+    sentence of each paragraph), like in sentence_lengths().
+    :param context: a context as provided by EntityGraph, for example
+    :param tokenizer: usually a BERT Tokenizer (a fast tokenizer with the same vocabulary is used for the offsets)
+    :return text: the context as a single string
+    :return offsets: Tensor of shape (T, 2) -- start and end character of each of the T tokens
+    :return token_sentences: Tensor of shape (T) -- number of each token's sentence (counted over all paragraphs)
+    :return paragraph_sizes: list[int] -- number of sentences (including the title) per paragraph
+    """
+    if not getattr(tokenizer, "is_fast", False):
+        name = getattr(tokenizer, "name_or_path", None) or 'bert-base-uncased'
+        if name not in FAST_TOKENIZERS:
+            from transformers import BertTokenizerFast
+            FAST_TOKENIZERS[name] = BertTokenizerFast.from_pretrained(name)
+        tokenizer = FAST_TOKENIZERS[name]
+
+    # same string as EntityGraph.flatten_context(), but with the start of each sentence
+    text = ""
+    sentence_starts = []
+    for para in context:
+        sentence_starts.append(len(text))
+        text += para[0] + " "
+        for sent in para[1]:
+            sentence_starts.append(len(text))
+            text += sent
+        text += " "
+    text = text.rstrip()
+
+    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+    offsets = torch.tensor(offsets, dtype=torch.long).view(-1, 2) # (T, 2)
+    token_sentences = torch.searchsorted(torch.tensor(sentence_starts, dtype=torch.long),
+                                         offsets[:, 0].contiguous(), right=True) - 1
+    return text, offsets, token_sentences, [1 + len(p[1]) for p in context]
+
 def make_labeled_data_for_predictor(graph, raw_point, tokenizer):
     """
     Prepare labeled data for the Predictor, i.e. per-token labels for
@@ -409,6 +817,10 @@ def make_labeled_data_for_predictor(graph, raw_point, tokenizer):
         - supporting facts
         - answer
 
+    All labels are made from one tokenization of the context (see tokenize_context()):
+    the answer span is the first occurrence of the answer in the context (preferably
+    in a supporting sentence), mapped to tokens via their character offsets.
+
     :param graph: instance of the EntityGraph class (holds context with M tokens)
     :param raw_point: data point as returned from HotPotDataHandler.data_for_paragraph_selector()
     :return sup_labels: Tensor of shape M -- marks tokens that are 'supporting facts'
@@ -417,16 +829,25 @@ def make_labeled_data_for_predictor(graph, raw_point, tokenizer):
     :return type_labels: Tensor of shape 1 -- one of 3 question types (yes/no/span)
     """
     M = len(graph.tokens)
-    # print(f"making labels for point {raw_point[0]}") #CLEANUP
-    # print(f"query of that point: {raw_point[2]}") #CLEANUP
-    # print(f"length of graph's tokens (=M): {M}") #CLEANUP
-    # print(f"raw_point context:\n{raw_point[3]}\n\n") #CLEANUP
 
     sup_labels = torch.zeros(M, dtype=torch.long) # CrossEntropyLoss needs dtype=torch.long
     start_label = torch.zeros(1, dtype=torch.long)
     end_label = torch.zeros(1, dtype=torch.long)
     type_labels = torch.zeros(1, dtype=torch.long)
 
+    text, offsets, token_sentences, paragraph_sizes = tokenize_context(graph.context, tokenizer)
+    offsets, token_sentences = offsets[:M], token_sentences[:M] # the graph's tokens are cut to M
+
+    # supporting sentences (numbered over all paragraphs; the 0th sentence of a paragraph is its title)
+    is_supporting = torch.zeros(sum(paragraph_sizes), dtype=torch.bool)
+    first_sentence = 0
+    for para, size in zip(graph.context, paragraph_sizes):
+        for j in raw_point[1].get(para[0], []):
+            if j + 1 < size:
+                is_supporting[first_sentence + j + 1] = True
+        first_sentence += size
+    sup_labels[:offsets.shape[0]] = is_supporting[token_sentences].long()
+
     answer = raw_point[4].lower()
 
     # get answer type
@@ -438,48 +859,335 @@ def make_labeled_data_for_predictor(graph, raw_point, tokenizer):
         type_labels[0] = 2
 
     # if the answer is not "yes" or "no", its a span
-    if type_labels[0] == 2:
-        for i, token in enumerate(graph.tokens):
-            if answer.startswith(token) and start_label==0:
-                start_label[0] = i # take the first start token's index as the label
-            if answer.endswith(token):
-                end_label[0] = i # take the last end token's index as label
-
-    # get supporting facts (paragraphs)
-    list_context = [[p[0] + " "] + p[1] for p in graph.context]  # squeeze header into the paragraph
-    num_sentences = sum([len(p) for p in list_context]) # number of sentence, including headers
-
-    # use an extra tokenizer again in order to have the correct number of tokens in order to determine position later
-    tokenized_sentences = [[tokenizer.tokenize(s) for s in p] for p in list_context] # list[list[list[str]]]
-
-    position = 0
-    sent_position = 0
-    for i, para in enumerate(graph.context):
-        if raw_point[1].get(para[0]): # para title in supporting facts
-            for j, sent in enumerate(tokenized_sentences[i]):
-                if j - 1 in raw_point[1][para[0]]: # the 0th sentence is the paragraph title, j - 1 accounts for that
-                    sup_labels[ position : position + len(sent) ] = 1 # fill with 1's from position to position + len(sent)
-                position += len(sent) # update position
-                sent_position += 1
-        else: # if the paragraph does not have any supporting facts, update our position with the total paragraph length
-            position += sum([len(sent) for sent in tokenized_sentences[i]])
-            sent_position += len(tokenized_sentences[i])
-
-    return sup_labels, start_label, end_label, type_labels # M, M, M, 1
+    if type_labels[0] == 2 and answer.strip() and offsets.shape[0] > 0:
+        token_starts = offsets[:, 0].contiguous()
+        spans = [] # (start token, end token) of each occurrence of the answer
+        for match in re.finditer(re.escape(answer.strip()), text, flags=re.IGNORECASE):
+            if match.start() >= offsets[-1, 1]: # beyond the M tokens
+                break
+            chars = torch.tensor([match.start(), match.end() - 1], dtype=torch.long)
+            spans.append((torch.searchsorted(token_starts, chars, right=True) - 1).clamp(min=0).tolist())
+        if spans:
+            supported = [s for s in spans if sup_labels[s[0]] == 1]
+            start_label[0], end_label[0] = supported[0] if supported else spans[0]
+
+    return sup_labels, start_label, end_label, type_labels # M, 1, 1, 1
 
 def sentence_lengths(context, tokenizer):
     """
     Return the length of each sentence in each paragraph of the context
+    (counted on the same tokenization as the labels; see tokenize_context())
 
     :param context: a context as provided by EntityGraph, for example
     :param tokenizer: usually a BERT Tokenizer
     :return: list[list[int]] -- number of tokens per sentence, per paragraph
     """
-    list_context = [[p[0] + " "] + p[1] for p in context]  # squeeze header into the paragraph
-    tokenized_sentences = [[tokenizer.tokenize(s) for s in p] for p in list_context]  # list[list[list[str]]]
-    sentence_lengths = [[len(s) for s in p] for p in tokenized_sentences]  # list[list[int]]
+    _, _, token_sentences, paragraph_sizes = tokenize_context(context, tokenizer)
+    lengths = torch.bincount(token_sentences, minlength=sum(paragraph_sizes)).tolist()
+    sentence_lengths = []  # list[list[int]]
+    for size in paragraph_sizes:
+        sentence_lengths.append(lengths[:size])
+        lengths = lengths[size:]
     return sentence_lengths
 
+def pack_sequences(sequences, window=512, pad_token_id=0):
+    """
+    Pack several token ID sequences into as few windows of 'window' tokens as
+    possible (first-fit, longest sequences first). Each sequence gets its own
+    block in a block-diagonal attention mask, so that sequences sharing a
+    window can't attend to each other, and position IDs restart at 0 for each
+    sequence. Sequences longer than 'window' are trimmed.
+
+    :param sequences: list[Tensor[int]] -- 1-dimensional token ID tensors, without padding
+    :param window: number of tokens per packed sequence (512 for BERT)
+    :param pad_token_id: for filling up the unused end of a window
+    :return token_ids: Tensor of shape (P, window) -- P packed sequences
+    :return attention_mask: Tensor of shape (P, window, window) -- block-diagonal, 1 = attend
+    :return position_ids: Tensor of shape (P, window) -- restarting at each sequence
+    :return layout: list[(int, int, int)] -- (pack index, offset, length) for each input sequence
+    """
+    device = sequences[0].device if sequences else torch.device('cpu')
+    lengths = [min(s.shape[0], window) for s in sequences]
+
+    bins = []  # list[ list[int] ] -- indices of the sequences in each window
+    free = []  # list[int] -- remaining space in each window
+    layout = [None for _ in sequences]
+    for i in sorted(range(len(sequences)), key=lambda x: lengths[x], reverse=True):
+        for b, space in enumerate(free):
+            if lengths[i] <= space:
+                break
+        else:  # no window has enough space left; open a new one
+            bins.append([])
+            free.append(window)
+            b = len(bins) - 1
+        layout[i] = (b, window - free[b], lengths[i])
+        bins[b].append(i)
+        free[b] -= lengths[i]
+
+    P = len(bins)
+    token_ids = torch.full((P, window), pad_token_id, dtype=torch.long, device=device)
+    attention_mask = torch.zeros((P, window, window), dtype=torch.long, device=device)
+    position_ids = torch.zeros((P, window), dtype=torch.long, device=device)
+
+    for i, (b, offset, length) in enumerate(layout):
+        token_ids[b, offset:offset+length] = sequences[i][:length]
+        attention_mask[b, offset:offset+length, offset:offset+length] = 1
+        position_ids[b, offset:offset+length] = torch.arange(length, device=device)
+
+    return token_ids, attention_mask, position_ids, layout
+
+def pad_with_mask(tensors):
+    """
+    Pad tensors of different lengths (first dimension) to a batch.
+
+    :param tensors: list[Tensor] -- each of shape (length, ...)
+    :return padded: Tensor of shape (batch, max_length, ...) -- padded with zeros
+    :return mask: Tensor[bool] of shape (batch, max_length) -- True for real entries
+    """
+    padded = nn.utils.rnn.pad_sequence(tensors, batch_first=True)
+    lengths = torch.tensor([t.shape[0] for t in tensors], device=padded.device)
+    mask = torch.arange(padded.shape[1], device=padded.device).unsqueeze(0) < lengths.unsqueeze(1)
+    return padded, mask
+
+def init_distributed(backend="gloo", timeout_minutes=120):
+    """
+    Join the process group of a data-parallel run, if this process is part of one.
+    The processes are started with torchrun (which sets RANK, WORLD_SIZE,
+    MASTER_ADDR and MASTER_PORT), e.g., with 4 processes on one machine:
+    torchrun --nproc_per_node=4 train_dfgn.py config/train_dfgn.cfg my_model
+    :param backend: 'gloo' (CPUs) or 'nccl' (GPUs)
+    :param timeout_minutes: how long processes wait for each other (e.g., while rank 0 evaluates)
+    :return: (rank, world_size) -- (0, 1) if the process runs on its own
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) > 1 and not torch.distributed.is_initialized():
+        torch.distributed.init_process_group(backend, timeout=timedelta(minutes=timeout_minutes))
+    return distributed_rank(), distributed_world_size()
+
+def distributed_rank():
+    """ :return: rank of this process (0 without a process group) """
+    return torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
+
+def distributed_world_size():
+    """ :return: number of processes in the process group (1 without a process group) """
+    return torch.distributed.get_world_size() if torch.distributed.is_initialized() else 1
+
+def barrier():
+    """ wait for all processes (if there is a process group) """
+    if distributed_world_size() > 1:
+        torch.distributed.barrier()
+
+def all_reduce_tensor(tensor):
+    """
+    Sum a tensor over all processes (in place).
+    :param tensor: Tensor
+    :return: the summed tensor
+    """
+    if distributed_world_size() > 1:
+        torch.distributed.all_reduce(tensor)
+    return tensor
+
+def broadcast_parameters(module, src=0):
+    """
+    Give all processes the parameters and buffers of process 'src' (e.g., after random initialization).
+    :param module: nn.Module
+    :param src: rank of the process whose values are used
+    """
+    if distributed_world_size() > 1:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            torch.distributed.broadcast(tensor.data, src)
+
+def all_reduce_gradients(module, average=False, bucket_size=2**24):
+    """
+    Sum (or average) the gradients of a module over all processes, like
+    DistributedDataParallel does, but after the backward passes. This also works
+    for modules that aren't called via forward() (e.g., DFGN.forward_batch())
+    or that don't use all of their parameters in each step.
+    Gradients are reduced in flat buckets of about bucket_size values;
+    parameters without gradients (in this process) contribute zeros.
+    :param module: nn.Module
+    :param average: if True, divide the sums by the number of processes
+    :param bucket_size: number of values per all_reduce call
+    """
+    world_size = distributed_world_size()
+    if world_size == 1:
+        return
+    params = [p for p in module.parameters() if p.requires_grad]
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+
+    buckets, current, size = [], [], 0
+    for p in params:
+        current.append(p)
+        size += p.numel()
+        if size >= bucket_size:
+            buckets.append(current)
+            current, size = [], 0
+    if current:
+        buckets.append(current)
+
+    for bucket in buckets:
+        flat = torch.cat([p.grad.reshape(-1) for p in bucket])
+        torch.distributed.all_reduce(flat)
+        if average:
+            flat /= world_size
+        offset = 0
+        for p in bucket:
+            p.grad.copy_(flat[offset:offset + p.numel()].view_as(p.grad))
+            offset += p.numel()
+
+def cpu_copy(obj):
+    """
+    Copy all tensors in a (nested) dict/list/tuple to the CPU, e.g. to take a
+    snapshot of state_dicts that training can't change anymore.
+    :param obj: Tensor, dict, list, tuple or any other object (returned as it is)
+    :return: the same structure with copied tensors
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: cpu_copy(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(v) for v in obj)
+    return obj
+
+def rng_states():
+    """ :return: dict with the states of Python's, torch's and (if available) CUDA's random number generators """
+    states = {"python": random.getstate(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+def set_rng_states(states):
+    """ :param states: dict as returned by rng_states() """
+    random.setstate(states["python"])
+    torch.set_rng_state(states["torch"])
+    if "cuda" in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """
+    Wraps a sampler and leaves out its first 'skip' indices, in order to
+    continue an epoch at the position where a checkpoint was saved (without
+    loading the batches that were trained on already).
+    """
+
+    def __init__(self, sampler):
+        """
+        :param sampler: a Sampler whose order only depends on the epoch (e.g., seeded RandomSampler, DistributedSampler)
+        """
+        self.sampler = sampler
+        self.skip = 0 # number of indices to leave out in the current epoch
+
+    def __iter__(self):
+        return itertools.islice(iter(self.sampler), self.skip, None)
+
+    def __len__(self):
+        return max(len(self.sampler) - self.skip, 0)
+
+
+class CheckpointManager():
+    """
+    Save training checkpoints (state_dicts of the model, optimizer etc., RNG states and
+    the position in the training data) in a background thread, and find them again to
+    resume training. The state is copied to the CPU in the training thread, so that
+    training can continue while it's written. Files are written under a temporary
+    name and renamed when complete, so that a crash never leaves a broken checkpoint.
+    The last keep_last checkpoints and the keep_best checkpoints with the best scores
+    are kept; checkpoints.json lists them.
+    """
+
+    def __init__(self, directory, keep_last=2, keep_best=1, asynchronous=True):
+        """
+        :param directory: where the checkpoints are saved (created if necessary)
+        :param keep_last: number of most recent checkpoints to keep
+        :param keep_best: number of checkpoints with the highest scores to keep
+        :param asynchronous: if False, save() returns after the checkpoint is written
+        """
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.asynchronous = asynchronous
+        self.thread = None
+        self.error = None
+        os.makedirs(directory, exist_ok=True)
+
+        self.index_path = os.path.join(directory, "checkpoints.json")
+        self.index = [] # list[ {"step": int, "score": float or None, "file": str} ], oldest first
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+
+    def save(self, step, state, score=None):
+        """
+        Save a checkpoint (and delete the ones that aren't kept anymore).
+        :param step: training step (e.g., number of optimizer steps), used for the file name
+        :param state: dict with state_dicts and other picklable objects
+        :param score: dev score (higher is better) for keeping the best checkpoints, or None
+        """
+        self.wait() # one checkpoint at a time
+        snapshot = cpu_copy(state)
+        if self.asynchronous:
+            self.thread = threading.Thread(target=self._write, args=(step, snapshot, score), daemon=True)
+            self.thread.start()
+        else:
+            self._write(step, snapshot, score)
+
+    def _write(self, step, snapshot, score):
+        """ write a checkpoint and update the index (runs in the background thread) """
+        try:
+            filename = f"checkpoint_{step:08d}.pt"
+            path = os.path.join(self.directory, filename)
+            torch.save(snapshot, path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+            self.index = [c for c in self.index if c["file"] != filename] + \
+                         [{"step": step, "score": score, "file": filename}]
+            kept = self.index[-self.keep_last:] if self.keep_last else []
+            scored = sorted([c for c in self.index if c["score"] is not None], key=lambda c: c["score"], reverse=True)
+            kept += scored[:self.keep_best]
+            for c in self.index:
+                if c not in kept and os.path.exists(os.path.join(self.directory, c["file"])):
+                    os.remove(os.path.join(self.directory, c["file"]))
+            self.index = [c for c in self.index if c in kept]
+
+            with open(self.index_path + ".tmp", "w") as f:
+                json.dump(self.index, f)
+            os.replace(self.index_path + ".tmp", self.index_path)
+        except Exception as e: # reported in the training thread by wait()
+            self.error = e
+
+    def wait(self):
+        """ wait until the current checkpoint is written """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            print(f"WARNING: a checkpoint couldn't be saved ({error}).")
+
+    def latest(self):
+        """ :return: path of the most recent checkpoint, or None """
+        self.wait()
+        return os.path.join(self.directory, self.index[-1]["file"]) if self.index else None
+
+    def best(self):
+        """ :return: path of the checkpoint with the best score, or None """
+        self.wait()
+        scored = [c for c in self.index if c["score"] is not None]
+        if not scored:
+            return None
+        return os.path.join(self.directory, max(scored, key=lambda c: c["score"])["file"])
+
+    @staticmethod
+    def load(path, map_location='cpu'):
+        """
+        :param path: checkpoint file (e.g., from latest() or best())
+        :return: the saved state (see save())
+        """
+        return torch.load(path, map_location=map_location)
+
 
 class Linear(nn.Module):
     '''
@@ -524,13 +1232,15 @@ class BiDAFNet(torch.nn.Module):
 
         self.reduction_layer = Linear(hidden_size * 4, output_size, dropout=dropout)
 
-    def forward(self, emb1, emb2, batch_processing=False):
+    def forward(self, emb1, emb2, batch_processing=False, x_mask=None, y_mask=None):
         """
         Perform bidaf and return the updated emb2.
         This method can handle single data points as well as batches.
         :param emb1: (batch, x_len, hidden_size)
         :param emb2: (batch, y_len, hidden_size)
-        :return: (batch, y_len, output_size)
+        :param x_mask: (batch, x_len) -- for padded batches: False for padding positions of emb1
+        :param y_mask: (batch, y_len) -- for padded batches: False for padding positions of emb2
+        :return: (batch, y_len, output_size) -- positions that are padding in emb2 are meaningless
         """
 
         # make sure that batch processing works, even for single data points
@@ -540,24 +1250,35 @@ class BiDAFNet(torch.nn.Module):
         x_len = emb1.size(1) # (batch, x_len, hidden_size)
         y_len = emb2.size(1) # (batch, y_len, hidden_size)
 
-        xy = []
-        for i in range(x_len):
-            xi = emb1.select(1, i).unsqueeze(1)  # (batch, 1, hidden_size)
-            yi = self.att_weight_cq(emb2 * xi).squeeze(-1) # (batch, y_len, 1) --> (batch, y_len)
-            xy.append(yi) # (x_len, batch, y_len)
-        xy = torch.stack(xy, dim=-1)  # (batch, y_len, x_len)
+        if self.training and hasattr(self.att_weight_cq, 'dropout'): # dropout differs for each xi
+            xy = []
+            for i in range(x_len):
+                xi = emb1.select(1, i).unsqueeze(1)  # (batch, 1, hidden_size)
+                yi = self.att_weight_cq(emb2 * xi).squeeze(-1) # (batch, y_len, 1) --> (batch, y_len)
+                xy.append(yi) # (x_len, batch, y_len)
+            xy = torch.stack(xy, dim=-1)  # (batch, y_len, x_len)
+        else: # the same without a loop: w.T x (y * x) + b = (y * w).T x x + b
+            w = self.att_weight_cq.linear.weight.squeeze(0) # (hidden_size)
+            xy = torch.bmm(emb2 * w, emb1.permute(0, 2, 1)) + self.att_weight_cq.linear.bias  # (batch, y_len, x_len)
 
         # (batch, y_len, x_len)
         s = self.att_weight_c(emb2).expand(-1, -1, x_len) + \
             self.att_weight_q(emb1).permute(0, 2, 1).expand(-1, y_len, -1) + \
             xy
 
+        # padding positions don't get any attention
+        if x_mask is not None:
+            s = s.masked_fill(~x_mask.bool().unsqueeze(1), torch.finfo(s.dtype).min)
+
         a = nnF.softmax(s, dim=2)  # (batch, y_len, x_len)
 
         # (batch, y_len, x_len) * (batch, x_len, hidden_size) -> (batch, y_len, hidden_size)
         y2x_att = torch.bmm(a, emb1)
 
-        b = nnF.softmax(torch.max(s, dim=2)[0], dim=1).unsqueeze(1) # (batch, 1, y_len)
+        s_max = torch.max(s, dim=2)[0] # (batch, y_len)
+        if y_mask is not None:
+            s_max = s_max.masked_fill(~y_mask.bool(), torch.finfo(s.dtype).min)
+        b = nnF.softmax(s_max, dim=1).unsqueeze(1) # (batch, 1, y_len)
 
         # (batch, 1, y_len) * (batch, y_len, hidden_size) -> (batch, hidden_size)
         x2y_att = torch.bmm(b, emb2).squeeze(1)